@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the asyncio download center module using a local server"""
+
+import os
+from os.path import join
+from time import time
+from unittest.mock import Mock, patch
+from . import test_download_center
+from ..tools import get_data_dir, LoggedTestCase
+from ..tools.local_server import LocalHttp, RequestHandler
+from urllib.parse import quote
+from umake.network.async_download_center import AsyncDownloadCenter
+from umake.network.download_center import DownloadItem, RetryPolicy
+
+
+class TestAsyncDownloadCenter(test_download_center.TestDownloadCenter):
+    """Run all download center tests against the asyncio engine"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(test_download_center, "DownloadCenter", AsyncDownloadCenter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestAsyncDownloadCenterTransfers(LoggedTestCase):
+    """This will test what is specific to the asyncio engine"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.retry_policy = RetryPolicy(attempts=3, backoff=0)
+
+    def tearDown(self):
+        AsyncDownloadCenter._host_failures.clear()
+        AsyncDownloadCenter.close_idle_connections()
+        super().tearDown()
+        for fd in self.fd_to_close:
+            fd.close()
+
+    def download(self, requests, download=True):
+        self.callback.reset_mock()
+        AsyncDownloadCenter(requests, self.callback, download=download)
+        test_download_center.TestDownloadCenter.wait_for_callback(self, self.callback)
+        return self.callback.call_args[0][0]
+
+    def assert_file_content(self, filename, result):
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), (result.fd or result.buffer).read())
+
+    def test_many_concurrent_downloads(self):
+        """we deliver many downloads at once"""
+        requests = [DownloadItem("{}/simplefile?id={}".format(self.server.get_address(), i)) for i in range(50)]
+
+        results = self.download(requests, download=False)
+
+        self.assertEqual(len(results), 50)
+        for result in results.values():
+            self.assert_file_content("simplefile", result)
+        self.assertEqual(self.callback.call_count, 1)
+
+    def test_retry_on_server_error(self):
+        """we retry on 5xx errors and report retries"""
+        url = "{}/simplefile-flaky?fail=2&id=async_retry_on_server_error".format(self.server.get_address())
+
+        result = self.download([DownloadItem(url, retry_policy=self.retry_policy)])[url]
+
+        self.assert_file_content("simplefile", result)
+        self.assertEqual(result.retries, 2)
+        self.expect_warn_error = True
+
+    def test_restart_truncated_download(self):
+        """we download truncated content again from the start"""
+        url = "{}/biggerfile-truncated?id=async_restart_truncated_download".format(self.server.get_address())
+
+        result = self.download([DownloadItem(url, retry_policy=self.retry_policy)])[url]
+
+        self.assert_file_content("biggerfile", result)
+        self.assertEqual(result.retries, 1)
+        self.expect_warn_error = True
+
+    def test_reuse_connection(self):
+        """we reuse kept alive connections for next requests to the same host"""
+        url = "{}/simplefile".format(self.server.get_address())
+        with patch.object(RequestHandler, "protocol_version", "HTTP/1.1"):
+            self.assert_file_content("simplefile", self.download([DownloadItem(url)])[url])
+            idle_connections = [connection for connections in AsyncDownloadCenter._idle_connections.values()
+                                for connection in connections]
+            self.assertEqual(len(idle_connections), 1)
+            reader = idle_connections[0].reader
+
+            self.assert_file_content("simplefile", self.download([DownloadItem(url)])[url])
+            idle_connections = [connection for connections in AsyncDownloadCenter._idle_connections.values()
+                                for connection in connections]
+            self.assertEqual(len(idle_connections), 1)
+            self.assertIs(idle_connections[0].reader, reader)
+            AsyncDownloadCenter.close_idle_connections()
+            # let the server see that the connection was closed
+            timeout = time() + 5
+            while not idle_connections[0].writer.is_closing() and time() < timeout:
+                pass
+
+    def test_delegate_local_files(self):
+        """we download other protocols in threads"""
+        path = join(self.server_dir, "simplefile")
+
+        result = self.download([DownloadItem("file://" + path)])["file://" + path]
+
+        self.assert_file_content("simplefile", result)
+
+    def test_proxy_from_environment(self):
+        """we download through the proxy configured in the environment"""
+        url = "{}/simplefile".format(self.server.get_address())
+        # nothing listens there
+        with patch.dict(os.environ, {"http_proxy": "http://localhost:9", "no_proxy": ""}):
+            result = self.download([DownloadItem(url, retry_policy=RetryPolicy(attempts=1))])[url]
+
+        self.assertIn("proxy", result.error.lower())
+        self.expect_warn_error = True
+
+    def test_no_proxy_from_environment(self):
+        """we don't use the proxy for hosts excluded from it"""
+        url = "{}/simplefile".format(self.server.get_address())
+        with patch.dict(os.environ, {"http_proxy": "http://localhost:9", "no_proxy": "localhost"}):
+            result = self.download([DownloadItem(url)])[url]
+
+        self.assert_file_content("simplefile", result)
+
+    def test_redirect_to_proxied_url(self):
+        """we download through the proxy urls we are redirected to"""
+        target = "http://127.0.0.1:{}/simplefile".format(self.server.port)
+        url = "{}/simplefile?redirect_to={}".format(self.server.get_address(), quote(target))
+        with patch.dict(os.environ, {"http_proxy": "http://localhost:9", "no_proxy": "localhost"}):
+            result = self.download([DownloadItem(url, retry_policy=RetryPolicy(attempts=1))])[url]
+
+        self.assertIn("proxy", result.error.lower())
+        self.expect_warn_error = True
+
+    def test_redirect_keeps_credentials_on_same_host(self):
+        """we send authorization and cookies to the host we are redirected to if it's the same"""
+        path = "simplefile?id=redirect_keeps_credentials"
+        target = "{}/{}".format(self.server.get_address(), path)
+        url = "{}/simplefile?redirect_to={}".format(self.server.get_address(), quote(target))
+
+        result = self.download([DownloadItem(url, headers={"Authorization": "Basic Zm9vOmJhcg=="},
+                                             cookies={"session": "secret"})])[url]
+
+        self.assert_file_content("simplefile", result)
+        headers = RequestHandler.headers_received["/" + path]
+        self.assertEqual(headers["Authorization"], "Basic Zm9vOmJhcg==")
+        self.assertIn("session=secret", headers["Cookie"])
+
+    def test_redirect_drops_credentials_on_other_host(self):
+        """we don't send authorization and cookies to another host we are redirected to"""
+        path = "simplefile?id=redirect_drops_credentials"
+        target = "http://127.0.0.1:{}/{}".format(self.server.port, path)
+        url = "{}/simplefile?redirect_to={}".format(self.server.get_address(), quote(target))
+
+        result = self.download([DownloadItem(url, headers={"Authorization": "Basic Zm9vOmJhcg==",
+                                                           "Cookie": "other=secret", "X-Custom": "foo"},
+                                             cookies={"session": "secret"})])[url]
+
+        self.assert_file_content("simplefile", result)
+        headers = RequestHandler.headers_received["/" + path]
+        self.assertIsNone(headers["Authorization"])
+        self.assertIsNone(headers["Cookie"])
+        self.assertEqual(headers["X-Custom"], "foo")
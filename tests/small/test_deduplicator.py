@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the deduplicator module"""
+
+import os
+from time import time
+from unittest.mock import Mock, patch
+import shutil
+import tempfile
+from ..tools import LoggedTestCase
+from umake.deduplicator import Deduplicator
+
+
+class TestDeduplicator(LoggedTestCase):
+    """This will test the deduplicator class"""
+
+    def setUp(self):
+        super().setUp()
+        self.on_done = Mock()
+        self.tempdir = tempfile.mkdtemp()
+        self.index_patch = patch("umake.deduplicator.settings.DEDUP_INDEX_PATH",
+                                 os.path.join(self.tempdir, "index"))
+        self.index_patch.start()
+        self.content = os.urandom(Deduplicator.MIN_FILE_SIZE * 2)
+
+    def tearDown(self):
+        self.index_patch.stop()
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def wait_for_callback(self, mock_function_to_be_called, timeout=10):
+        """wait for the callback to be called until a timeout."""
+        timeout_time = time() + timeout
+        while not mock_function_to_be_called.called:
+            if time() > timeout_time:
+                raise(BaseException("Function not called within {} seconds".format(timeout)))
+
+    def create_tree(self, name, files):
+        """Create an installed tree with files: {relative path: content}"""
+        root = os.path.join(self.tempdir, name)
+        for path, content in files.items():
+            path = os.path.join(root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+        return root
+
+    def deduplicate(self, paths):
+        self.on_done.reset_mock()
+        Deduplicator(paths, self.on_done)
+        self.wait_for_callback(self.on_done)
+        return self.on_done.call_args[0][0]
+
+    def assertSameContent(self, path1, path2):
+        """Files are either sharing their inodes (hardlinks) or their extents (reflinks)"""
+        with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_deduplicate_between_trees(self):
+        """Identical files in a new tree are replaced and saved space is reported"""
+        first = self.create_tree("first", {"lib/foo.jar": self.content})
+        second = self.create_tree("second", {"lib/bar.jar": self.content})
+
+        self.assertEqual(self.deduplicate([first])[first], Deduplicator.DedupResult(saved=0, error=None))
+        result = self.deduplicate([second])
+
+        self.assertEqual(result[second], Deduplicator.DedupResult(saved=len(self.content), error=None))
+        self.assertSameContent(os.path.join(first, "lib", "foo.jar"), os.path.join(second, "lib", "bar.jar"))
+        self.assertEqual(Deduplicator.get_report(), {second: len(self.content)})
+
+    def test_deduplicate_in_same_tree(self):
+        """Identical files inside the same tree are deduplicated"""
+        root = self.create_tree("root", {"a/foo": self.content, "b/foo": self.content})
+
+        self.assertEqual(self.deduplicate([root])[root].saved, len(self.content))
+        self.assertSameContent(os.path.join(root, "a", "foo"), os.path.join(root, "b", "foo"))
+
+    def test_different_content_same_size(self):
+        """Files with the same size but a different content aren't touched"""
+        other_content = bytearray(self.content)
+        other_content[0] ^= 0xff
+        first = self.create_tree("first", {"foo": self.content})
+        second = self.create_tree("second", {"foo": bytes(other_content)})
+
+        self.deduplicate([first])
+        self.assertEqual(self.deduplicate([second])[second].saved, 0)
+        with open(os.path.join(second, "foo"), 'rb') as f:
+            self.assertEqual(f.read(), bytes(other_content))
+        self.assertEqual(Deduplicator.get_report(), {})
+
+    def test_small_files_ignored(self):
+        """Files under the minimum size are left alone"""
+        small_content = self.content[:Deduplicator.MIN_FILE_SIZE - 1]
+        first = self.create_tree("first", {"foo": small_content})
+        second = self.create_tree("second", {"foo": small_content})
+
+        self.deduplicate([first])
+        self.assertEqual(self.deduplicate([second])[second].saved, 0)
+        self.assertNotEqual(os.stat(os.path.join(first, "foo")).st_ino, os.stat(os.path.join(second, "foo")).st_ino)
+
+    def test_only_hash_on_size_collision(self):
+        """We don't hash a file without any other file of the same size"""
+        first = self.create_tree("first", {"foo": self.content})
+        second = self.create_tree("second", {"foo": self.content + b"bar"})
+
+        with patch.object(Deduplicator, "_hash", wraps=Deduplicator._hash) as hash_mock:
+            self.deduplicate([first])
+            self.deduplicate([second])
+            self.assertFalse(hash_mock.called)
+
+    def test_removed_tree_dropped_from_index(self):
+        """Removed or modified files aren't used as a deduplication source anymore"""
+        first = self.create_tree("first", {"foo": self.content})
+        self.deduplicate([first])
+        shutil.rmtree(first)
+        second = self.create_tree("second", {"foo": self.content})
+
+        self.assertEqual(self.deduplicate([second])[second].saved, 0)
+        self.assertEqual(Deduplicator.load_index()["files"], {str(len(self.content)): [
+            [os.path.join(second, "foo"), os.stat(os.path.join(second, "foo")).st_mtime_ns, None]]})
+
+    def test_reinstall_same_tree(self):
+        """Reinstalling in the same path replaces previous index entries and report"""
+        root = self.create_tree("root", {"a/foo": self.content, "b/foo": self.content})
+        self.deduplicate([root])
+        shutil.rmtree(root)
+        root = self.create_tree("root", {"a/foo": self.content})
+
+        self.assertEqual(self.deduplicate([root])[root].saved, 0)
+        self.assertEqual(Deduplicator.get_report(), {})
+
+    def test_corrupted_index(self):
+        """A corrupted index is reset"""
+        with open(os.path.join(self.tempdir, "index"), 'w') as f:
+            f.write("{corrupted")
+        root = self.create_tree("root", {"foo": self.content})
+
+        self.assertEqual(self.deduplicate([root])[root], Deduplicator.DedupResult(saved=0, error=None))
+        self.assertIn(str(len(self.content)), Deduplicator.load_index()["files"])
+        self.expect_warn_error = True
+
+    def test_missing_path_reports_error(self):
+        """A non existing path reports an error without raising"""
+        path = os.path.join(self.tempdir, "doesnt_exist")
+
+        result = self.deduplicate([path])
+
+        self.assertEqual(result[path].saved, 0)
+        self.assertIsNotNone(result[path].error)
+        self.expect_warn_error = True
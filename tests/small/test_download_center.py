@@ -20,13 +20,20 @@
 """Tests for the download center module using a local server"""
 
 from enum import Enum
+import errno
+from io import BytesIO
 import os
 from os.path import join, getsize
+import shutil
+import tempfile
+from threading import Event
 from time import time
-from unittest.mock import Mock, call
+from unittest.mock import Mock, call, patch
 from ..tools import get_data_dir, CopyingMock, LoggedTestCase
-from ..tools.local_server import LocalHttp
-from umake.network.download_center import DownloadCenter, DownloadItem
+from ..tools.local_server import LocalHttp, RequestHandler
+from umake.network.bundle import Bundle
+from umake.network.download_center import ChecksumUrl, DownloadCenter, DownloadItem, RetryPolicy
+from umake.network.file_adapter import copy_file_content
 from umake.tools import ChecksumType, Checksum
 
 
@@ -302,16 +309,75 @@ class TestDownloadCenter(LoggedTestCase):
         filesize = getsize(join(self.server_dir, filename))
         report = CopyingMock()
         request = DownloadItem(self.build_server_address(filename), None)
-        dl_center = DownloadCenter([request], self.callback, report=report)
-        self.wait_for_callback(self.callback)
+        with patch.object(DownloadCenter, "REPORT_INTERVAL", 0), patch.object(DownloadCenter, "BLOCK_SIZE", 8192),\
+                patch.object(DownloadCenter, "MAX_BLOCK_SIZE", 8192):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
 
         self.assertEqual(report.call_count, 3)
         self.assertEqual(report.call_args_list,
                          [call({self.build_server_address(filename): {'size': filesize, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': filesize,
-                                                                      'current': dl_center.BLOCK_SIZE}}),
+                          call({self.build_server_address(filename): {'size': filesize, 'current': 8192}}),
                           call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
 
+    def test_download_coalesce_progress(self):
+        """we coalesce progress hooks, but always deliver the first and last ones"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        report = CopyingMock()
+        request = DownloadItem(self.build_server_address(filename), None)
+        with patch.object(DownloadCenter, "REPORT_INTERVAL", 3600):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        self.assertEqual(report.call_args_list,
+                         [call({self.build_server_address(filename): {'size': filesize, 'current': 0}}),
+                          call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
+
+    def test_download_coalesce_progress_no_size(self):
+        """we deliver the last progress hook even without any content size"""
+        filename = "simplefile-with-no-content-length"
+        report = CopyingMock()
+        request = DownloadItem(self.build_server_address(filename), None)
+        with patch.object(DownloadCenter, "REPORT_INTERVAL", 3600):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        self.assertEqual(report.call_count, 2)
+        last_progress = {'size': -1, 'current': getsize(join(self.server_dir, filename))}
+        self.assertEqual(report.call_args, call({self.build_server_address(filename): last_progress}))
+
+    def test_download_adapt_block_size(self):
+        """we read bigger blocks on fast transfers, without altering content"""
+        filename = "biggerfile"
+        report = CopyingMock()
+        request = DownloadItem(self.build_server_address(filename), None)
+        with patch.object(DownloadCenter, "REPORT_INTERVAL", 0), patch.object(DownloadCenter, "BLOCK_SIZE", 1024),\
+                patch.object(DownloadCenter, "BLOCK_DURATION", 3600):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][self.build_server_address(filename)]
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+        # 1024, 2048, 4096 then the remaining bytes
+        progress = [args[0][self.build_server_address(filename)]["current"] for (args, kwargs) in
+                    report.call_args_list]
+        self.assertEqual(progress, [0, 1024, 3072, 7168, getsize(join(self.server_dir, filename))])
+
+    def test_download_adapt_block_size_chunked(self):
+        """we receive the whole chunked content while adapting the block size"""
+        filename = "biggerfile"
+        request = DownloadItem(self.build_server_address(filename + "-chunked"), None)
+        with patch.object(DownloadCenter, "BLOCK_SIZE", 1024), patch.object(DownloadCenter, "BLOCK_DURATION", 3600):
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][self.build_server_address(filename + "-chunked")]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
     def test_multiple_downloads(self):
         """we deliver more than on download in parallel"""
         requests = [DownloadItem(self.build_server_address("biggerfile"), None),
@@ -331,13 +397,77 @@ class TestDownloadCenter(LoggedTestCase):
                                  map_result[self.build_server_address(filename)].fd.read())
         self.assertEqual(self.callback.call_count, 1, "Global done callback is only called once")
 
+    def test_multiple_downloads_same_url(self):
+        """we only download once an url requested multiple times"""
+        # the class name keeps requests count separate for test classes running those tests against other engines
+        path = "simplefile-flaky?fail=0&id={}_multiple_downloads_same_url".format(type(self).__name__)
+        url = self.build_server_address(path)
+        DownloadCenter([DownloadItem(url), DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        map_result = self.callback.call_args[0][0]
+        self.assertEqual(list(map_result), [url])
+        with open(join(self.server_dir, "simplefile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), map_result[url].fd.read())
+        self.assertEqual(RequestHandler.requests_count["/" + path], 1)
+        self.assertEqual(self.callback.call_count, 1, "Global done callback is only called once")
+
+    def test_share_identical_requests_in_flight(self):
+        """we share the transfer of identical in memory requests in flight, each getting its own content"""
+        path = "simplefile-flaky?fail=0&id={}_share_identical_requests_in_flight".format(type(self).__name__)
+        url = self.build_server_address(path)
+        other_callback = Mock()
+        release = Event()
+        do_GET = RequestHandler.do_GET
+
+        def held_do_GET(handler):
+            release.wait(5)
+            do_GET(handler)
+        with patch.object(RequestHandler, "do_GET", held_do_GET):
+            DownloadCenter([DownloadItem(url)], self.callback, download=False)
+            DownloadCenter([DownloadItem(url)], other_callback, download=False)
+            release.set()
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(other_callback)
+
+        result = self.callback.call_args[0][0][url]
+        other_result = other_callback.call_args[0][0][url]
+        self.assertIsNot(result.buffer, other_result.buffer)
+        with open(join(self.server_dir, "simplefile"), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        self.assertEqual(result.buffer.read(), content)
+        self.assertEqual(other_result.buffer.read(), content)
+        self.assertEqual(RequestHandler.requests_count["/" + path], 1)
+
+    def test_dont_share_different_requests_in_flight(self):
+        """we don't share transfers of requests in flight for the same url with different options"""
+        path = "simplefile-flaky?fail=0&id={}_dont_share_different_requests_in_flight".format(type(self).__name__)
+        url = self.build_server_address(path)
+        other_callback = Mock()
+        release = Event()
+        do_GET = RequestHandler.do_GET
+
+        def held_do_GET(handler):
+            release.wait(5)
+            do_GET(handler)
+        with patch.object(RequestHandler, "do_GET", held_do_GET):
+            DownloadCenter([DownloadItem(url)], self.callback, download=False)
+            DownloadCenter([DownloadItem(url, headers={"foo": "bar"})], other_callback, download=False)
+            release.set()
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(other_callback)
+
+        self.assertEqual(RequestHandler.requests_count["/" + path], 2)
+
     def test_multiple_downloads_with_reports(self):
         """we deliver more than on download in parallel"""
         requests = [DownloadItem(self.build_server_address("biggerfile"), None),
                     DownloadItem(self.build_server_address("simplefile"), None)]
         report = CopyingMock()
-        DownloadCenter(requests, self.callback, report=report)
-        self.wait_for_callback(self.callback)
+        with patch.object(DownloadCenter, "REPORT_INTERVAL", 0), patch.object(DownloadCenter, "BLOCK_SIZE", 8192),\
+                patch.object(DownloadCenter, "MAX_BLOCK_SIZE", 8192):
+            DownloadCenter(requests, self.callback, report=report)
+            self.wait_for_callback(self.callback)
 
         self.assertEqual(report.call_count, 5)
         # ensure that first call only contains one file
@@ -455,6 +585,80 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.fd)
         self.expect_warn_error = True
 
+    def test_download_with_checksum_url(self):
+        """we deliver one successful download, matching the sha256sum fetched in parallel"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        report = CopyingMock()
+        DownloadCenter([DownloadItem(request, Checksum(ChecksumType.sha256,
+                                                       ChecksumUrl(self.build_server_address("simplefile.sha256"))))],
+                       self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        results = self.callback.call_args[0][0]
+        self.assertEqual(list(results), [request])
+        self.assertIsNone(results[request].error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), results[request].fd.read())
+        # checksum urls aren't part of the reported downloads
+        for report_call in report.call_args_list:
+            self.assertEqual(list(report_call[0][0]), [request])
+
+    def test_download_with_checksum_url_and_parse(self):
+        """we deliver one successful download, matching the checksum parsed from the fetched content"""
+        request = self.build_server_address("simplefile")
+        DownloadCenter([DownloadItem(request, Checksum(ChecksumType.md5,
+                                                       ChecksumUrl(self.build_server_address("simplefile.md5"),
+                                                                   parse=lambda content: content.split()[-1])))],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertIsNotNone(result.fd)
+
+    def test_download_with_wrong_checksum_url(self):
+        """we raise an error if the checksum fetched in parallel doesn't match"""
+        request = self.build_server_address("simplefile")
+        DownloadCenter([DownloadItem(request, Checksum(ChecksumType.md5,
+                                                       ChecksumUrl(self.build_server_address("simplefile.sha256"))))],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_download_with_404_checksum_url(self):
+        """we raise an error if we can't fetch the checksum"""
+        request = self.build_server_address("simplefile")
+        DownloadCenter([DownloadItem(request, Checksum(ChecksumType.sha256,
+                                                       ChecksumUrl(self.build_server_address("does_not_exist"))))],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Couldn't get checksum", result.error)
+        self.assertIn("404", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_multiple_downloads_sharing_checksum_url(self):
+        """we fetch a checksum url only once for all the downloads using it"""
+        checksum = Checksum(ChecksumType.sha256, ChecksumUrl(self.build_server_address("simplefile.sha256")))
+        requests = [DownloadItem(self.build_server_address("simplefile?id={}".format(i)), checksum) for i in range(2)]
+        with patch.object(DownloadCenter, "_start_checksum_downloads",
+                          side_effect=DownloadCenter._start_checksum_downloads, autospec=True) as start:
+            DownloadCenter(requests, self.callback)
+            self.wait_for_callback(self.callback)
+
+        for result in self.callback.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        # the main download center and the one fetching the checksum, with a single url
+        self.assertEqual(start.call_count, 2)
+        self.assertEqual(len(start.call_args_list[1][0][0]._urls), 1)
+
     def test_download_with_no_size(self):
         """we deliver one successful download, even if size isn't provided. Progress returns -1 though"""
         filename = "simplefile-with-no-content-length"
@@ -475,7 +679,9 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertEqual(report.call_count, 2)
         self.assertEqual(report.call_args_list,
                          [call({self.build_server_address(filename): {'size': -1, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': -1, 'current': 8192}})])
+                          call({self.build_server_address(filename): {'size': -1,
+                                                                      'current': getsize(join(self.server_dir,
+                                                                                              filename))}})])
 
     def test_download_with_wrong_checksumtype(self):
         """we raise an error if we don't have a support checksum type"""
@@ -494,6 +700,445 @@ class TestDownloadCenter(LoggedTestCase):
         self.expect_warn_error = True
 
 
+class TestDownloadCenterRetries(LoggedTestCase):
+    """This will test retrying downloads on transient errors"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.retry_policy = RetryPolicy(attempts=3, backoff=0)
+
+    def tearDown(self):
+        DownloadCenter._host_failures.clear()
+        super().tearDown()
+        for fd in self.fd_to_close:
+            fd.close()
+
+    def download(self, request):
+        self.callback.reset_mock()
+        DownloadCenter([request], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+        return self.callback.call_args[0][0][request.url]
+
+    def assert_file_content(self, filename, result):
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_no_retry_on_success(self):
+        """we report no retry on direct success"""
+        result = self.download(DownloadItem(TestDownloadCenter.build_server_address(self, "simplefile")))
+
+        self.assert_file_content("simplefile", result)
+        self.assertEqual(result.retries, 0)
+
+    def test_retry_on_server_error(self):
+        """we retry on 5xx errors and report retries"""
+        url = TestDownloadCenter.build_server_address(self, "simplefile-flaky?fail=2&id=retry_on_server_error")
+
+        result = self.download(DownloadItem(url, retry_policy=self.retry_policy))
+
+        self.assert_file_content("simplefile", result)
+        self.assertEqual(result.retries, 2)
+        self.expect_warn_error = True
+
+    def test_give_up_after_attempts(self):
+        """we give up once we used all attempts"""
+        url = TestDownloadCenter.build_server_address(self, "simplefile-flaky?fail=3&id=give_up_after_attempts")
+
+        result = self.download(DownloadItem(url, retry_policy=self.retry_policy))
+
+        self.assertIn("503", result.error)
+        self.assertEqual(result.retries, 2)
+        self.expect_warn_error = True
+
+    def test_no_retry_on_client_error(self):
+        """we don't retry on 4xx errors"""
+        url = TestDownloadCenter.build_server_address(self, "does_not_exist")
+
+        result = self.download(DownloadItem(url, retry_policy=self.retry_policy))
+
+        self.assertIn("404", result.error)
+        self.assertEqual(result.retries, 0)
+        self.expect_warn_error = True
+
+    def test_resume_truncated_download(self):
+        """we resume truncated downloads where they stopped"""
+        filename = "biggerfile"
+        path = "/{}-truncated?id=resume_truncated_download".format(filename)
+        url = "{}{}".format(self.server.get_address(), path)
+
+        # partially received blocks are lost
+        block_size = 1024
+
+        with patch.object(DownloadCenter, "BLOCK_SIZE", block_size),\
+                patch.object(DownloadCenter, "MAX_BLOCK_SIZE", block_size):
+            result = self.download(DownloadItem(url, retry_policy=self.retry_policy))
+
+        self.assert_file_content(filename, result)
+        self.assertEqual(result.retries, 1)
+        received = getsize(join(self.server_dir, filename)) // 2 // block_size * block_size
+        self.assertEqual(RequestHandler.ranges_requested[path], [None, "bytes={}-".format(received)])
+        self.expect_warn_error = True
+
+    def test_host_failure_budget(self):
+        """we stop trying a host once it failed too many times in a row"""
+        url = TestDownloadCenter.build_server_address(self, "simplefile-flaky?fail=100&id=host_failure_budget")
+        retry_policy = RetryPolicy(attempts=DownloadCenter.HOST_FAILURE_BUDGET * 2, backoff=0)
+
+        result = self.download(DownloadItem(url, retry_policy=retry_policy))
+
+        self.assertIn("not trying it again", result.error)
+        self.assertEqual(result.retries, DownloadCenter.HOST_FAILURE_BUDGET - 1)
+        # any other download on this host fails directly
+        result = self.download(DownloadItem(TestDownloadCenter.build_server_address(self, "simplefile")))
+        self.assertIn("not trying it again", result.error)
+        self.expect_warn_error = True
+
+
+class TestDownloadCenterMirrors(LoggedTestCase):
+    """This will test downloading through mirrors defined in the configuration"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.config_patch = patch("umake.network.download_center.ConfigHandler")
+        self.config = {}
+        self.config_patch.start().return_value.config = self.config
+        self.retry_patch = patch.object(DownloadCenter, "DEFAULT_RETRY_POLICY", RetryPolicy(backoff=0))
+        self.retry_patch.start()
+
+    def tearDown(self):
+        self.retry_patch.stop()
+        self.config_patch.stop()
+        DownloadCenter._host_failures.clear()
+        super().tearDown()
+        for fd in self.fd_to_close:
+            fd.close()
+
+    def download(self, request):
+        DownloadCenter([request], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+        return self.callback.call_args[0][0][request.url]
+
+    def assert_simplefile_content(self, result):
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, "simplefile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_download_from_mirror(self):
+        """we download from the mirror instead of upstream"""
+        self.config["mirrors"] = {"http://upstream.invalid/": "{}/".format(self.server.get_address())}
+
+        result = self.download(DownloadItem("http://upstream.invalid/simplefile"))
+
+        self.assert_simplefile_content(result)
+        self.assertEqual(result.final_url, TestDownloadCenter.build_server_address(self, "simplefile"))
+
+    def test_mirrors_tried_in_order(self):
+        """we try each mirror in order, then upstream"""
+        mirrors = ["http://mirror.invalid/", "{}/".format(self.server.get_address())]
+        self.config["mirrors"] = {"http://upstream.invalid/": mirrors}
+
+        self.assert_simplefile_content(self.download(DownloadItem("http://upstream.invalid/simplefile")))
+        self.expect_warn_error = True
+
+    def test_fallback_to_upstream(self):
+        """we fallback to upstream if the mirror fails"""
+        server_prefix = "{}/".format(self.server.get_address())
+        self.config["mirrors"] = {server_prefix: server_prefix + "notthere/"}
+
+        self.assert_simplefile_content(self.download(DownloadItem(server_prefix + "simplefile")))
+        self.expect_warn_error = True
+
+    def test_fallback_to_upstream_on_wrong_checksum(self):
+        """we check the upstream checksum on mirror content, and fallback on upstream on mismatch"""
+        self.config["mirrors"] = {TestDownloadCenter.build_server_address(self, "simplefile"):
+                                  TestDownloadCenter.build_server_address(self, "biggerfile")}
+
+        result = self.download(DownloadItem(TestDownloadCenter.build_server_address(self, "simplefile"),
+                                            Checksum(ChecksumType.md5, '268a5059001855fef30b4f95f82044ed')))
+
+        self.assert_simplefile_content(result)
+        self.expect_warn_error = True
+
+    def test_checksum_url_from_upstream(self):
+        """we always download checksums given as urls from upstream, not from mirrors serving the content too"""
+        self.config["mirrors"] = {TestDownloadCenter.build_server_address(self, "simplefile"):
+                                  TestDownloadCenter.build_server_address(self, "hostile-mirror/simplefile")}
+        checksum_url = ChecksumUrl(TestDownloadCenter.build_server_address(self, "simplefile.sha256"))
+
+        result = self.download(DownloadItem(TestDownloadCenter.build_server_address(self, "simplefile"),
+                                            Checksum(ChecksumType.sha256, checksum_url)))
+
+        self.assert_simplefile_content(result)
+        self.expect_warn_error = True
+
+    def test_download_page_from_upstream(self):
+        """we always read download pages from upstream, not from mirrors serving the content too"""
+        self.config["mirrors"] = {TestDownloadCenter.build_server_address(self, "simplefile"):
+                                  TestDownloadCenter.build_server_address(self, "hostile-mirror/simplefile")}
+        url = TestDownloadCenter.build_server_address(self, "simplefile")
+
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, "simplefile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.read())
+        self.assertEqual(result.final_url, url)
+
+    def test_longest_prefix_wins(self):
+        """we use the most specific mirror prefix"""
+        self.config["mirrors"] = {"http://upstream.invalid/": "http://mirror.invalid/",
+                                  "http://upstream.invalid/foo/": "{}/".format(self.server.get_address())}
+
+        self.assert_simplefile_content(self.download(DownloadItem("http://upstream.invalid/foo/simplefile")))
+
+    def test_upstream_error_without_mirror_match(self):
+        """we don't use mirrors for urls not matching any prefix"""
+        self.config["mirrors"] = {"http://upstream.invalid/": "{}/".format(self.server.get_address())}
+        url = TestDownloadCenter.build_server_address(self, "does_not_exist")
+
+        self.assertIn("404", self.download(DownloadItem(url)).error)
+        self.expect_warn_error = True
+
+    def test_all_locations_fail(self):
+        """we report upstream error when all mirrors and upstream fail"""
+        self.config["mirrors"] = {"http://upstream.invalid/": "{}/notthere/".format(self.server.get_address())}
+
+        self.assertIsNotNone(self.download(DownloadItem("http://upstream.invalid/simplefile")).error)
+        self.expect_warn_error = True
+
+
+class TestDownloadCenterBundle(LoggedTestCase):
+    """This will test recording downloads in a bundle and serving them back from it"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.bundle_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        DownloadCenter.bundle = None
+        shutil.rmtree(self.bundle_dir)
+        super().tearDown()
+        for fd in self.fd_to_close:
+            fd.close()
+
+    def download(self, requests, **kwargs):
+        self.callback.reset_mock()
+        DownloadCenter(requests, self.callback, **kwargs)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+        return self.callback.call_args[0][0]
+
+    def record(self, url, **kwargs):
+        DownloadCenter.bundle = Bundle(self.bundle_dir, recording=True)
+        result = self.download([DownloadItem(url)], **kwargs)
+        DownloadCenter.bundle = Bundle(self.bundle_dir)
+        return result
+
+    def test_record_and_replay(self):
+        """we serve from the bundle what we recorded"""
+        filename = "simplefile"
+        url = TestDownloadCenter.build_server_address(self, filename)
+        self.record(url)
+        # bundled content is what we get now, not the server one
+        files_dir = join(self.bundle_dir, Bundle.FILES_DIRNAME)
+        bundled_file = join(files_dir, os.listdir(files_dir)[0])
+        with open(bundled_file, 'wb') as f:
+            f.write(b"bundled content")
+
+        result = self.download([DownloadItem(url)])[url]
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), b"bundled content")
+        self.assertEqual(result.final_url, url)
+
+    def test_record_and_replay_in_memory_with_redirect(self):
+        """we keep the final url of recorded in memory downloads"""
+        filename = "simplefile"
+        url = TestDownloadCenter.build_server_address(self, filename + "-redirect")
+        self.record(url, download=False)
+
+        result = self.download([DownloadItem(url)], download=False)[url]
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, TestDownloadCenter.build_server_address(self, filename))
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.read())
+
+    def test_replay_checks_checksum(self):
+        """we still check checksums when serving from the bundle"""
+        filename = "simplefile"
+        url = TestDownloadCenter.build_server_address(self, filename)
+        self.record(url)
+
+        result = self.download([DownloadItem(url, Checksum(ChecksumType.md5, '268a5059001855fef30b4f95f82044ed'))])
+        self.assertIsNone(result[url].error)
+        result = self.download([DownloadItem(url, Checksum(ChecksumType.md5, 'AAAAA'))])
+        self.assertIn("checksum", result[url].error)
+        self.expect_warn_error = True
+
+    def test_replay_missing_url(self):
+        """we error out on urls which aren't part of the bundle"""
+        filename = "simplefile"
+        self.record(TestDownloadCenter.build_server_address(self, filename))
+        url = TestDownloadCenter.build_server_address(self, "foo")
+
+        result = self.download([DownloadItem(url)])[url]
+
+        self.assertIn("isn't part of the bundle", result.error)
+        self.expect_warn_error = True
+
+    def test_failed_download_not_recorded(self):
+        """we don't record failed downloads"""
+        url = TestDownloadCenter.build_server_address(self, "does_not_exist")
+        self.record(url)
+
+        self.assertNotIn(url, DownloadCenter.bundle)
+        self.expect_warn_error = True
+
+    def test_invalid_bundle(self):
+        """we can't replay from a directory which isn't a bundle"""
+        with self.assertRaises(BaseException):
+            Bundle(self.bundle_dir)
+
+
+class TestDownloadCenterLocalFiles(LoggedTestCase):
+    """This will test downloading local files"""
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.server_dir = join(get_data_dir(), "server-content")
+
+    def tearDown(self):
+        super().tearDown()
+        for fd in self.fd_to_close:
+            fd.close()
+
+    def download(self, request, download=True):
+        DownloadCenter([request], self.callback, download=download)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+        return self.callback.call_args[0][0][request.url]
+
+    def test_download_local_file(self):
+        """we copy local files to a temporary file"""
+        path = join(self.server_dir, "biggerfile")
+        report = CopyingMock()
+        with open(path, 'rb') as f:
+            request = DownloadItem("file://" + path, Checksum(ChecksumType.md5, DownloadCenter.md5_for_fd(f)))
+        DownloadCenter([request], self.callback, report=report)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request.url]
+        self.assertIsNone(result.error)
+        self.assertNotEqual(result.fd.name, path)
+        with open(path, 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+        self.assertEqual(report.call_args, call({request.url: {"size": getsize(path), "current": getsize(path)}}))
+
+    def test_download_local_file_in_memory(self):
+        """we read local files in memory"""
+        path = join(self.server_dir, "simplefile")
+
+        result = self.download(DownloadItem("file://" + path), download=False)
+
+        self.assertIsNone(result.error)
+        with open(path, 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.read())
+
+    def test_download_missing_local_file(self):
+        """we error out on missing local files"""
+        for download in (True, False):
+            self.callback.reset_mock()
+            result = self.download(DownloadItem("file://" + join(self.server_dir, "does_not_exist")),
+                                   download=download)
+            self.assertIsNotNone(result.error)
+        self.expect_warn_error = True
+
+    def test_download_local_file_wrong_checksum(self):
+        """we still check checksums of local files"""
+        result = self.download(DownloadItem("file://" + join(self.server_dir, "simplefile"),
+                                            Checksum(ChecksumType.md5, 'AAAAA')))
+
+        self.assertIn("checksum", result.error)
+        self.expect_warn_error = True
+
+    def test_copy_fallback(self):
+        """we fallback to other copy methods if the kernel can't copy between those files"""
+        path = join(self.server_dir, "biggerfile")
+        with open(path, 'rb') as f:
+            content = f.read()
+        for methods in (["copy_file_range"], ["copy_file_range", "sendfile"]):
+            with open(path, 'rb') as src, tempfile.TemporaryFile() as dest:
+                patches = [patch("os.{}".format(method), side_effect=OSError(errno.EXDEV, "Cross-device link"),
+                                 create=True) for method in methods]
+                for method_patch in patches:
+                    method_patch.start()
+                dest.write(b"prefix")
+                try:
+                    self.assertEqual(copy_file_content(src, dest), len(content))
+                finally:
+                    for method_patch in patches:
+                        method_patch.stop()
+                dest.seek(0)
+                self.assertEqual(dest.read(), b"prefix" + content)
+
+    def test_checksum_from_position(self):
+        """we hash content from the current position, in memory or on disk"""
+        with open(join(self.server_dir, "simplefile"), 'rb') as f:
+            content = f.read()
+            f.seek(2)
+            self.assertEqual(DownloadCenter.sha256_for_fd(f), DownloadCenter.sha256_for_fd(BytesIO(content[2:])))
+            self.assertEqual(DownloadCenter.sha256_for_fd(f), DownloadCenter.sha256_for_fd(BytesIO(b"")))
+
+
 class TestDownloadCenterSecure(LoggedTestCase):
     """This will test the download center in secure mode by sending one or more download requests"""
 
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the GitHub releases module using a local server"""
+
+from os.path import join
+from threading import Event
+from time import time
+from unittest.mock import Mock, patch
+from ..tools import get_data_dir, LoggedTestCase
+from ..tools.local_server import LocalHttp, RequestHandler
+from umake.frameworks.githubrelease import GitHubRelease, GitHubReleases
+from umake.tools import Singleton
+
+
+class TestGitHubRelease(LoggedTestCase):
+    """This will test finding assets in a release"""
+
+    def setUp(self):
+        super().setUp()
+        self.release = GitHubRelease({"tag_name": "v1.0", "assets": [
+            {"browser_download_url": "https://github.com/foo/foo/releases/download/v1.0/foo-linux-x64.zip"},
+            {"browser_download_url": "https://github.com/foo/foo/releases/download/v1.0/foo-linux-x64.tar.gz"},
+            {"browser_download_url": "https://github.com/foo/foo/releases/download/v1.0/foo-linux-ia32.tar.gz"},
+            {"browser_download_url": "https://github.com/foo/foo/releases/download/v1.0/foo-win.exe"}]})
+
+    def test_tag(self):
+        """we get the release tag"""
+        self.assertEqual(self.release.tag, "v1.0")
+
+    def test_get_extension(self):
+        """we get simple and compound extensions of urls"""
+        self.assertEqual(GitHubRelease.get_extension("https://foo.com/a/foo.tar.gz"), ".tar.gz")
+        self.assertEqual(GitHubRelease.get_extension("https://foo.com/a/foo.tar.xz?raw=1"), ".tar.xz")
+        self.assertEqual(GitHubRelease.get_extension("https://foo.com/a.b/foo.zip"), ".zip")
+        self.assertEqual(GitHubRelease.get_extension("https://foo.com/a/RELEASES"), "")
+
+    def test_find_by_keyword(self):
+        """we find the last asset containing a keyword"""
+        self.assertEqual(self.release.find("linux-x64"),
+                         "https://github.com/foo/foo/releases/download/v1.0/foo-linux-x64.tar.gz")
+
+    def test_find_by_extension(self):
+        """we find assets having an extension"""
+        self.assertEqual(self.release.find(extension=".zip"),
+                         "https://github.com/foo/foo/releases/download/v1.0/foo-linux-x64.zip")
+        self.assertEqual(self.release.find("ia32", extension=".tar.gz"),
+                         "https://github.com/foo/foo/releases/download/v1.0/foo-linux-ia32.tar.gz")
+
+    def test_find_nothing(self):
+        """we return None when no asset matches"""
+        self.assertIsNone(self.release.find("mac"))
+        self.assertIsNone(self.release.find("win", extension=".zip"))
+        self.assertIsNone(self.release.find(extension=".deb"))
+
+
+class TestGitHubReleases(LoggedTestCase):
+    """This will test fetching latest releases from the local server"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = LocalHttp(join(get_data_dir(), "server-content"))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(GitHubReleases, None)
+        self.callback = Mock()
+
+    def tearDown(self):
+        Singleton._instances.pop(GitHubReleases, None)
+        super().tearDown()
+
+    def api_url(self, request_id):
+        """count requests made with this api url under request_id"""
+        return "{}/api.github.com/repos/{{}}/releases/latest-flaky?fail=0&id={}".format(
+            self.server.get_address(), request_id)
+
+    def requests_count(self, repository, request_id):
+        return RequestHandler.requests_count.get("/api.github.com/repos/{}/releases/latest-flaky?fail=0&id={}".format(
+            repository, request_id), 0)
+
+    def wait_for_callback(self, mock_function_to_be_called, call_count=1):
+        """wait for the callback to be called call_count times until a timeout"""
+        timeout = time() + 5
+        while mock_function_to_be_called.call_count < call_count:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+
+    def test_get_latest(self):
+        """we get the latest release of a repository"""
+        with patch.object(GitHubReleases, "API_URL", self.api_url("get_latest")):
+            GitHubReleases().get_latest("Jetbrains/kotlin", self.callback)
+            self.wait_for_callback(self.callback)
+
+        release, error = self.callback.call_args[0]
+        self.assertIsNone(error)
+        self.assertEqual(release.tag, "build-1.0.0")
+        self.assertEqual(release.find("kotlin-compiler-", extension=".zip"),
+                         "https://github.com/JetBrains/kotlin/releases/download/build-1.0.0/kotlin-compiler-1.0.0.zip")
+
+    def test_get_latest_once(self):
+        """we only fetch once the latest release of a repository for later calls"""
+        other_callback = Mock()
+        with patch.object(GitHubReleases, "API_URL", self.api_url("get_latest_once")):
+            GitHubReleases().get_latest("Atom/Atom", self.callback)
+            self.wait_for_callback(self.callback)
+            GitHubReleases().get_latest("Atom/Atom", other_callback)
+            self.wait_for_callback(other_callback)
+
+        self.assertIs(self.callback.call_args[0][0], other_callback.call_args[0][0])
+        self.assertEqual(self.requests_count("Atom/Atom", "get_latest_once"), 1)
+
+    def test_get_latest_concurrently_once(self):
+        """we only fetch once the latest release of a repository for concurrent calls"""
+        other_callback = Mock()
+        release = Event()
+        do_GET = RequestHandler.do_GET
+
+        def held_do_GET(handler):
+            release.wait(5)
+            do_GET(handler)
+        with patch.object(GitHubReleases, "API_URL", self.api_url("get_latest_concurrently_once")), \
+                patch.object(RequestHandler, "do_GET", held_do_GET):
+            GitHubReleases().get_latest("Atom/Atom", self.callback)
+            GitHubReleases().get_latest("Atom/Atom", other_callback)
+            release.set()
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(other_callback)
+
+        self.assertIs(self.callback.call_args[0][0], other_callback.call_args[0][0])
+        self.assertEqual(self.requests_count("Atom/Atom", "get_latest_concurrently_once"), 1)
+
+    def test_get_latest_per_repository(self):
+        """we fetch separately the latest releases of different repositories"""
+        other_callback = Mock()
+        with patch.object(GitHubReleases, "API_URL", self.api_url("get_latest_per_repository")):
+            GitHubReleases().get_latest("Atom/Atom", self.callback)
+            GitHubReleases().get_latest("Jetbrains/kotlin", other_callback)
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(other_callback)
+
+        self.assertEqual(self.callback.call_args[0][0].tag, "v1.8.0")
+        self.assertEqual(other_callback.call_args[0][0].tag, "build-1.0.0")
+
+    def test_get_latest_error_not_kept(self):
+        """we report errors fetching the latest release and retry on next call"""
+        self.expect_warn_error = True
+        with patch.object(GitHubReleases, "API_URL", self.api_url("get_latest_error_not_kept")):
+            GitHubReleases().get_latest("doesnt/exist", self.callback)
+            self.wait_for_callback(self.callback)
+            GitHubReleases().get_latest("doesnt/exist", self.callback)
+            self.wait_for_callback(self.callback, call_count=2)
+
+        release, error = self.callback.call_args[0]
+        self.assertIsNone(release)
+        self.assertIsNotNone(error)
+        self.assertEqual(self.requests_count("doesnt/exist", "get_latest_error_not_kept"), 2)
+
+    def test_get_latest_unparsable(self):
+        """we report releases we can't parse as errors"""
+        with patch.object(GitHubReleases, "API_URL", "{}/{{}}".format(self.server.get_address())):
+            GitHubReleases().get_latest("simplefile", self.callback)
+            self.wait_for_callback(self.callback)
+
+        release, error = self.callback.call_args[0]
+        self.assertIsNone(release)
+        self.assertIn("Can't parse the latest release of simplefile", error)
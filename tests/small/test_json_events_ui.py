@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the JSON events ui module"""
+
+from io import StringIO
+import json
+import logging
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+from ..tools import LoggedTestCase
+from umake.interactions import InputText, LicenseAgreement, YesNo, DisplayMessage
+from umake.tools import MainLoop, Singleton
+from umake.ui.json_events import JsonEventsUI, load_answers
+
+
+class TestJsonEventsUI(LoggedTestCase):
+    """This will test the JSON events UI"""
+
+    def setUp(self):
+        super().setUp()
+        self.stream = StringIO()
+        self.mainloop_patcher = patch("umake.ui.json_events.MainLoop")
+        self.mainloop_mock = self.mainloop_patcher.start()
+        self.mainloop_mock.return_value.quit.side_effect = MainLoop.ReturnMainLoop
+        self.tempdir = tempfile.mkdtemp()
+        self.ui = None
+
+    def tearDown(self):
+        if self.ui:
+            logging.getLogger().removeHandler(self.ui._log_handler)
+        Singleton._instances = {}
+        self.mainloop_patcher.stop()
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def create_ui(self, **kwargs):
+        self.ui = JsonEventsUI(stream=self.stream, **kwargs)
+        return self.ui
+
+    def get_events(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def return_main_screen(self, ui, status_code=0):
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            ui._return_main_screen(status_code=status_code)
+        self.mainloop_mock.return_value.quit.assert_called_with(status_code=status_code)
+
+    def test_phases_and_result(self):
+        """We report phase changes and their durations in the final result"""
+        ui = self.create_ui()
+        ui._event("phase", {"phase": "download", "framework": "foo"})
+        ui._display(DisplayMessage("Downloading"))
+        ui._event("phase", {"phase": "install", "framework": "foo"})
+        self.return_main_screen(ui)
+
+        events = self.get_events()
+        self.assertEqual([event["event"] for event in events],
+                         ["phase_start", "message", "phase_end", "phase_start", "phase_end", "result"])
+        self.assertEqual(events[0]["phase"], "download")
+        self.assertEqual(events[0]["framework"], "foo")
+        self.assertEqual(events[1]["text"], "Downloading")
+        self.assertEqual(events[2]["phase"], "download")
+        self.assertEqual(events[4]["phase"], "install")
+        self.assertEqual(set(events[5]["phases"]), {"download", "install"})
+        self.assertTrue(events[5]["success"])
+        self.assertEqual(events[5]["status_code"], 0)
+        for event in events:
+            self.assertIn("time", event)
+            self.assertIn("elapsed", event)
+
+    def test_failed_result(self):
+        """We report failures in the final result"""
+        ui = self.create_ui()
+        self.return_main_screen(ui, status_code=1)
+
+        result = self.get_events()[-1]
+        self.assertEqual(result["event"], "result")
+        self.assertFalse(result["success"])
+        self.assertEqual(result["status_code"], 1)
+
+    def test_progress_is_throttled(self):
+        """We only report progress every PROGRESS_INTERVAL, but always the last one, with rate and ETA"""
+        ui = self.create_ui()
+        with patch.object(JsonEventsUI, "PROGRESS_INTERVAL", 3600):
+            for current in (0, 100, 200, 1000):
+                ui._event("download_progress", {"current": current, "size": 1000})
+
+        events = self.get_events()
+        self.assertEqual([event["current"] for event in events], [0, 1000])
+        self.assertEqual(events[0]["kind"], "download")
+        self.assertEqual(events[1]["event"], "progress")
+        self.assertGreater(events[1]["rate"], 0)
+        self.assertEqual(events[1]["eta"], 0)
+
+    def test_requirements_progress(self):
+        """We report apt progress percentages"""
+        ui = self.create_ui()
+        with patch.object(JsonEventsUI, "PROGRESS_INTERVAL", 3600):
+            for percentage in (0, 50, 100):
+                ui._event("requirements_progress", {"step": "install", "percentage": percentage, "size": 0})
+
+        events = self.get_events()
+        self.assertEqual([event["percentage"] for event in events], [0, 100])
+        self.assertEqual(events[0]["kind"], "requirements")
+        self.assertEqual(events[0]["step"], "install")
+
+    def test_answer_from_file(self):
+        """We answer prompts matching answers file patterns"""
+        answers = {"license": "a", "prompts": {"already installed": "y", "installation path": "/foo"}}
+        ui = self.create_ui(answers=answers)
+        yes, no, license_yes, license_no, path = Mock(), Mock(), Mock(), Mock(), Mock()
+
+        ui._display(YesNo("Foo is already installed, reinstall?", yes, no))
+        ui._display(LicenseAgreement("Some license", license_yes, license_no))
+        ui._display(InputText("Choose installation path:", path, "/default"))
+
+        self.assertTrue(yes.called)
+        self.assertFalse(no.called)
+        self.assertTrue(license_yes.called)
+        self.assertFalse(license_no.called)
+        path.assert_called_once_with("/foo")
+        events = self.get_events()
+        self.assertEqual([(event["kind"], event["answer"]) for event in events],
+                         [("choice", "y"), ("license", "a"), ("input", "/foo")])
+        self.assertEqual(events[0]["choices"], ["Yes", "No"])
+
+    def test_default_answers(self):
+        """We take default answers for prompts without any matching answer"""
+        ui = self.create_ui()
+        yes, no, path = Mock(), Mock(), Mock()
+
+        ui._display(YesNo("Foo is already installed, reinstall?", yes, no))
+        ui._display(InputText("Choose installation path:", path, "/default"))
+
+        self.assertFalse(yes.called)
+        self.assertTrue(no.called)
+        path.assert_called_once_with("/default")
+        self.assertEqual([event["answer"] for event in self.get_events()], [None, None])
+
+    def test_invalid_answer(self):
+        """We fail on invalid answers instead of asking again"""
+        ui = self.create_ui(answers={"prompts": {"reinstall": "maybe"}})
+        yes, no = Mock(), Mock()
+
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            ui._display(YesNo("Foo is already installed, reinstall?", yes, no))
+
+        self.assertFalse(yes.called)
+        self.assertFalse(no.called)
+        events = self.get_events()
+        self.assertEqual([event["event"] for event in events], ["prompt", "log", "result"])
+        self.assertEqual(events[1]["level"], "error")
+        self.assertFalse(events[2]["success"])
+        self.expect_warn_error = True
+
+    def test_load_answers(self):
+        """We load answers from a yaml file"""
+        path = os.path.join(self.tempdir, "answers")
+        with open(path, "w") as f:
+            f.write("license: a\nprompts:\n  'already installed': y\n")
+
+        self.assertEqual(load_answers(path), {"license": "a", "prompts": {"already installed": "y"}})
+
+    def test_load_invalid_answers(self):
+        """We raise on invalid answers files"""
+        path = os.path.join(self.tempdir, "answers")
+        for content in ("- a list", "prompts:\n  '[invalid regexp': y\n", "prompts: [a, b]"):
+            with open(path, "w") as f:
+                f.write(content)
+            self.assertRaises(BaseException, load_answers, path)
+        self.assertRaises(BaseException, load_answers, os.path.join(self.tempdir, "doesnt_exist"))
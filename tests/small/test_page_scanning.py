@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for download pages scanning and html parsing over the local server pages"""
+
+from os.path import join
+import re
+from unittest.mock import patch
+from ..tools import get_data_dir, LoggedTestCase
+from umake import tools
+import umake.frameworks.android
+import umake.frameworks.games
+import umake.frameworks.go
+import umake.frameworks.ide
+
+
+class TestPageScanning(LoggedTestCase):
+    """This will test frameworks page scanners on the local server pages"""
+
+    # framework and category classes, page in server-content and the expected amd64 (url, checksum)
+    cases = [
+        (umake.frameworks.go.GoLang, umake.frameworks.go.GoCategory, "golang.org/dl/index.html",
+         ("https://golang.org/fake.go.linux-amd64.tar.gz",
+          "c26c1bb756f83e63d0dc850c2128367d17b99af09c7e5407e8e7de50e9716d41")),
+        (umake.frameworks.android.AndroidStudio, umake.frameworks.android.AndroidCategory,
+         "developer.android.com/studio/index.html",
+         ("https://dl.google.com/dl/android/studio/ide-zips/fake/android-studio-ide-fake-linux.zip",
+          "48685a6824453275ac7e4bac8c9efa173c3ac8eb79cf7455a290286544bc074c")),
+        (umake.frameworks.android.AndroidNDK, umake.frameworks.android.AndroidCategory,
+         "developer.android.com/ndk/downloads/index.html",
+         ("http://dl.google.com/android/repository/android-ndk-fake-linux-x86_64.zip",
+          "f3ba966ba157abc7dd2f21778afda0e4a049dcbf")),
+        (umake.frameworks.games.Stencyl, umake.frameworks.games.GamesCategory, "www.stencyl.com/download/index.html",
+         ("http://www.stencyl.com/lin", None)),
+        (umake.frameworks.ide.SublimeText, umake.frameworks.ide.IdeCategory, "sublimetext.com/3/index.html",
+         ("https://download.sublimetext.com/sublime_text_3_build_mock_x64.tar.bz2", None)),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.pages = []
+        # expected results are for amd64
+        with patch("umake.frameworks.get_current_arch", return_value="amd64"), \
+                patch("umake.frameworks.go.get_current_arch", return_value="amd64"), \
+                patch("umake.frameworks.games.get_current_arch", return_value="amd64"), \
+                patch("umake.frameworks.ide.get_current_arch", return_value="amd64"):
+            for framework_class, category_class, path, expected in self.cases:
+                # don't register those categories globally
+                with patch.dict(category_class.categories, clear=True):
+                    framework = framework_class(category_class())
+                with open(join(get_data_dir(), "server-content", path), 'rb') as f:
+                    self.pages.append((framework, f.read().decode(), expected))
+
+    def test_scanners_find_download_links(self):
+        """Page scanners find the download links and checksums of the pages"""
+        for framework, content, expected in self.pages:
+            result = framework.page_scanner.scan(content, need_checksum=bool(framework.checksum_type))
+            self.assertEqual((result.url, result.checksum), expected)
+
+    def test_scanners_find_licenses(self):
+        """Page scanners find licenses when frameworks expect one"""
+        for framework, content, expected in self.pages:
+            if framework.expect_license:
+                result = framework.page_scanner.scan(content, need_license=True)
+                self.assertIn("Terms and Conditions", result.license)
+
+
+class TestHtmlParsing(LoggedTestCase):
+    """This will compare parsing only the needed elements of html pages with building their whole tree"""
+
+    # page in server-content and the element we look for in it, as name, attributes and string: (page, element)
+    cases = [
+        ("www.arduino.cc/en/Main/Software", ('a', {"href": re.compile(r'arduino-[\d\.\-r]+-linux64.tar.xz$')}, None)),
+        ("www.arduino.cc/en/Main/Software", ('a', {}, re.compile('Checksums'))),
+        ("www.arduino.cc/download_handler_arduino-1.6.5-linux64.tar.xz", ('button', {}, re.compile('JUST DOWNLOAD'))),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.pages = []
+        for path, element in self.cases:
+            with open(join(get_data_dir(), "server-content", path), 'rb') as f:
+                self.pages.append((f.read(), element))
+
+    @staticmethod
+    def find_in_whole_tree(content, element):
+        from bs4 import BeautifulSoup
+        name, attrs, string = element
+        return BeautifulSoup(content, 'html.parser').find(name, attrs, string=string)
+
+    @staticmethod
+    def find_in_links(content, element):
+        name, attrs, string = element
+        return tools.parse_html(content, 'a').find(name, attrs, string=string)
+
+    def test_parsing_links_finds_elements(self):
+        """Parsing only links finds the same elements and parents than the whole tree"""
+        for content, element in self.pages:
+            found = self.find_in_links(content, element)
+            self.assertIsNotNone(found)
+            self.assertEqual(str(found), str(self.find_in_whole_tree(content, element)))
+            if found.name == 'button':
+                self.assertEqual(found.parent['href'], self.find_in_whole_tree(content, element).parent['href'])
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the rate limiter module"""
+
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake.network.rate_limiter import RateLimiter, parse_rate
+from umake.tools import Singleton
+
+
+class TestParseRate(LoggedTestCase):
+    """This will test parsing rates"""
+
+    def test_parse_bytes(self):
+        """we parse raw bytes per second"""
+        self.assertEqual(parse_rate("1000"), 1000)
+        self.assertEqual(parse_rate(1000), 1000)
+
+    def test_parse_units(self):
+        """we parse rates with units"""
+        self.assertEqual(parse_rate("500K"), 500 * 1024)
+        self.assertEqual(parse_rate("1.5M"), int(1.5 * 1024 * 1024))
+        self.assertEqual(parse_rate("2MB"), 2 * 1024 * 1024)
+        self.assertEqual(parse_rate("1GiB/s"), 1024 ** 3)
+        self.assertEqual(parse_rate("3k"), 3 * 1024)
+
+    def test_parse_invalid(self):
+        """we raise on invalid rates"""
+        with self.assertRaises(ValueError):
+            parse_rate("fast")
+
+
+class TestRateLimiter(LoggedTestCase):
+    """This will test sharing bandwidth between streams"""
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(RateLimiter, None)
+        self.config = {}
+        self.config_patch = patch("umake.network.rate_limiter.ConfigHandler")
+        self.config_patch.start().return_value.config = self.config
+        self.time = 0
+        self.monotonic_patch = patch("umake.network.rate_limiter.monotonic", side_effect=lambda: self.time)
+        self.monotonic_patch.start()
+        self.sleep_patch = patch("umake.network.rate_limiter.sleep", side_effect=self.sleep)
+        self.sleep_mock = self.sleep_patch.start()
+
+    def tearDown(self):
+        Singleton._instances.pop(RateLimiter, None)
+        self.sleep_patch.stop()
+        self.monotonic_patch.stop()
+        self.config_patch.stop()
+        super().tearDown()
+
+    def sleep(self, duration):
+        self.time += duration
+
+    def test_unlimited(self):
+        """we never wait without any limit"""
+        with RateLimiter().stream("foo.com") as stream:
+            stream.consume(10 ** 9)
+        self.assertFalse(self.sleep_mock.called)
+
+    def test_global_limit(self):
+        """we pace a single stream to the global limit"""
+        self.config["max_rate"] = "1K"
+        with RateLimiter().stream("foo.com") as stream:
+            for i in range(4):
+                stream.consume(512)
+        self.assertEqual(self.time, 2)
+
+    def test_no_credit_when_network_slow(self):
+        """we don't wait if the network was already slower than the limit"""
+        self.config["max_rate"] = 1000
+        with RateLimiter().stream("foo.com") as stream:
+            self.time += 5
+            stream.consume(1000)
+            self.assertFalse(self.sleep_mock.called)
+            stream.consume(1000)
+            self.sleep_mock.assert_called_once_with(1)
+
+    def test_weighted_shares(self):
+        """streams share the global limit proportionally to their weight"""
+        self.config["max_rate"] = 900
+        limiter = RateLimiter()
+        with limiter.stream("foo.com") as artifact, limiter.stream("bar.com", weight=2) as metadata:
+            self.assertEqual(limiter.get_share(artifact), 300)
+            self.assertEqual(limiter.get_share(metadata), 600)
+        with limiter.stream("foo.com") as artifact:
+            self.assertEqual(limiter.get_share(artifact), 900)
+
+    def test_host_limit(self):
+        """streams on a host share its limit, others aren't limited"""
+        self.config["max_rate_per_host"] = {"foo.com": "1K"}
+        limiter = RateLimiter()
+        with limiter.stream("foo.com") as first, limiter.stream("foo.com") as second, \
+                limiter.stream("bar.com") as other:
+            self.assertEqual(limiter.get_share(first), 512)
+            self.assertEqual(limiter.get_share(second), 512)
+            self.assertIsNone(limiter.get_share(other))
+
+    def test_global_and_host_limits(self):
+        """the most restrictive of global and host limits applies"""
+        self.config["max_rate"] = 1000
+        self.config["max_rate_per_host"] = {"foo.com": 100}
+        limiter = RateLimiter()
+        with limiter.stream("foo.com") as limited, limiter.stream("bar.com") as other:
+            self.assertEqual(limiter.get_share(limited), 100)
+            self.assertEqual(limiter.get_share(other), 500)
+
+    def test_reservation(self):
+        """a reservation gets its share of the global limit, and streams share the rest"""
+        self.config["max_rate"] = 900
+        limiter = RateLimiter()
+        with limiter.stream("foo.com") as first, limiter.stream("bar.com") as second:
+            with limiter.reserve() as reserved_rate:
+                self.assertEqual(reserved_rate, 300)
+                self.assertEqual(limiter.get_share(first), 300)
+                with limiter.stream("baz.com") as third:
+                    self.assertEqual(limiter.get_share(third), 200)
+            self.assertEqual(limiter.get_share(first), 450)
+        with limiter.stream("foo.com") as first:
+            self.assertEqual(limiter.get_share(first), 900)
+
+    def test_reservation_unlimited(self):
+        """nothing is reserved without a global limit"""
+        self.config["max_rate_per_host"] = {"foo.com": "1K"}
+        limiter = RateLimiter()
+        with limiter.reserve() as reserved_rate, limiter.stream("foo.com") as stream:
+            self.assertIsNone(reserved_rate)
+            self.assertEqual(limiter.get_share(stream), 1024)
+
+    def test_invalid_configuration(self):
+        """an invalid configuration is ignored"""
+        self.config["max_rate"] = "fast"
+        self.assertFalse(RateLimiter().enabled)
+        self.expect_warn_error = True
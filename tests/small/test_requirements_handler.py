@@ -22,11 +22,13 @@
 import os
 import shutil
 import subprocess
+import sys
+from threading import Timer
 from time import time
 from unittest.mock import Mock, call, patch
 import umake
 from . import DpkgAptSetup
-from umake.network.requirements_handler import RequirementsHandler
+from umake.network.requirements_handler import RequirementsHandler, get_lock_holder
 from umake import tools
 
 
@@ -409,6 +411,97 @@ class TestRequirementsHandler(DpkgAptSetup):
             self.wait_for_callback(self.done_callback)
             self.assertEqual(openaptcache_mock.call_count, 2)
 
+    def hold_lock(self, path):
+        """Hold a fcntl lock on path from another process until the returned process stdin is closed"""
+        process = subprocess.Popen([sys.executable, "-c", "import fcntl, sys; f = open(sys.argv[1], 'w'); "
+                                    "fcntl.lockf(f, fcntl.LOCK_EX); print('locked', flush=True); sys.stdin.read()",
+                                    path], stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(process.stdout.readline(), "locked\n")
+        self.addCleanup(process.wait)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.stdin.close)
+        return process
+
+    def test_get_lock_holder(self):
+        """We get the pid of the process holding a lock, if any"""
+        lock_path = os.path.join(self.dpkg_dir, "lock-frontend")
+        self.assertIsNone(get_lock_holder(lock_path))
+        open(lock_path, 'w').close()
+        self.assertIsNone(get_lock_holder(lock_path))
+
+        process = self.hold_lock(lock_path)
+        self.assertEqual(get_lock_holder(lock_path), process.pid)
+
+        process.stdin.close()
+        process.wait()
+        self.assertIsNone(get_lock_holder(lock_path))
+
+    def test_get_lock_holder_unreadable(self):
+        """We can't tell if a lock is held when we can't open its file"""
+        lock_path = os.path.join(self.dpkg_dir, "lock-frontend")
+        open(lock_path, 'w').close()
+
+        with patch("umake.network.requirements_handler.os.open", side_effect=PermissionError):
+            self.assertRaises(PermissionError, get_lock_holder, lock_path)
+
+    def test_apt_cache_wait_for_lock(self):
+        """When apt is locked, we wait for the lock to be released and only then load the cache again"""
+        origin_open = self.handler.cache.open
+        process = self.hold_lock(os.path.join(self.dpkg_dir, "lock-frontend"))
+        Timer(0.5, process.stdin.close).start()
+        progress_callback = Mock()
+
+        def cache_call(*args, **kwargs):
+            if get_lock_holder(os.path.join(self.dpkg_dir, "lock-frontend")):
+                raise SystemError
+            return origin_open()
+
+        with patch.object(self.handler.cache, 'open', side_effect=cache_call) as openaptcache_mock, \
+                patch.object(self.handler, 'LOCK_POLL_INTERVAL', 0.05), \
+                patch.object(self.handler, '_progress_callback', progress_callback):
+            self.handler._force_reload_apt_cache()
+
+        self.assertEqual(openaptcache_mock.call_count, 2)
+        # lock files are only readable by root
+        self.assertIn(call(0), os.seteuid.call_args_list)
+        self.assertTrue(progress_callback.called)
+        status = progress_callback.call_args[0][0]
+        self.assertEqual(status["step"], RequirementsHandler.STATUS_WAITING_LOCK)
+        self.assertEqual(status["holder"], process.pid)
+        self.assertTrue(0 < status["percentage"] < 100)
+
+    def test_apt_cache_unreadable_locks(self):
+        """We back off loading the cache when we can't check apt locks"""
+        origin_open = self.handler.cache.open
+        failures = 2
+
+        def cache_call(*args, **kwargs):
+            nonlocal failures
+            if failures:
+                failures -= 1
+                raise SystemError
+            return origin_open()
+
+        with patch.object(self.handler.cache, 'open', side_effect=cache_call) as openaptcache_mock, \
+                patch("umake.network.requirements_handler.get_lock_holder", side_effect=PermissionError), \
+                patch("umake.network.requirements_handler.time.sleep") as sleep_mock:
+            self.handler._force_reload_apt_cache()
+
+        self.assertEqual(openaptcache_mock.call_count, 3)
+        self.assertEqual(sleep_mock.call_args_list, [call(1), call(2)])
+
+    def test_apt_cache_wait_for_lock_timeout(self):
+        """We give up loading the cache once apt is locked for longer than the timeout"""
+        process = self.hold_lock(os.path.join(self.dpkg_dir, "lock"))
+
+        with patch.object(self.handler.cache, 'open', side_effect=SystemError) as openaptcache_mock, \
+                patch.object(self.handler, 'LOCK_POLL_INTERVAL', 0.05), \
+                patch.object(self.handler, 'apt_lock_timeout', 0.3):
+            with self.assertRaisesRegex(BaseException, "locked by process {}".format(process.pid)):
+                self.handler._force_reload_apt_cache()
+
+        self.assertEqual(openaptcache_mock.call_count, 1)
+
     def test_upgrade(self):
         """Upgrade one package already installed"""
         shutil.copy(os.path.join(self.apt_status_dir, "testpackage_installed_dpkg_status"),
@@ -22,6 +22,7 @@
 import os
 import shutil
 import tempfile
+from time import time
 from ..tools import get_data_dir, LoggedTestCase
 from unittest.mock import patch
 
@@ -34,6 +35,7 @@ class TestVersionHandler(LoggedTestCase):
     def setUp(self):
         super().setUp()
         self.from_dev_opt = settings.from_dev
+        settings._get_version.cache_clear()
         self.version_dir = tempfile.mkdtemp()
         self.initial_env = os.environ.copy()
         self.initial_os_path_join = os.path.join
@@ -45,6 +47,7 @@ class TestVersionHandler(LoggedTestCase):
         # remove caching
         shutil.rmtree(self.version_dir)
         settings.from_dev = self.from_dev_opt
+        settings._get_version.cache_clear()
         # restore original environment. Do not use the dict copy which erases the object and doesn't have the magical
         # _Environ which setenv() for subprocess
         os.environ.clear()
@@ -73,6 +76,16 @@ class TestVersionHandler(LoggedTestCase):
         path_join_result.side_effect = self.return_fake_version_path
         self.assertEquals(settings.get_version(), "42.03-25-g1fd9507")
 
+    @patch("os.path.join")
+    @patch("subprocess.check_output", return_value=b"42.03-25-g1fd9507")
+    def test_version_resolved_once(self, check_output, path_join_result):
+        """Ensure we only resolve the version once"""
+        settings.from_dev = True
+        path_join_result.side_effect = self.return_fake_version_path
+        self.assertEqual(settings.get_version(), "42.03-25-g1fd9507")
+        self.assertEqual(settings.get_version(), "42.03-25-g1fd9507")
+        self.assertEqual(check_output.call_count, 1)
+
     @patch("os.path.join")
     def test_version_snap(self, path_join_result):
         """Ensure we are returning the right version for a snap"""
@@ -97,3 +110,79 @@ class TestVersionHandler(LoggedTestCase):
         path_join_result.side_effect = self.return_fake_version_path
         os.environ["PATH"] = ""
         self.assertEquals(settings.get_version(), "42.02+unknown")
+
+
+class TestLatestVersionCache(LoggedTestCase):
+    """This will test the latest version cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.cache_dir, "umake", "latest-version")
+        for patcher in (patch.object(settings, "LATEST_VERSION_CACHE_PATH", self.cache_path),
+                        patch.object(settings, "get_latest_version", return_value="42.04"),
+                        patch("gi.repository.Gio.NetworkMonitor.get_default")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        from gi.repository import Gio
+        Gio.NetworkMonitor.get_default.return_value.get_network_available.return_value = True
+        self.network_available = Gio.NetworkMonitor.get_default.return_value.get_network_available
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def write_cache(self, version, checked):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, "w") as f:
+            f.write('{{"version": "{}", "checked": {}}}'.format(version, checked))
+
+    def test_no_cache(self):
+        """We don't know the latest version without any cache"""
+        self.assertIsNone(settings.get_cached_latest_version())
+
+    def test_invalid_cache(self):
+        """We ignore invalid cache content"""
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, "w") as f:
+            f.write("garbage")
+        self.assertIsNone(settings.get_cached_latest_version())
+
+    def test_refresh(self):
+        """We check and cache latest version in the background"""
+        settings.refresh_latest_version_cache().join()
+
+        self.assertEqual(settings.get_cached_latest_version(), "42.04")
+        self.assertTrue(settings.get_latest_version.called)
+
+    def test_no_refresh_if_recent(self):
+        """We don't check latest version again before the cache expires"""
+        self.write_cache("42.03", time())
+
+        self.assertIsNone(settings.refresh_latest_version_cache())
+        self.assertEqual(settings.get_cached_latest_version(), "42.03")
+        self.assertFalse(settings.get_latest_version.called)
+
+    def test_refresh_if_expired(self):
+        """We check latest version again once the cache expired"""
+        self.write_cache("42.03", time() - settings.LATEST_VERSION_TTL - 1)
+
+        settings.refresh_latest_version_cache().join()
+
+        self.assertEqual(settings.get_cached_latest_version(), "42.04")
+
+    def test_no_refresh_offline(self):
+        """We don't try to check latest version when offline"""
+        self.network_available.return_value = False
+
+        self.assertIsNone(settings.refresh_latest_version_cache())
+        self.assertFalse(settings.get_latest_version.called)
+
+    def test_refresh_failure_keeps_cache(self):
+        """We keep previous cached version if we can't check latest version"""
+        self.write_cache("42.03", 0)
+        settings.get_latest_version.side_effect = BaseException("Network down")
+
+        settings.refresh_latest_version_cache().join()
+
+        self.assertEqual(settings.get_cached_latest_version(), "42.03")
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests the modules umake imports on startup"""
+
+import os
+import subprocess
+import sys
+from ..tools import get_root_dir, LoggedTestCase
+
+
+class TestStartupImports(LoggedTestCase):
+    """This will check the modules imported on startup"""
+
+    # modules slow to import which are only needed to install frameworks
+    HEAVY_MODULES = ("apt", "apt_pkg", "bs4", "gnupg", "progressbar", "requests", "urllib3", "yaml")
+
+    def get_imported_modules(self, code):
+        """Return the set of modules imported by running code in a new python interpreter"""
+        process = subprocess.run([sys.executable, "-c", "import sys\n{}\nprint('\\n'.join(sys.modules))".format(code)],
+                                 cwd=get_root_dir(), stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        return set(process.stdout.splitlines())
+
+    def get_version_imported_modules(self):
+        """Return the set of modules imported by umake --version, as listed by python -X importtime"""
+        env = os.environ.copy()
+        env.pop("PYTHONPROFILEIMPORTTIME", None)
+        process = subprocess.run([sys.executable, "-X", "importtime", os.path.join(get_root_dir(), "bin", "umake"),
+                                  "--version"], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, check=True)
+        return {line.split("|")[2].strip() for line in process.stderr.splitlines()
+                if line.startswith("import time:") and "cumulative" not in line}
+
+    def test_import_doesnt_import_heavy_modules(self):
+        """import umake doesn't load frameworks nor their dependencies"""
+        modules = self.get_imported_modules("import umake")
+
+        self.assertIn("umake", modules)
+        for module in self.HEAVY_MODULES + ("umake.frameworks",):
+            self.assertNotIn(module, modules)
+
+    def test_version_doesnt_import_heavy_modules(self):
+        """umake --version doesn't load frameworks nor their dependencies"""
+        modules = self.get_version_imported_modules()
+
+        self.assertIn("umake", modules)
+        for module in self.HEAVY_MODULES + ("umake.frameworks",):
+            self.assertNotIn(module, modules)
+
+    def test_download_center_doesnt_import_requests(self):
+        """requests is only imported once something is downloaded"""
+        modules = self.get_imported_modules("import umake.network.download_center")
+
+        self.assertIn("umake.network.download_center", modules)
+        self.assertNotIn("requests", modules)
+        self.assertNotIn("urllib3", modules)
@@ -21,8 +21,12 @@
 
 from concurrent import futures
 from contextlib import contextmanager, suppress
+import errno
+import fcntl
+import json
 from gi.repository import GLib
 import os
+import re
 import shutil
 import subprocess
 import stat
@@ -36,7 +40,7 @@ from ..tools import change_xdg_path, get_data_dir, LoggedTestCase, INSTALL_DIR
 from umake import settings, tools
 from umake.tools import ConfigHandler, Singleton, get_current_arch, get_foreign_archs, get_current_ubuntu_version,\
     create_launcher, launcher_exists_and_is_pinned, launcher_exists, get_icon_path, get_launcher_path, copy_icon,\
-    add_exec_link
+    add_exec_link, LauncherFavorites
 from unittest.mock import patch, Mock
 
 
@@ -111,6 +115,95 @@ class TestConfigHandler(LoggedTestCase):
         with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME)) as f:
             self.assertEqual(f.read(), 'foo: bar\n')
 
+    def test_transaction_saves_once(self):
+        """Changes made in a transaction, even nested, are saved once at the end"""
+        with patch.object(ConfigHandler, "_save", wraps=ConfigHandler()._save) as save:
+            with ConfigHandler().transaction() as config:
+                config["foo"] = "bar"
+                with ConfigHandler().transaction() as nested_config:
+                    nested_config["baz"] = "qux"
+                self.assertFalse(save.called)
+
+        self.assertEqual(save.call_count, 1)
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME)) as f:
+            self.assertEqual(f.read(), 'baz: qux\nfoo: bar\n')
+
+    def test_failed_transaction_doesnt_save(self):
+        """Changes made in a transaction raising an exception are dropped"""
+        ConfigHandler().config = {'foo': 'bar'}
+        with suppress(BaseException):
+            with ConfigHandler().transaction() as config:
+                config["foo"] = "baz"
+                raise BaseException("Something bad happened")
+
+        self.assertEqual(ConfigHandler().config, {'foo': 'bar'})
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME)) as f:
+            self.assertEqual(f.read(), 'foo: bar\n')
+
+    def test_save_replaces_file(self):
+        """We replace the config file atomically, without leftovers"""
+        config_path = os.path.join(self.config_dir, settings.CONFIG_FILENAME)
+        shutil.copy(os.path.join(self.config_dir_for_name('valid'), settings.CONFIG_FILENAME), self.config_dir)
+        previous_inode = os.stat(config_path).st_ino
+
+        ConfigHandler().config = {'foo': 'bar'}
+
+        self.assertNotEqual(os.stat(config_path).st_ino, previous_inode)
+        self.assertEqual(sorted(os.listdir(self.config_dir)),
+                         sorted([settings.CONFIG_FILENAME, settings.CONFIG_FILENAME + ".lock"]))
+
+    def test_save_keeps_symlinked_config(self):
+        """We replace the target of a symlinked config file, keeping the symlink"""
+        config_path = os.path.join(self.config_dir, settings.CONFIG_FILENAME)
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        target = os.path.join(target_dir, "umake-config")
+        shutil.copy(os.path.join(self.config_dir_for_name('valid'), settings.CONFIG_FILENAME), target)
+        os.symlink(target, config_path)
+
+        ConfigHandler().config = {'foo': 'bar'}
+
+        self.assertEqual(os.readlink(config_path), target)
+        with open(target) as f:
+            self.assertEqual(f.read(), 'foo: bar\n')
+        self.assertEqual(os.listdir(target_dir), ["umake-config"])
+
+    def test_reload_config_changed_by_other_process(self):
+        """We reload the config file when another process changed it"""
+        ConfigHandler().config = {'foo': 'bar'}
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME), 'w') as f:
+            f.write('foo: baz\nother: content\n')
+
+        self.assertEqual(ConfigHandler().config, {'foo': 'baz', 'other': 'content'})
+
+    def test_transaction_merges_config_changed_by_other_process(self):
+        """A transaction starts from the config saved by another process"""
+        ConfigHandler().config = {'foo': 'bar'}
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME), 'w') as f:
+            f.write('foo: baz\n')
+
+        with ConfigHandler().transaction() as config:
+            config["other"] = "content"
+
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME)) as f:
+            self.assertEqual(f.read(), 'foo: baz\nother: content\n')
+
+    def test_transaction_locks_other_processes(self):
+        """A transaction holds a lock on the config against other processes"""
+        with ConfigHandler().transaction():
+            with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME + ".lock")) as f:
+                with self.assertRaises(BlockingIOError):
+                    # flock locks are per open file description: this behaves like another process
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_load_config_with_python_objects_fails(self):
+        """We refuse to load arbitrary python objects from the config file"""
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME), 'w') as f:
+            f.write('foo: !!python/object/apply:os.getcwd []\n')
+
+        self.assertEqual(ConfigHandler().config, {})
+        self.expect_warn_error = True
+
     def test_dont_create_file_without_assignment(self):
         """We don't create any file without an assignment"""
         ConfigHandler()
@@ -414,6 +507,112 @@ class TestToolsThreads(LoggedTestCase):
         mocksys.exit.assert_called_once_with(1)
         self.expect_warn_error = True
 
+    @patch("umake.tools.sys")
+    def test_dispatch_in_order_in_one_batch(self, mocksys):
+        """Decorated calls are run in posting order, many of them per main loop iteration"""
+        calls = []
+
+        @tools.MainLoop.in_mainloop_thread
+        def _function_in_mainloop_thread(value):
+            calls.append(value)
+
+        @tools.MainLoop.in_mainloop_thread
+        def _return_to_mainloop():
+            self.mainloop_object.quit()
+
+        with patch.object(tools.MainLoop, "dispatch_queue", tools.DispatchQueue()) as dispatch_queue,\
+                patch("umake.tools.GLib.idle_add", wraps=GLib.idle_add) as idle_add_mock:
+            for i in range(100):
+                _function_in_mainloop_thread(i)
+            _return_to_mainloop()
+            self.assertEqual(dispatch_queue.get_stats().depth, 101)
+            self.assertEqual(idle_add_mock.call_count, 1)
+            self.start_glib_mainloop()
+            self.wait_for_mainloop_shutdown()
+
+            self.assertEqual(calls, list(range(100)))
+            stats = dispatch_queue.get_stats()
+            self.assertEqual(stats.depth, 0)
+            self.assertEqual(stats.max_depth, 101)
+            self.assertEqual(stats.dispatched, 101)
+            self.assertGreater(stats.max_latency, 0)
+        mocksys.exit.assert_called_once_with(0)
+
+    @patch("umake.tools.sys")
+    def test_coalesce_dispatch(self, mocksys):
+        """Pending coalesced calls are replaced by newer ones with the same key, keeping their order"""
+        calls = []
+
+        @tools.MainLoop.coalesced_in_mainloop_thread(lambda side, value: side)
+        def _progress(side, value):
+            calls.append((side, value))
+
+        @tools.MainLoop.in_mainloop_thread
+        def _function_in_mainloop_thread(value):
+            calls.append(value)
+            self.mainloop_object.quit()
+
+        with patch.object(tools.MainLoop, "dispatch_queue", tools.DispatchQueue()) as dispatch_queue:
+            for i in range(10):
+                _progress("download", i)
+                _progress("requirement", i * 2)
+            _function_in_mainloop_thread("done")
+            self.start_glib_mainloop()
+            self.wait_for_mainloop_shutdown()
+
+            self.assertEqual(calls, [("download", 9), ("requirement", 18), "done"])
+            self.assertEqual(dispatch_queue.get_stats().coalesced, 18)
+
+    @patch("umake.tools.sys")
+    def test_dispatch_backpressure(self, mocksys):
+        """Threads posting calls wait for the main loop to drain a full queue"""
+        calls = []
+
+        @tools.MainLoop.in_mainloop_thread
+        def _function_in_mainloop_thread(value):
+            calls.append(value)
+            if value == 9:
+                self.mainloop_object.quit()
+
+        def _post_all():
+            self.wait_for_mainloop_function()
+            for i in range(10):
+                _function_in_mainloop_thread(i)
+
+        with patch.object(tools.MainLoop, "dispatch_queue", tools.DispatchQueue()) as dispatch_queue,\
+                patch.object(tools.DispatchQueue, "MAX_PENDING", 2):
+            executor = futures.ThreadPoolExecutor(max_workers=1)
+            executor.submit(_post_all)
+            self.start_glib_mainloop()
+            self.wait_for_mainloop_shutdown()
+
+            self.assertEqual(calls, list(range(10)))
+            self.assertLessEqual(dispatch_queue.get_stats().max_depth, 2)
+
+    @patch("umake.tools.sys")
+    def test_dispatch_continues_after_return_mainloop(self, mocksys):
+        """ReturnMainLoop is swallowed and next calls of the batch still run"""
+        calls = []
+
+        @tools.MainLoop.in_mainloop_thread
+        def _returning_function():
+            calls.append("return")
+            raise tools.MainLoop.ReturnMainLoop()
+
+        @tools.MainLoop.in_mainloop_thread
+        def _function_in_mainloop_thread():
+            calls.append("next")
+            self.mainloop_object.quit()
+
+        with patch.object(tools.MainLoop, "dispatch_queue", tools.DispatchQueue()):
+            _returning_function()
+            _function_in_mainloop_thread()
+            self.start_glib_mainloop()
+            self.wait_for_mainloop_shutdown()
+
+        self.assertEqual(calls, ["return", "next"])
+        mocksys.exit.assert_called_once_with(0)
+
 
 class TestLauncherIcons(LoggedTestCase):
     """Test module for launcher icons handling"""
@@ -431,8 +630,11 @@ class TestLauncherIcons(LoggedTestCase):
         change_xdg_path('XDG_DATA_HOME', self.local_dir)
         self.current_desktop = os.environ.get("XDG_CURRENT_DESKTOP")
         os.environ["XDG_CURRENT_DESKTOP"] = "Unity"
+        # launcher favorites cache available schemas
+        Singleton._instances.pop(LauncherFavorites, None)
 
     def tearDown(self):
+        Singleton._instances.pop(LauncherFavorites, None)
         change_xdg_path('XDG_DATA_HOME', remove=True)
         shutil.rmtree(self.local_dir)
         if self.current_desktop:
@@ -476,6 +678,37 @@ class TestLauncherIcons(LoggedTestCase):
         self.assertTrue(os.path.exists(get_launcher_path("foo.desktop")))
         self.assertEqual(open(get_launcher_path("foo.desktop")).read(), self.get_generic_desktop_content())
 
+    @patch("umake.tools.Gio.Settings")
+    def test_install_syncs_settings(self, SettingsMock):
+        """Installing a launcher icon waits for the settings to be written instead of sleeping"""
+        SettingsMock.list_schemas.return_value = ["foo", "bar", "com.canonical.Unity.Launcher", "baz"]
+        SettingsMock.return_value.get_strv.return_value = ["application://bar.desktop", "unity://running-apps"]
+        with patch("time.sleep") as sleep_mock:
+            create_launcher("foo.desktop", self.get_generic_desktop_content())
+
+        self.assertTrue(SettingsMock.sync.called)
+        self.assertFalse(sleep_mock.called)
+
+    @patch("umake.tools.Gio.Settings")
+    def test_install_multiple_in_batch(self, SettingsMock):
+        """Launchers created in a batch are pinned with a single favorites update, checking schemas once"""
+        SettingsMock.list_schemas.return_value = ["foo", "bar", "com.canonical.Unity.Launcher", "baz"]
+        SettingsMock.return_value.get_strv.side_effect = lambda key: ["application://bar.desktop",
+                                                                      "unity://running-apps"]
+        with LauncherFavorites().batch():
+            create_launcher("foo.desktop", self.get_generic_desktop_content())
+            create_launcher("baz.desktop", self.get_generic_desktop_content())
+            self.assertFalse(SettingsMock.return_value.set_strv.called)
+            self.write_desktop_file("foo.desktop")
+            self.assertTrue(launcher_exists_and_is_pinned("foo.desktop"))
+
+        SettingsMock.return_value.set_strv.assert_called_once_with("favorites", ["application://bar.desktop",
+                                                                                 "application://foo.desktop",
+                                                                                 "application://baz.desktop",
+                                                                                 "unity://running-apps"])
+        self.assertEqual(SettingsMock.list_schemas.call_count, 1)
+        self.assertEqual(SettingsMock.sync.call_count, 1)
+
     @patch("umake.tools.Gio.Settings")
     def test_can_update_launcher(self, SettingsMock):
         """Update a launcher file"""
@@ -656,12 +889,18 @@ class TestLauncherIcons(LoggedTestCase):
         """Get correct launcher path"""
         self.assertEqual(get_launcher_path("foo.desktop"), os.path.join(self.local_dir, "applications", "foo.desktop"))
 
-    @patch("umake.tools.settings")
-    def test_create_exec_path(self, settings_module):
+    def test_create_exec_path(self):
         """Create link to the executable"""
-        settings_module.DEFAULT_BINARY_LINK_PATH = os.path.join(self.local_dir, ".local", "share", "umake", "bin")
-        add_exec_link(os.path.join(self.server_dir, "simplefile"), "foo")
-        self.assertTrue(os.path.exists(os.path.join(settings_module.DEFAULT_BINARY_LINK_PATH, "foo")))
+        bin_folder = os.path.join(self.local_dir, ".local", "share", "umake", "bin")
+        with patch("umake.tools.settings.DEFAULT_BINARY_LINK_PATH", bin_folder), \
+                patch("umake.tools.settings.PROFILE_LOCK_PATH", os.path.join(self.local_dir, ".profile-lock")), \
+                patch("umake.tools.os.path.expanduser") as expanderusermock, \
+                patch.dict(os.environ, {"SHELL": "/bin/bash"}):
+            expanderusermock.return_value = self.local_dir
+            add_exec_link(os.path.join(self.server_dir, "simplefile"), "foo")
+        self.assertTrue(os.path.exists(os.path.join(bin_folder, "foo")))
+        with open(os.path.join(self.local_dir, ".profile")) as f:
+            self.assertIn(bin_folder, f.read())
 
 
 class TestMiscTools(LoggedTestCase):
@@ -818,6 +1057,18 @@ class TestMiscTools(LoggedTestCase):
         self.assertTrue(exception_raised, "Permission Error was raised")
         self.assertTrue(switch_to_current_usermock.called, "switch back to user when exiting context")
 
+    @patch("umake.tools.os")
+    @patch("umake.tools.switch_to_current_user")
+    def test_as_root_nested(self, switch_to_current_usermock, osmock):
+        """Nested as_root only switch to root and back to user once"""
+        with tools.as_root():
+            with tools.as_root():
+                pass
+            self.assertFalse(switch_to_current_usermock.called, "didn't switch to current user in outer context")
+        osmock.seteuid.assert_called_once_with(0)
+        osmock.setegid.assert_called_once_with(0)
+        switch_to_current_usermock.assert_called_once_with()
+
     @patch("umake.tools.os")
     @patch("umake.tools.switch_to_current_user")
     def test_as_root_with_lock(self, switch_to_current_usermock, osmock):
@@ -854,6 +1105,9 @@ class TestUserENV(LoggedTestCase):
         self.orig_environ = os.environ.copy()
         self.local_dir = tempfile.mkdtemp()
         os.environ['SHELL'] = '/bin/bash'
+        lock_patcher = patch("umake.tools.settings.PROFILE_LOCK_PATH", os.path.join(self.local_dir, ".profile-lock"))
+        lock_patcher.start()
+        self.addCleanup(lock_patcher.stop)
 
     def tearDown(self):
         shutil.rmtree(self.local_dir)
@@ -1038,6 +1292,72 @@ class TestUserENV(LoggedTestCase):
         self.assertTrue("\nPATH=/tmp/bar:$PATH\n" in profile_content, profile_content)
         self.assertTrue("/tmp/bar" in os.environ["PATH"], os.environ["PATH"])
 
+    @patch("umake.tools.os.path.expanduser")
+    def test_add_env_to_user_in_transaction(self, expanderusermock):
+        """Envs added in a transaction for the same framework are written once in the same block"""
+        expanderusermock.return_value = self.local_dir
+        profile_file = os.path.join(self.local_dir, ".profile")
+        open(profile_file, 'w').write("Foo\n# Ubuntu make installation of framework A\nexport OLD=old\n\nBar\n")
+
+        with patch("umake.tools.os.replace", wraps=os.replace) as replace_mock:
+            with tools.profile_transaction():
+                tools.add_env_to_user("framework A", {"FOOO": {"value": "bar", "keep": False}})
+                tools.add_env_to_user("framework A", {"BAR": {"value": "$FOOO", "keep": False}})
+                tools.add_env_to_user("framework B", {"PATH": {"value": "/tmp/baz"}})
+                self.assertEqual(open(profile_file).read(),
+                                 "Foo\n# Ubuntu make installation of framework A\nexport OLD=old\n\nBar\n")
+
+        self.assertEqual(replace_mock.call_count, 1)
+        self.assertEqual(open(profile_file).read(),
+                         "Foo\nBar\n"
+                         "# Ubuntu make installation of framework A\nexport FOOO=bar\nexport BAR=$FOOO\n\n"
+                         "# Ubuntu make installation of framework B\nPATH=/tmp/baz:$PATH\n\n")
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_failed_transaction_doesnt_change_profile(self, expanderusermock):
+        """Nothing is written if the profile transaction raises"""
+        expanderusermock.return_value = self.local_dir
+        profile_file = os.path.join(self.local_dir, ".profile")
+        open(profile_file, 'w').write("Foo\nBar\n")
+
+        with suppress(BaseException):
+            with tools.profile_transaction():
+                tools.add_env_to_user("framework A", {"FOOO": {"value": "bar"}})
+                raise BaseException("Something bad happened")
+
+        self.assertEqual(open(profile_file).read(), "Foo\nBar\n")
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_profile_transaction_locks_other_processes(self, expanderusermock):
+        """The profile lock is held while rewriting it"""
+        expanderusermock.return_value = self.local_dir
+        lock_path = os.path.join(self.local_dir, ".profile-lock")
+        original_replace = os.replace
+
+        def replace_while_locked(src, dst):
+            with open(lock_path) as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            original_replace(src, dst)
+
+        with patch("umake.tools.os.replace", side_effect=replace_while_locked) as replace_mock:
+            tools.add_env_to_user("framework A", {"FOOO": {"value": "bar"}})
+
+        self.assertTrue(replace_mock.called)
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_add_env_to_user_keeps_symlinked_profile(self, expanderusermock):
+        """We update the target of a symlinked profile file"""
+        expanderusermock.return_value = self.local_dir
+        target = os.path.join(self.local_dir, "dotfiles-profile")
+        open(target, 'w').write("Foo\n")
+        os.symlink(target, os.path.join(self.local_dir, ".profile"))
+
+        tools.add_env_to_user("framework A", {"FOOO": {"value": "bar", "keep": False}})
+
+        self.assertTrue(os.path.islink(os.path.join(self.local_dir, ".profile")))
+        self.assertEqual(open(target).read(), "Foo\n# Ubuntu make installation of framework A\nexport FOOO=bar\n\n")
+
     @patch("umake.tools.os.path.expanduser")
     def test_remove_user_env(self, expanderusermock):
         """Remove an env from a user setup"""
@@ -1062,6 +1382,19 @@ class TestUserENV(LoggedTestCase):
         profile_content = open(profile_file).read()
         self.assertEqual(profile_content, "Foo\nBar\n")
 
+    @patch("umake.tools.os.path.expanduser")
+    def test_remove_user_env_multiple_blocks(self, expanderusermock):
+        """Remove all env blocks of a framework, keeping other frameworks ones"""
+        expanderusermock.return_value = self.local_dir
+        profile_file = os.path.join(self.local_dir, ".profile")
+        open(profile_file, 'w').write("Foo\n# Ubuntu make installation of framework A\nexport FOO=bar\n\n"
+                                      "# Ubuntu make installation of framework B\nexport BAZ=qux\n\n"
+                                      "# Ubuntu make installation of framework A\nexport BAR=baz\n\nBar\n")
+        tools.remove_framework_envs_from_user("framework A")
+
+        profile_content = open(profile_file).read()
+        self.assertEqual(profile_content, "Foo\n# Ubuntu make installation of framework B\nexport BAZ=qux\n\nBar\n")
+
     @patch("umake.tools.os.path.expanduser")
     def test_remove_user_env_not_found(self, expanderusermock):
         """Remove an env from a user setup with no matching content found"""
@@ -1162,3 +1495,435 @@ class TestUserShell(LoggedTestCase):
         """Return bash if no key"""
         os.environ.pop('SHELL')
         self.assertTrue(tools._get_shell_profile_file_path().endswith(".profile"))
+
+
+class TestTrash(LoggedTestCase):
+    """Test deferred removal of trashed paths"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.trash_dir = os.path.join(self.tempdir, "trash")
+        self.settings_patcher = patch.object(settings, "DEFAULT_TRASH_PATH", self.trash_dir)
+        self.settings_patcher.start()
+        self.tree = os.path.join(self.tempdir, "install")
+        for subdir in ("a", os.path.join("a", "b"), "c"):
+            os.makedirs(os.path.join(self.tree, subdir))
+            for i in range(10):
+                open(os.path.join(self.tree, subdir, "file{}".format(i)), "w").write("foo")
+        os.symlink(os.path.join(self.tree, "a"), os.path.join(self.tree, "link"))
+
+    def tearDown(self):
+        self.settings_patcher.stop()
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def test_move_to_trash(self):
+        """Trashed path is moved right away and removed in the background"""
+        tools.move_to_trash(self.tree)
+
+        self.assertFalse(os.path.exists(self.tree))
+        tools.TrashCollector().join()
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_move_to_trash_can_reuse_path(self):
+        """Path can be recreated as soon as it's trashed"""
+        tools.move_to_trash(self.tree)
+        os.makedirs(self.tree)
+        open(os.path.join(self.tree, "new"), "w").write("new")
+        tools.TrashCollector().join()
+
+        self.assertEqual(os.listdir(self.tree), ["new"])
+
+    def test_move_to_trash_doesnt_follow_symlinks(self):
+        """We don't remove content which is only a symlink target"""
+        target = os.path.join(self.tempdir, "target")
+        os.makedirs(target)
+        open(os.path.join(target, "foo"), "w").write("foo")
+        os.symlink(target, os.path.join(self.tree, "external"))
+
+        tools.move_to_trash(self.tree)
+        tools.TrashCollector().join()
+
+        self.assertTrue(os.path.isfile(os.path.join(target, "foo")))
+
+    def test_move_to_trash_other_filesystem(self):
+        """We use a trash next to the path if it's on a different filesystem than the default trash"""
+        orig_rename = os.rename
+
+        def rename(src, dest):
+            if dest.startswith(self.trash_dir):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return orig_rename(src, dest)
+
+        with patch("umake.tools.os.rename", side_effect=rename):
+            tools.move_to_trash(self.tree)
+        self.assertFalse(os.path.exists(self.tree))
+        tools.TrashCollector().join()
+
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, settings.TRASH_DIRNAME)), [])
+        self.assertIn(os.path.join(self.tempdir, settings.TRASH_DIRNAME), tools._get_trash_dirs())
+
+    def test_move_to_trash_unlink_failure(self):
+        """Files we fail to unlink are removed by the fallback, without stopping the removal"""
+        orig_unlink = os.unlink
+        failed = []
+
+        def unlink(path, *args, **kwargs):
+            if os.path.isabs(path) and os.path.basename(path) == "file0":
+                failed.append(path)
+                raise PermissionError(errno.EACCES, "Permission denied")
+            return orig_unlink(path, *args, **kwargs)
+
+        with patch("umake.tools.os.unlink", side_effect=unlink):
+            tools.move_to_trash(self.tree)
+            tools.TrashCollector().join()
+
+        self.assertEqual(len(failed), 3)
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_move_to_trash_no_path(self):
+        """Trashing a non existing path raises FileNotFoundError"""
+        self.assertRaises(FileNotFoundError, tools.move_to_trash, os.path.join(self.tempdir, "doesntexist"))
+
+    def test_empty_trash(self):
+        """Leftovers from previous runs are removed"""
+        os.makedirs(self.trash_dir)
+        os.rename(self.tree, os.path.join(self.trash_dir, "install-foo"))
+
+        tools.empty_trash()
+        tools.TrashCollector().join()
+
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_empty_trash_without_trash(self):
+        """Nothing happens if there is no trash"""
+        tools.empty_trash()
+        tools.TrashCollector().join()
+
+        self.assertFalse(os.path.exists(self.trash_dir))
+
+
+class TestTracer(LoggedTestCase):
+    """Test recording install phases spans"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.trace_path = os.path.join(self.tempdir, "trace.json")
+        Singleton._instances.pop(tools.Tracer, None)
+        self.tracer = tools.Tracer()
+
+    def tearDown(self):
+        Singleton._instances.pop(tools.Tracer, None)
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def load_trace(self):
+        self.tracer.save(self.trace_path)
+        with open(self.trace_path) as f:
+            return json.load(f)["traceEvents"]
+
+    def test_no_span_recorded_when_disabled(self):
+        """Nothing is recorded when tracing isn't enabled"""
+        with self.tracer.span("foo") as args:
+            args["bytes"] = 42
+
+        self.assertEqual(self.load_trace(), [])
+
+    @patch("umake.tools.atexit")
+    def test_record_spans(self, atexit_mock):
+        """Spans are recorded as complete events with their arguments and thread name"""
+        self.tracer.start(self.trace_path)
+        with self.tracer.span("foo", "download", url="http://foo") as args:
+            args["bytes"] = 42
+
+        events = self.load_trace()
+        atexit_mock.register.assert_called_once_with(self.tracer.save, self.trace_path)
+        span = [event for event in events if event["ph"] == "X"][0]
+        self.assertEqual(span["name"], "foo")
+        self.assertEqual(span["cat"], "download")
+        self.assertEqual(span["args"], {"url": "http://foo", "bytes": 42})
+        self.assertEqual(span["tid"], threading.get_ident())
+        self.assertGreaterEqual(span["dur"], 0)
+        self.assertIn({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": threading.get_ident(),
+                       "args": {"name": threading.current_thread().name}}, events)
+
+    @patch("umake.tools.atexit")
+    def test_record_span_errors(self, atexit_mock):
+        """Errors ending a span are recorded, but not returning to the main loop"""
+        self.tracer.start(self.trace_path)
+        with suppress(BaseException):
+            with self.tracer.span("foo"):
+                raise BaseException("bar")
+        with suppress(tools.MainLoop.ReturnMainLoop):
+            with self.tracer.span("baz"):
+                raise tools.MainLoop.ReturnMainLoop()
+
+        spans = {event["name"]: event for event in self.load_trace() if event["ph"] == "X"}
+        self.assertEqual(spans["foo"]["args"], {"error": "bar"})
+        self.assertEqual(spans["baz"]["args"], {})
+
+    @patch("umake.tools.atexit")
+    def test_trace_mainloop_calls(self, atexit_mock):
+        """Functions run in the main loop thread are recorded"""
+        self.tracer.start(self.trace_path)
+        calls = []
+
+        @tools.MainLoop.in_mainloop_thread
+        def _function_in_mainloop_thread():
+            calls.append(True)
+
+        with patch.object(tools.MainLoop, "dispatch_queue", tools.DispatchQueue()) as dispatch_queue:
+            _function_in_mainloop_thread()
+            dispatch_queue._drain()
+
+        self.assertEqual(calls, [True])
+        spans = [event for event in self.load_trace() if event["ph"] == "X"]
+        self.assertEqual(spans[0]["cat"], "mainloop")
+        self.assertIn("_function_in_mainloop_thread", spans[0]["name"])
+
+
+class TestPageScanner(LoggedTestCase):
+    """Test extracting download links, checksums and licenses from pages"""
+
+    page = dedent("""\
+        <h1>Downloads</h1>
+        <table>
+        <tr class="foo-linux-i386">
+          <td><a href="http://download/foo-i386.tar.gz">foo i386</a></td>
+          <td>1234</td><td>i386checksum</td>
+        </tr>
+        <tr class="foo-linux-amd64">
+          <td><a href="http://download/foo-amd64.tar.gz">foo amd64</a></td>
+          <td>5678</td><td>amd64checksum</td>
+        </tr>
+        </table>
+        <div class="license">
+        Do what you want.
+          </div>
+        but not that.
+        </div>
+        """)
+
+    def scanner(self, **kwargs):
+        kwargs.setdefault("url", r'href="(.*)">')
+        kwargs.setdefault("checksum", r'<td>(\w+checksum)</td>')
+        return tools.PageScanner(**kwargs)
+
+    def test_scan_section(self):
+        """We get the url and checksum of the section matching start"""
+        result = self.scanner(start="linux-amd64", end="</tr>").scan(self.page, need_checksum=True)
+
+        self.assertEqual(result.url, "http://download/foo-amd64.tar.gz")
+        self.assertEqual(result.checksum, "amd64checksum")
+        self.assertEqual(result.license, "")
+
+    def test_scan_first_section(self):
+        """We get the url and checksum of the first section matching start"""
+        result = self.scanner(start="linux-", end="</tr>").scan(self.page, need_checksum=True)
+
+        self.assertEqual(result.url, "http://download/foo-i386.tar.gz")
+        self.assertEqual(result.checksum, "i386checksum")
+
+    def test_scan_section_without_end(self):
+        """A section without end goes to the end of the page"""
+        result = self.scanner(start="</table>").scan(self.page + '<a href="http://download/last">\n')
+
+        self.assertEqual(result.url, "http://download/last")
+        self.assertIsNone(result.checksum)
+
+    def test_scan_whole_page(self):
+        """Without start, we get the first url and checksum of the page"""
+        result = self.scanner().scan(self.page, need_checksum=True)
+
+        self.assertEqual(result.url, "http://download/foo-i386.tar.gz")
+        self.assertEqual(result.checksum, "i386checksum")
+
+    def test_scan_values_stay_on_their_line(self):
+        """Dots don't match new lines, like when parsing line by line"""
+        result = tools.PageScanner(url=r'href="(.*amd64.tar.gz)"').scan('<a href="http://foo\n/amd64.tar.gz"\n')
+
+        self.assertIsNone(result.url)
+
+    def test_scan_until_checksum_found(self):
+        """The last section providing an url wins until we find a checksum"""
+        page = self.page.replace("<td>i386checksum</td>", "")
+
+        result = self.scanner(start="linux-", end="</tr>").scan(page, need_checksum=True)
+
+        self.assertEqual(result.url, "http://download/foo-amd64.tar.gz")
+        self.assertEqual(result.checksum, "amd64checksum")
+
+    def test_scan_nothing(self):
+        """We get nothing if no section matches"""
+        result = self.scanner(start="linux-arm64", end="</tr>", license_start="^<div",
+                              license_end="^</div>").scan(self.page, need_checksum=True)
+
+        self.assertIsNone(result.url)
+        self.assertIsNone(result.checksum)
+        self.assertEqual(result.license, "")
+
+    def test_scan_license(self):
+        """We get the license lines, excluding the end one"""
+        result = self.scanner(start="linux-amd64", end="</tr>", license_start='^<div class="license"',
+                              license_end="^</div>").scan(self.page, need_license=True)
+
+        self.assertEqual(result.license, '<div class="license">\nDo what you want.\n  </div>\nbut not that.\n')
+        self.assertEqual(result.url, "http://download/foo-amd64.tar.gz")
+
+    def test_scan_license_only_when_needed(self):
+        """We don't look for the license if it's not needed"""
+        result = self.scanner(license_start='^<div class="license"', license_end="^</div>").scan(self.page)
+
+        self.assertEqual(result.license, "")
+
+
+class TestParseHtml(LoggedTestCase):
+    """Test parsing only the needed elements of html pages"""
+
+    page = dedent("""\
+        <html><body>
+        <h1>Downloads</h1>
+        <p>Get <a href="http://download/foo.tar.gz">foo</a> here.</p>
+        <a href="http://download/checksums.txt"><button>Checksums</button></a>
+        </body></html>
+        """)
+
+    def setUp(self):
+        super().setUp()
+        tools._html_parser = None
+
+    def tearDown(self):
+        tools._html_parser = None
+        super().tearDown()
+
+    def test_parse_only_matching_elements(self):
+        """We only get the matching elements with their children"""
+        soup = tools.parse_html(self.page, 'a')
+
+        self.assertIsNone(soup.find('h1'))
+        self.assertIsNone(soup.find('p'))
+        self.assertEqual([a['href'] for a in soup.find_all('a')],
+                         ["http://download/foo.tar.gz", "http://download/checksums.txt"])
+        self.assertEqual(soup.find('button').parent['href'], "http://download/checksums.txt")
+
+    def test_parse_matching_attributes(self):
+        """We only get the elements matching attributes"""
+        soup = tools.parse_html(self.page.encode(), 'a', href=re.compile(r'\.tar\.gz$'))
+
+        self.assertEqual([a['href'] for a in soup.find_all('a')], ["http://download/foo.tar.gz"])
+
+    def test_parser_without_lxml(self):
+        """We fall back to the python html parser when lxml isn't installed"""
+        with patch.dict("sys.modules", {"lxml": None}):
+            self.assertEqual(tools.get_html_parser(), "html.parser")
+            self.assertEqual(tools.parse_html(self.page, 'a').find('a')['href'], "http://download/foo.tar.gz")
+
+    def test_parser_with_lxml(self):
+        """We use lxml when installed"""
+        with patch.dict("sys.modules", {"lxml": Mock()}):
+            self.assertEqual(tools.get_html_parser(), "lxml")
+
+
+class TestGpgKeyring(LoggedTestCase):
+    """Test the persistent gpg keyrings"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.settings_patcher = patch.object(settings, "GPG_KEYRINGS_PATH", self.tempdir)
+        self.settings_patcher.start()
+        with open(os.path.join(get_data_dir(), "server-content", "swift.org", "keys", "all-keys.asc")) as f:
+            self.keys = f.read()
+
+    def tearDown(self):
+        self.settings_patcher.stop()
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def test_build_keyring(self):
+        """We build the keyring from the keys"""
+        keyring = tools.GpgKeyring("foo")
+        gpg = keyring.get_gpg(self.keys)
+
+        self.assertEqual(keyring.path, os.path.join(self.tempdir, "foo"))
+        self.assertEqual(gpg.gnupghome, keyring.path)
+        self.assertEqual(len(gpg.list_keys()), 3)
+        self.assertEqual(os.listdir(self.tempdir), ["foo"])
+
+    def test_reuse_keyring(self):
+        """We reuse the keyring for the same keys, even from another instance"""
+        tools.GpgKeyring("foo").get_gpg(self.keys)
+        inode = os.stat(os.path.join(self.tempdir, "foo")).st_ino
+
+        with patch("gnupg.GPG.import_keys") as import_keys:
+            gpg = tools.GpgKeyring("foo").get_gpg(self.keys)
+
+        self.assertFalse(import_keys.called)
+        self.assertEqual(os.stat(os.path.join(self.tempdir, "foo")).st_ino, inode)
+        self.assertEqual(len(gpg.list_keys()), 3)
+
+    def test_rebuild_keyring_with_new_keys(self):
+        """We rebuild the keyring when the keys change, dropping removed ones"""
+        keyring = tools.GpgKeyring("foo")
+        gpg = keyring.get_gpg(self.keys)
+        fingerprint = gpg.list_keys().fingerprints[0]
+        one_key = gpg.export_keys(fingerprint)
+
+        gpg = keyring.get_gpg(one_key)
+
+        self.assertEqual(gpg.list_keys().fingerprints, [fingerprint])
+        self.assertEqual(os.listdir(self.tempdir), ["foo"])
+
+    def test_rebuild_keyring_missing_keys(self):
+        """We rebuild the keyring when it doesn't have all the keys we imported"""
+        keyring = tools.GpgKeyring("foo")
+        gpg = keyring.get_gpg(self.keys)
+        gpg.delete_keys(gpg.list_keys().fingerprints[0])
+
+        gpg = keyring.get_gpg(self.keys)
+
+        self.assertEqual(len(gpg.list_keys()), 3)
+
+    def test_keyring_given_to_user_as_root(self):
+        """We give the keyring and the directories we created for it to the user when building it as root"""
+        keyrings_path = os.path.join(self.tempdir, "umake", ".gnupg")
+        with patch.object(settings, "GPG_KEYRINGS_PATH", keyrings_path), \
+                patch("umake.tools.os.geteuid", return_value=0), \
+                patch.dict("os.environ", {"SUDO_UID": "4242", "SUDO_GID": "4243"}):
+            keyring = tools.GpgKeyring("foo")
+            keyring.get_gpg(self.keys)
+
+        for path in (os.path.join(self.tempdir, "umake"), keyrings_path, keyring.path,
+                     os.path.join(keyring.path, keyring.STATE_FILENAME)):
+            self.assertEqual((os.stat(path).st_uid, os.stat(path).st_gid), (4242, 4243), path)
+        self.assertEqual(os.stat(self.tempdir).st_uid, os.getuid())
+
+    def test_keyring_rebuilt_concurrently(self):
+        """We use the keyring another run built at the same time than us"""
+        rename = os.rename
+        other_run_done = False
+
+        def other_run_first(src, dst):
+            nonlocal other_run_done
+            if not other_run_done:
+                other_run_done = True
+                tools.GpgKeyring("foo").get_gpg(self.keys)
+            rename(src, dst)
+
+        with patch("umake.tools.os.rename", side_effect=other_run_first):
+            gpg = tools.GpgKeyring("foo").get_gpg(self.keys)
+
+        self.assertEqual(len(gpg.list_keys()), 3)
+        self.assertEqual(os.listdir(self.tempdir), ["foo"])
+
+    def test_keyring_with_invalid_keys(self):
+        """We don't build any keyring without valid keys, and keep the previous one"""
+        self.expect_warn_error = True
+        keyring = tools.GpgKeyring("foo")
+        keyring.get_gpg(self.keys)
+
+        self.assertIsNone(keyring.get_gpg("not a key"))
+        self.assertEqual(os.listdir(self.tempdir), ["foo"])
+        self.assertEqual(len(keyring.get_gpg(self.keys).list_keys()), 3)
@@ -87,6 +87,24 @@ class TestUI(LoggedTestCase):
         UI.return_main_screen()
         self.assertTrue(self.mockUIPlug._return_main_screen.called)
 
+    @patch("requests.head")
+    @patch("umake.ui.get_cached_latest_version", return_value="42.04")
+    @patch("builtins.print")
+    def test_return_to_mainscreen_on_error_advertises_cached_latest_version(self, mock_print, _, mock_head):
+        """We advertise latest cached version on errors without any network access"""
+        UI.return_main_screen(status_code=1)
+        self.assertIn("42.04", mock_print.call_args[0][0])
+        self.assertFalse(mock_head.called)
+        self.mockUIPlug._return_main_screen.assert_called_with(status_code=1)
+
+    @patch("umake.ui.get_version", side_effect=FileNotFoundError("no version file"))
+    @patch("umake.ui.get_cached_latest_version", return_value="42.04")
+    def test_return_to_mainscreen_on_error_without_version(self, *args):
+        """We still return to the main screen if we can't get our version"""
+        self.expect_warn_error = True
+        UI.return_main_screen(status_code=1)
+        self.mockUIPlug._return_main_screen.assert_called_with(status_code=1)
+
     @patch("umake.tools.sys")
     def test_call_display(self, mocksys):
         """We call the display method from the UIPlug"""
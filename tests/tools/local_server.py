@@ -105,6 +105,12 @@ class LocalHttp:
 class RequestHandler(SimpleHTTPRequestHandler):
 
     root_path = os.getcwd()
+    # number of requests received per path, for flaky and truncated paths
+    requests_count = {}
+    # Range headers received per path
+    ranges_requested = {}
+    # headers of the last request received per path
+    headers_received = {}
 
     def __init__(self, request, client_address, server):
         self.headers_to_send = []
@@ -169,11 +175,66 @@ class RequestHandler(SimpleHTTPRequestHandler):
             cookies['int'] = int(cookies['int'].value) + 1
         for cookie in cookies.values():
             self.headers_to_send.append(('Set-Cookie', cookie.OutputString(None)))
+        RequestHandler.headers_received[self.path] = self.headers
 
-        if self.path.endswith('-redirect'):
+        if '?redirect_to=' in self.path:
+            # For paths like 'foo?redirect_to=url', we redirect to url, which can be on another host
+            self.send_response(302)
+            self.send_header('Location', urllib.parse.unquote(self.path.split('?redirect_to=', 1)[1]))
+            self.end_headers()
+        elif self.path.endswith('-redirect'):
             self.send_response(302)
             self.send_header('Location', self.path[:-len('-redirect')])
             self.end_headers()
+        elif '-flaky' in self.path:
+            # For paths like 'foo-flaky?fail=N', we answer 503 to the N first requests before serving foo.
+            url = urllib.parse.urlparse(self.path)
+            count = RequestHandler.requests_count.get(self.path, 0)
+            RequestHandler.requests_count[self.path] = count + 1
+            if count < int(urllib.parse.parse_qs(url.query)['fail'][0]):
+                self.send_error(503)
+                return
+            self.path = url.path[:-len('-flaky')]
+            super().do_GET()
+        elif self.path.endswith('-chunked'):
+            # For paths like 'foo-chunked', we send foo content with a chunked transfer encoding, in small chunks
+            with open(self.translate_path(self.path[:-len('-chunked')]), 'rb') as f:
+                content = f.read()
+            self.protocol_version = "HTTP/1.1"
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(content), 1000):
+                chunk = content[i:i + 1000]
+                self.wfile.write("{:x}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.close_connection = True
+        elif '-truncated' in self.path:
+            # For paths like 'foo-truncated', we only send the first half of foo content on first request, then
+            # honor 'Range: bytes=N-' requests to resume it.
+            url = urllib.parse.urlparse(self.path)
+            count = RequestHandler.requests_count.get(self.path, 0)
+            RequestHandler.requests_count[self.path] = count + 1
+            with open(self.translate_path(url.path[:-len('-truncated')]), 'rb') as f:
+                content = f.read()
+            range_header = self.headers['Range']
+            RequestHandler.ranges_requested.setdefault(self.path, []).append(range_header)
+            start = 0
+            if count > 0 and range_header:
+                start = int(range_header.split('=')[1].rstrip('-'))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', len(content) - start)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', 'Wed, 21 Oct 2015 07:28:00 GMT')
+            self.end_headers()
+            if count == 0:
+                self.wfile.write(content[:len(content) // 2])
+            else:
+                self.wfile.write(content[start:])
+            self.close_connection = True
         elif 'setheaders' in self.path:
             # For paths that end with '-setheaders', we fish out the headers from the query
             # params and set them.
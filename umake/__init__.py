@@ -22,13 +22,11 @@ import gettext
 from gettext import gettext as _
 import locale
 import logging
-import logging.config
 import os
 import sys
-from umake.frameworks import BaseCategory, load_frameworks
-from umake.tools import MainLoop
-from .ui import cli
-import yaml
+from umake.network.rate_limiter import parse_rate
+from umake.settings import get_version, refresh_latest_version_cache
+from umake.tools import MainLoop, empty_trash, is_completion_mode
 
 
 logger = logging.getLogger(__name__)
@@ -58,9 +56,11 @@ def _setup_logging(env_key='LOG_CFG', level=_default_log_level):
     logging.basicConfig(level=level, format="%(levelname)s: %(message)s")
     if level == _default_log_level:
         if os.path.exists(path):
+            from logging.config import dictConfig
+            import yaml
             with open(path, 'rt') as f:
                 config = yaml.load(f.read())
-            logging.config.dictConfig(config)
+            dictConfig(config)
     logging.info("Logging level set to {}".format(logging.getLevelName(logging.root.getEffectiveLevel())))
 
 
@@ -118,13 +118,43 @@ def main():
     parser.add_argument('-r', '--remove', action="store_true", help=_("Remove specified framework if installed"))
 
     parser.add_argument('--version', action="store_true", help=_("Print version and exit"))
+    parser.add_argument('--max-rate', metavar="RATE", type=parse_rate,
+                        help=_("Limit the total download rate, in bytes per second (suffixes K, M and G are accepted)"))
+    bundle_group = parser.add_mutually_exclusive_group()
+    bundle_group.add_argument('--export-bundle', metavar="DIR",
+                              help=_("Download everything needed to install the framework in DIR and exit, without "
+                                     "installing it"))
+    bundle_group.add_argument('--from-bundle', metavar="DIR",
+                              help=_("Install the framework only from content previously exported to DIR"))
+    parser.add_argument('--json-events', action="store_true",
+                        help=_("Don't ask anything and report progress as JSON objects, one per line"))
+    parser.add_argument('--answers', metavar="FILE",
+                        help=_("Answer questions from this yaml file, with --json-events"))
+    parser.add_argument('--trace', metavar="FILE",
+                        help=_("Save time spent in each installation step to FILE, in the Chrome trace event format"))
+    parser.add_argument('--dedup-report', action="store_true",
+                        help=_("Print disk space saved by sharing identical files between frameworks and exit"))
 
     # set logging ignoring unknown options
     set_logging_from_args(sys.argv, parser)
 
+    # answer without loading any framework, as it's the only option not needing them
+    if sys.argv[1:] == ["--version"] and not is_completion_mode():
+        print(get_version())
+        sys.exit(0)
+
     mainloop = MainLoop()
 
+    # finish removing what previous runs couldn't before exiting
+    if not is_completion_mode():
+        empty_trash()
+        # check for a newer release while we work, to advertise it on later failures. Bundles are for offline use
+        if "--from-bundle" not in sys.argv:
+            refresh_latest_version_cache()
+
     # load frameworks and initialize parser
+    from umake.frameworks import load_frameworks
+    from umake.ui import cli
     load_frameworks()
     cli.main(parser)
 
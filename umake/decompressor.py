@@ -27,7 +27,10 @@ import stat
 import subprocess
 import tarfile
 import tempfile
+from threading import Lock
+from time import monotonic
 import zipfile
+from umake.tools import Tracer
 
 
 logger = logging.getLogger(__name__)
@@ -48,7 +51,10 @@ class Decompressor:
             os.chmod(targetpath, mode)
             return targetpath
 
-    def __init__(self, orders, on_done):
+    # minimum delay in seconds between two progress reports
+    REPORT_INTERVAL = 0.1
+
+    def __init__(self, orders, on_done, report=lambda x: None):
         """Decompress all fds in threads and send on_done callback once finished
 
 
@@ -65,10 +71,17 @@ class Decompressor:
             "fd":
                 DecompressResult(error=optional error if anything went wrong"
         }
+
+        report, if not None, will be called while decompressing with a dict of archive names and how much of them
+        was read, as current/size parameters
         """
         self._orders = orders
         self._decompressed = {}
         self._done_callback = on_done
+        self._wired_report = report
+        self._progress = {}
+        self._report_lock = Lock()
+        self._last_report_time = 0
 
         executor = futures.ThreadPoolExecutor(max_workers=3)
         for fd in orders:
@@ -82,6 +95,35 @@ class Decompressor:
         """decompress one entry
 
         dir can be a regexp"""
+        size = os.fstat(fd.fileno()).st_size
+        with Tracer().span("decompress", "install", dest=dest, bytes=size):
+            self._report(fd.name, 0, size, force=True)
+            tempdest = self._extract(fd, dest, lambda current_size: self._report(fd.name, current_size, size))
+            self._report(fd.name, size, size, force=True)
+
+        with Tracer().span("move", "install", dest=dest):
+            try:
+                dir_path = glob(os.path.join(tempdest, dir))[0]
+            except IndexError:
+                raise BaseException("Couldn't find {} in tarball".format(dir))
+            for filename in os.listdir(dir_path):
+                shutil.move(os.path.join(dir_path, filename), os.path.join(dest, filename))
+            shutil.rmtree(tempdest)
+
+    def _report(self, name, current_size, total_size, force=False):
+        """Update name decompression progress and deliver it at most every REPORT_INTERVAL, unless forced"""
+        with self._report_lock:
+            self._progress[name] = {"current": min(current_size, total_size), "size": total_size}
+            now = monotonic()
+            if not force and now - self._last_report_time < self.REPORT_INTERVAL:
+                return
+            self._last_report_time = now
+            self._wired_report(dict(self._progress))
+
+    def _extract(self, fd, dest, report):
+        """extract fd content in a temporary directory in dest, which is returned
+
+        report is called with the position in fd while reading it, when possible"""
         logger.debug("Extracting to {}".format(dest))
         # we temporarily extract to this destination the archive content
         tempdest = tempfile.mktemp(dir=dest)
@@ -92,7 +134,7 @@ class Decompressor:
         try:
             try:
                 # the fd isn't forcibly at position 0 (like in Unity3D where we offset the script part)
-                archive = tarfile.open(fileobj=fd, mode='r|*')
+                archive = tarfile.open(fileobj=_ReportingReader(fd, report), mode='r|*')
                 logger.debug("tar file")
             except tarfile.ReadError:
                 archive = self.ZipFileWithPerm(fd.name)
@@ -125,14 +167,7 @@ class Decompressor:
             archive.communicate()
             logger.debug("executable file")
             os.remove(name)
-
-        try:
-            dir_path = glob(os.path.join(tempdest, dir))[0]
-        except IndexError:
-            raise BaseException("Couldn't find {} in tarball".format(dir))
-        for filename in os.listdir(dir_path):
-            shutil.move(os.path.join(dir_path, filename), os.path.join(dest, filename))
-        shutil.rmtree(tempdest)
+        return tempdest
 
     def _one_done(self, future):
         """Callback that will be called once one decompress finishes.
@@ -158,3 +193,19 @@ class Decompressor:
         """
         logger.info("All pending decompression done to {} done.".format([self._orders[fd].dest for fd in self._orders]))
         self._done_callback(self._decompressed)
+
+
+class _ReportingReader:
+    """File object wrapper reporting the position in the file after each read"""
+
+    def __init__(self, fileobj, report):
+        self._fileobj = fileobj
+        self._report = report
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._report(self._fileobj.tell())
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Deduplicate identical files between installed frameworks"""
+
+from collections import namedtuple
+from concurrent import futures
+from contextlib import suppress
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+from umake import settings
+
+logger = logging.getLogger(__name__)
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class Deduplicator:
+    """Replace files in installed trees which are identical to already indexed ones by reflinks or hardlinks
+
+    We keep a persistent content index of all installed trees. Files are bucketed by size first, so that we only
+    hash files having at least another one with the same size."""
+
+    DedupResult = namedtuple("DedupResult", ["saved", "error"])
+
+    # don't bother for small files, the gain is less than the cost
+    MIN_FILE_SIZE = 4096
+
+    def __init__(self, paths, on_done):
+        """Deduplicate all paths in a thread and send on_done callback once finished
+
+        Return a dict of DedupResult on the on_done callback:
+        {
+            "path":
+                DedupResult(saved=bytes saved in this path,
+                            error=optional error if anything went wrong)
+        }
+        """
+        self._paths = paths
+        self._done_callback = on_done
+
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self._deduplicate_all, paths)
+        future.add_done_callback(self._done)
+
+    def _deduplicate_all(self, paths):
+        results = {}
+        index = self.load_index()
+        for path in paths:
+            try:
+                saved = self._deduplicate(index, path)
+                results[path] = self.DedupResult(saved=saved, error=None)
+            except Exception as e:
+                logger.warning("Couldn't deduplicate {}: {}".format(path, e))
+                results[path] = self.DedupResult(saved=0, error=str(e))
+        self.save_index(index)
+        return results
+
+    def _done(self, future):
+        if future.exception():
+            logger.warning("Deduplication failed: {}".format(future.exception()))
+            result = {path: self.DedupResult(saved=0, error=str(future.exception())) for path in self._paths}
+        else:
+            result = future.result()
+        logger.info("Deduplication of {} done".format(self._paths))
+        self._done_callback(result)
+
+    @staticmethod
+    def load_index():
+        """Load content index, dropping it if it's corrupted
+
+        Index content is:
+        {"files": {"size": [[path, mtime_ns, hash or None], ...]},
+         "saved": {"installed path": saved bytes}}"""
+        try:
+            with open(settings.DEDUP_INDEX_PATH, encoding='utf-8') as f:
+                index = json.load(f)
+            index["files"]
+            index["saved"]
+            return index
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Invalid deduplication index, reset it: {}".format(e))
+        return {"files": {}, "saved": {}}
+
+    @staticmethod
+    def save_index(index):
+        """Save atomically the content index"""
+        os.makedirs(os.path.dirname(settings.DEDUP_INDEX_PATH), exist_ok=True)
+        with open(settings.DEDUP_INDEX_PATH + ".new", "w", encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(settings.DEDUP_INDEX_PATH + ".new", settings.DEDUP_INDEX_PATH)
+
+    @staticmethod
+    def _hash(path):
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(2 ** 20), b''):
+                checksum.update(data)
+        return checksum.hexdigest()
+
+    def _deduplicate(self, index, root):
+        """Deduplicate root against itself and index content. Return the saved size in bytes"""
+        root = os.path.normpath(root)
+        root_prefix = os.path.join(root, '')
+
+        # drop anything previously indexed in this tree (reinstall) or not matching what is on disk anymore
+        for size in list(index["files"]):
+            entries = []
+            for entry in index["files"][size]:
+                if entry[0].startswith(root_prefix):
+                    continue
+                with suppress(FileNotFoundError):
+                    st = os.lstat(entry[0])
+                    if stat.S_ISREG(st.st_mode) and st.st_size == int(size) and st.st_mtime_ns == entry[1]:
+                        entries.append(entry)
+            if entries:
+                index["files"][size] = entries
+            else:
+                del(index["files"][size])
+        index["saved"] = {path: saved for (path, saved) in index["saved"].items()
+                          if os.path.isdir(path) and path != root}
+
+        saved = 0
+        for path, st in self._walk(root):
+            if st.st_size < self.MIN_FILE_SIZE:
+                continue
+            entries = index["files"].setdefault(str(st.st_size), [])
+            new_entry = [path, st.st_mtime_ns, None]
+            if entries:
+                new_entry[2] = self._hash(path)
+                for entry in entries:
+                    if entry[2] is None:
+                        entry[2] = self._hash(entry[0])
+                    if entry[2] == new_entry[2] and self._replace_with_copy_of(entry[0], path, st):
+                        saved += st.st_size
+                        new_entry = None
+                        break
+            if new_entry:
+                entries.append(new_entry)
+
+        if saved:
+            index["saved"][root] = saved
+        logger.info("Deduplication saved {} bytes in {}".format(saved, root))
+        return saved
+
+    @staticmethod
+    def _walk(root):
+        """Yield (path, stat) of all regular files in root"""
+        to_scan = [root]
+        while to_scan:
+            with os.scandir(to_scan.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        to_scan.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield (entry.path, entry.stat(follow_symlinks=False))
+
+    @staticmethod
+    def _replace_with_copy_of(source, path, path_st):
+        """Replace path by a reflink of source if the filesystem supports it, or a hardlink otherwise
+
+        Return True if path was replaced."""
+        tmp_path = "{}.umake-dedup".format(path)
+        try:
+            source_st = os.lstat(source)
+            if source_st.st_dev != path_st.st_dev or source_st.st_ino == path_st.st_ino:
+                return False
+            try:
+                with open(source, 'rb') as src, open(tmp_path, 'wb') as dest:
+                    fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                os.chmod(tmp_path, stat.S_IMODE(path_st.st_mode))
+                os.utime(tmp_path, ns=(path_st.st_atime_ns, path_st.st_mtime_ns))
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                    raise
+                os.remove(tmp_path)
+                # hardlinks share metadata: only use them when this doesn't change anything
+                if (source_st.st_mode, source_st.st_uid, source_st.st_gid) != \
+                        (path_st.st_mode, path_st.st_uid, path_st.st_gid):
+                    return False
+                os.link(source, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.debug("Couldn't deduplicate {} with {}: {}".format(path, source, e))
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            return False
+        logger.debug("{} deduplicated with {}".format(path, source))
+        return True
+
+    @classmethod
+    def get_report(cls):
+        """Return a dict of installed paths with the number of bytes deduplication saved"""
+        return {path: saved for (path, saved) in cls.load_index()["saved"].items() if os.path.isdir(path)}
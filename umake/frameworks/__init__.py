@@ -262,17 +262,15 @@ class BaseFramework(metaclass=abc.ABCMeta):
 
     def mark_in_config(self):
         """Mark the installation as installed in the config file"""
-        config = ConfigHandler().config
-        config.setdefault("frameworks", {})\
-              .setdefault(self.category.prog_name, {})\
-              .setdefault(self.prog_name, {})["path"] = self.install_path
-        ConfigHandler().config = config
+        with ConfigHandler().transaction() as config:
+            config.setdefault("frameworks", {})\
+                  .setdefault(self.category.prog_name, {})\
+                  .setdefault(self.prog_name, {})["path"] = self.install_path
 
     def remove_from_config(self):
         """Remove current framework from config"""
-        config = ConfigHandler().config
-        del(config["frameworks"][self.category.prog_name][self.prog_name])
-        ConfigHandler().config = config
+        with ConfigHandler().transaction() as config:
+            del(config["frameworks"][self.category.prog_name][self.prog_name])
 
     @property
     def is_installed(self):
@@ -20,7 +20,6 @@
 
 """Android module"""
 
-from contextlib import suppress
 from gettext import gettext as _
 import logging
 import os
@@ -29,7 +28,7 @@ import re
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
 from umake.ui import UI
-from umake.tools import add_env_to_user, create_launcher, get_application_desktop_file, ChecksumType
+from umake.tools import add_env_to_user, create_launcher, get_application_desktop_file, ChecksumType, PageScanner
 
 logger = logging.getLogger(__name__)
 
@@ -41,39 +40,13 @@ class AndroidCategory(umake.frameworks.BaseCategory):
     def __init__(self):
         super().__init__(name="Android", description=_("Android Development Environment"), logo_path=None)
 
-    def parse_license(self, tag, line, license_txt, in_license):
-        """Parse Android download page for license"""
-        if line.startswith(tag):
-            in_license = True
-        if in_license:
-            if line.startswith('</div>'):
-                in_license = False
-            else:
-                license_txt.write(line)
-        return in_license
-
-    def parse_download_link(self, tag, line, in_download):
-        """Parse Android download links, expect to find a sha1sum and a url"""
-        url, sha1sum = (None, None)
-        if tag in line:
-            in_download = True
-        if in_download:
-            p = re.search(r'href="(.*)"', line)
-            with suppress(AttributeError):
-                url = p.group(1)
-            p = re.search(r'<td>(\w+)</td>', line)
-            with suppress(AttributeError):
-                # ensure the size can match a md5 or sha1 checksum
-                if len(p.group(1)) > 15:
-                    sha1sum = p.group(1)
-            if "</tr>" in line:
-                in_download = False
-
-        if url is None and sha1sum is None:
-            return (None, in_download)
-        if url and url.startswith("//"):
-            url = "https:" + url
-        return ((url, sha1sum), in_download)
+    def get_page_scanner(self, tag):
+        """Return the scanner of Android download pages, with the download link and its checksum in the table row
+        containing tag"""
+        # the checksum length ensures that we don't match the size column
+        return PageScanner(start=re.escape(tag), end=re.escape("</tr>"), url=r'href="(.*)"',
+                           checksum=r'<td>(\w{16,})</td>',
+                           license_start=r'^<div class="sdk-terms"', license_end=r'^</div>')
 
 
 class AndroidStudio(umake.frameworks.baseinstaller.BaseInstaller):
@@ -87,15 +60,8 @@ class AndroidStudio(umake.frameworks.baseinstaller.BaseInstaller):
                          checksum_type=ChecksumType.sha256,
                          dir_to_decompress_in_tarball="android-studio",
                          desktop_filename="android-studio.desktop",
-                         required_files_path=[os.path.join("bin", "studio.sh")])
-
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android Studio download page for license"""
-        return self.category.parse_license('<div class="sdk-terms"', line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android Studio download link, expect to find a sha1sum and a url"""
-        return self.category.parse_download_link('id="linux-bundle"', line, in_download)
+                         required_files_path=[os.path.join("bin", "studio.sh")],
+                         page_scanner=category.get_page_scanner('id="linux-bundle"'))
 
     def post_install(self):
         """Create the Android Studio launcher"""
@@ -117,15 +83,8 @@ class AndroidSDK(umake.frameworks.baseinstaller.BaseInstaller):
                          download_page="https://developer.android.com/studio/index.html",
                          checksum_type=ChecksumType.sha256,
                          dir_to_decompress_in_tarball=".",
-                         required_files_path=[os.path.join("tools", "android")])
-
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android SDK download page for license"""
-        return self.category.parse_license('<div class="sdk-terms"', line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android SDK download link, expect to find a SHA-1 and a url"""
-        return self.category.parse_download_link('id="linux-tools"', line, in_download)
+                         required_files_path=[os.path.join("tools", "android")],
+                         page_scanner=category.get_page_scanner('id="linux-tools"'))
 
     def post_install(self):
         """Add necessary environment variables"""
@@ -156,15 +115,8 @@ class AndroidNDK(umake.frameworks.baseinstaller.BaseInstaller):
                          checksum_type=ChecksumType.sha1,
                          packages_requirements=['clang'],
                          dir_to_decompress_in_tarball="android-ndk-*",
-                         required_files_path=[os.path.join("ndk-build")])
-
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android NDK download page for license"""
-        return self.category.parse_license('<div class="sdk-terms"', line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android NDK download link, expect to find a sha1sum and a url"""
-        return self.category.parse_download_link('<td>Linux ', line, in_download)
+                         required_files_path=[os.path.join("ndk-build")],
+                         page_scanner=category.get_page_scanner('<td>Linux '))
 
     def post_install(self):
         """Add necessary environment variables"""
@@ -24,17 +24,19 @@ from contextlib import suppress
 from gettext import gettext as _
 from io import StringIO
 import logging
-from progressbar import ProgressBar
 import os
 import shutil
+from urllib import parse
 import umake.frameworks
 from umake.decompressor import Decompressor
+from umake.deduplicator import Deduplicator
 from umake.interactions import InputText, YesNo, LicenseAgreement, DisplayMessage, UnknownProgress
 from umake.network.download_center import DownloadCenter, DownloadItem
 from umake.network.requirements_handler import RequirementsHandler
 from umake.ui import UI
 from umake.tools import MainLoop, strip_tags, launcher_exists, get_icon_path, get_launcher_path, \
-    Checksum, remove_framework_envs_from_user, add_exec_link
+    Checksum, Tracer, remove_framework_envs_from_user, add_exec_link, move_to_trash, profile_transaction, \
+    LauncherFavorites
 
 logger = logging.getLogger(__name__)
 
@@ -65,9 +67,12 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.desktop_filename = kwargs.get("desktop_filename", None)
         self.icon_filename = kwargs.get("icon_filename", None)
         self.match_last_link = kwargs.get("match_last_link", False)
+        # tools.PageScanner extracting download link, checksum and license from the download page, instead of
+        # parse_download_link() and parse_license() being called on each line
+        self.page_scanner = kwargs.get("page_scanner", None)
         for extra_arg in ["download_page", "checksum_type", "dir_to_decompress_in_tarball",
                           "desktop_filename", "icon_filename", "required_files_path",
-                          "match_last_link"]:
+                          "match_last_link", "page_scanner"]:
             with suppress(KeyError):
                 kwargs.pop(extra_arg)
         super().__init__(*args, **kwargs)
@@ -97,9 +102,23 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         logger.debug("{} is installed".format(self.name))
         return True
 
+    @property
+    def exporting_bundle(self):
+        """Only download everything needed to install the framework in the offline bundle"""
+        return DownloadCenter.bundle is not None and DownloadCenter.bundle.recording
+
+    @property
+    def bundle_extra_requests(self):
+        """DownloadItems needed after installation, like icons, which should be part of an offline bundle"""
+        return []
+
     def setup(self, install_path=None, auto_accept_license=False):
         self.arg_install_path = install_path
         self.auto_accept_license = auto_accept_license
+        if self.exporting_bundle:
+            # nothing is installed: no need for root access or installation path
+            self._start_download_provider_page()
+            return
         super().setup()
 
         # first step, check if installed
@@ -132,7 +151,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             with suppress(FileNotFoundError):
                 os.remove(get_icon_path(self.icon_filename))
         with suppress(FileNotFoundError):
-            shutil.rmtree(self.install_path)
+            move_to_trash(self.install_path)
         remove_framework_envs_from_user(self.name)
         self.remove_from_config()
 
@@ -166,12 +185,16 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                     return
         self.install_path = path_dir
         self.set_exec_path()
-        self.download_provider_page()
+        self._start_download_provider_page()
 
     def set_installdir_to_clean(self):
         logger.debug("Mark non empty new installation path for cleaning.")
         self._paths_to_clean.add(self.install_path)
         self.set_exec_path()
+        self._start_download_provider_page()
+
+    def _start_download_provider_page(self):
+        UI.event("phase", phase="metadata", framework=self.name)
         self.download_provider_page()
 
     def download_provider_page(self):
@@ -202,29 +225,25 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
             UI.return_main_screen(status_code=1)
 
+        # decode the page once, as a whole
+        page = result[self.download_page].buffer.read().decode()
         url, checksum = (None, None)
         with StringIO() as license_txt:
-            in_license = False
-            in_download = False
-            for line in result[self.download_page].buffer:
-                line_content = line.decode()
-
-                if self.expect_license and not self.auto_accept_license:
-                    in_license = self.parse_license(line_content, license_txt, in_license)
-
-                # always take the first valid (url, checksum) if not match_last_link is set to True:
-                download = None
-                if url is None or (self.checksum_type and not checksum) or self.match_last_link:
-                    (download, in_download) = self.parse_download_link(line_content, in_download)
-                if download is not None:
-                    (newurl, new_checksum) = download
-                    url = newurl if newurl is not None else url
-                    checksum = new_checksum if new_checksum is not None else checksum
-                    if url is not None:
-                        if self.checksum_type and checksum:
-                            logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
-                        elif not self.checksum_type:
-                            logger.debug("Found download link for {}".format(url))
+            need_license = self.expect_license and not self.auto_accept_license
+            if self.page_scanner:
+                scan = self.page_scanner.scan(page, need_checksum=bool(self.checksum_type), need_license=need_license)
+                if scan.url is not None:
+                    url = parse.urljoin(self.download_page, scan.url)
+                checksum = scan.checksum
+                if need_license:
+                    license_txt.write(scan.license)
+            else:
+                url, checksum = self._parse_page_lines(page, license_txt)
+            if url is not None:
+                if self.checksum_type:
+                    logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
+                else:
+                    logger.debug("Found download link for {}".format(url))
 
             if url is None:
                 logger.error("Download page changed its syntax or is not parsable (url missing)")
@@ -246,7 +265,29 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             else:
                 self.start_download_and_install()
 
+    def _parse_page_lines(self, page, license_txt):
+        """Parse page line by line with parse_download_link() and parse_license(). Return (url, checksum)"""
+        url, checksum = (None, None)
+        in_license = False
+        in_download = False
+        for line_content in StringIO(page):
+            if self.expect_license and not self.auto_accept_license:
+                in_license = self.parse_license(line_content, license_txt, in_license)
+
+            # always take the first valid (url, checksum) if not match_last_link is set to True:
+            download = None
+            if url is None or (self.checksum_type and not checksum) or self.match_last_link:
+                (download, in_download) = self.parse_download_link(line_content, in_download)
+            if download is not None:
+                (newurl, new_checksum) = download
+                url = newurl if newurl is not None else url
+                checksum = new_checksum if new_checksum is not None else checksum
+        return (url, checksum)
+
     def start_download_and_install(self):
+        if self.exporting_bundle:
+            self.export_to_bundle()
+            return
         self.last_progress_download = None
         self.last_progress_requirement = None
         self.balance_requirement_download = None
@@ -254,16 +295,42 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.result_requirement = None
         self.result_download = None
         self._download_done_callback_called = False
+        UI.event("phase", phase="download", framework=self.name)
         UI.display(DisplayMessage("Downloading and installing requirements"))
+        from progressbar import ProgressBar
         self.pbar = ProgressBar().start()
         self.pkg_to_install = RequirementsHandler().install_bucket(self.packages_requirements,
                                                                    self.get_progress_requirement,
                                                                    self.requirement_done)
         DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download)
 
+    def export_to_bundle(self):
+        UI.event("phase", phase="export", framework=self.name)
+        UI.display(DisplayMessage("Exporting {} to {}".format(self.name, DownloadCenter.bundle.path)))
+        DownloadCenter(urls=self.download_requests + self.bundle_extra_requests, on_done=self.export_to_bundle_done)
+        UI.display(UnknownProgress(self.iterate_until_install_done))
+
     @MainLoop.in_mainloop_thread
+    def export_to_bundle_done(self, result):
+        self._install_done = True
+        error_detected = False
+        for url in result:
+            if result[url].error:
+                logger.error(result[url].error)
+                error_detected = True
+            else:
+                result[url].fd.close()
+        if error_detected:
+            UI.return_main_screen(status_code=1)
+
+        UI.delayed_display(DisplayMessage("Export done"))
+        UI.return_main_screen()
+
+    # download and requirement progress are reported separately: only coalesce reports from the same side
+    @MainLoop.coalesced_in_mainloop_thread(lambda self, progress_download, progress_requirement:
+                                           (self, progress_download is None))
     def get_progress(self, progress_download, progress_requirement):
-        """Global progress info. Don't use named parameters as idle_add doesn't like it"""
+        """Global progress info"""
 
         if progress_download is not None:
             self.last_progress_download = progress_download
@@ -304,6 +371,10 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         """Chain up to main get_progress, returning current value between 0 and 100"""
 
         percentage = status["percentage"]
+        if status["step"] == RequirementsHandler.STATUS_WAITING_LOCK:
+            # percentage of the timeout we waited for, we didn't progress
+            UI.event("requirements_progress", step="wait_lock", percentage=percentage, holder=status["holder"])
+            return
         # 60% is download, 40% is installing
         if status["step"] == RequirementsHandler.STATUS_DOWNLOADING:
             self.pkg_size_download = status["pkg_size_download"]
@@ -313,6 +384,9 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                 progress = percentage  # no download, only install
             else:
                 progress = 60 + 0.4 * percentage
+        UI.event("requirements_progress",
+                 step="download" if status["step"] == RequirementsHandler.STATUS_DOWNLOADING else "install",
+                 percentage=percentage, size=self.pkg_size_download)
         self.get_progress(None, progress)
 
     def get_progress_download(self, downloads):
@@ -328,8 +402,14 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             total_size += downloads[download]["size"]
             total_current_size += downloads[download]["current"]
         self.total_download_size = total_size
+        UI.event("download_progress", current=total_current_size, size=total_size)
         self.get_progress(total_current_size / total_size * 100, None)
 
+    def get_progress_decompress(self, archives):
+        """Report how much of all archives was decompressed"""
+        UI.event("extract_progress", current=sum(archive["current"] for archive in archives.values()),
+                 size=sum(archive["size"] for archive in archives.values()))
+
     def requirement_done(self, result):
         # set requirement download as finished if no error
         if not result.error:
@@ -375,11 +455,12 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.decompress_and_install(fds)
 
     def decompress_and_install(self, fds):
+        UI.event("phase", phase="install", framework=self.name)
         UI.display(DisplayMessage("Installing {}".format(self.name)))
-        # empty destination directory if reinstall
+        # empty destination directory if reinstall. Removal itself is done in the background.
         for dir_to_remove in self._paths_to_clean:
             with suppress(FileNotFoundError):
-                shutil.rmtree(dir_to_remove)
+                move_to_trash(dir_to_remove)
             # marked them as cleaned
             self._paths_to_clean = []
 
@@ -396,7 +477,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             else:
                 decompress_fds[fd] = Decompressor.DecompressOrder(dir=self.dir_to_decompress_in_tarball,
                                                                   dest=self.install_path)
-        Decompressor(decompress_fds, self.decompress_and_install_done)
+        Decompressor(decompress_fds, self.decompress_and_install_done, report=self.get_progress_decompress)
         UI.display(UnknownProgress(self.iterate_until_install_done))
 
     def post_install(self):
@@ -405,7 +486,6 @@ class BaseInstaller(umake.frameworks.BaseFramework):
 
     @MainLoop.in_mainloop_thread
     def decompress_and_install_done(self, result):
-        self._install_done = True
         error_detected = False
         for fd in result:
             if result[fd].error:
@@ -413,11 +493,27 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                 error_detected = True
             fd.close()
         if error_detected:
+            self._install_done = True
             UI.return_main_screen(status_code=1)
 
-        self.post_install()
-        if self.exec_link_name:
-            add_exec_link(self.exec_path, self.exec_link_name)
+        Deduplicator([self.install_path], self.deduplicate_done)
+
+    @MainLoop.in_mainloop_thread
+    def deduplicate_done(self, result):
+        """Finish the installation once identical files are shared with other installed frameworks"""
+        self._install_done = True
+        for path in result:
+            if result[path].error:
+                # we don't fail on deduplication errors, files are still there
+                logger.warning(result[path].error)
+
+        UI.event("phase", phase="post_install", framework=self.name)
+        # update the user shell profile and launcher favorites only once for all changes
+        with Tracer().span("post_install", "install", framework=self.name), profile_transaction(), \
+                LauncherFavorites().batch():
+            self.post_install()
+            if self.exec_link_name:
+                add_exec_link(self.exec_path, self.exec_link_name)
         # Mark as installation done in configuration
         self.mark_in_config()
 
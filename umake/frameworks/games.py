@@ -27,12 +27,12 @@ import logging
 import os
 import re
 import stat
-import json
 
 import umake.frameworks.baseinstaller
+import umake.frameworks.githubrelease
 from umake.network.download_center import DownloadItem, DownloadCenter
 from umake.tools import as_root, create_launcher, get_application_desktop_file, get_current_arch,\
-    ChecksumType, MainLoop, Checksum
+    ChecksumType, MainLoop, Checksum, PageScanner
 from umake.ui import UI
 
 logger = logging.getLogger(__name__)
@@ -61,26 +61,11 @@ class Stencyl(umake.frameworks.baseinstaller.BaseInstaller):
                                                 "libxdmcp6:i386", "libxfixes3:i386", "libx11-6:i386",
                                                 "libxinerama1:i386", "libxrandr2:i386", "libxrender1:i386",
                                                 "zlib1g:i386", "libnss3-1d:i386", "libnspr4-0d:i386", "libcurl3:i386",
-                                                "libasound2:i386"])
-
-    def parse_download_link(self, line, in_download):
-        """Parse Stencyl download links"""
-        url, md5sum = (None, None)
-        if ">Linux <" in line:
-            in_download = True
-        if in_download:
-            regexp = r'href="(.*)"><.*64-'
-            if get_current_arch() == "i386":
-                regexp = r'href="(.*)"><.*32-'
-            p = re.search(regexp, line)
-            with suppress(AttributeError):
-                url = p.group(1)
-            if '<div class="spacer"><br/><br/>' in line:
-                in_download = False
-
-        if url is None:
-            return (None, in_download)
-        return ((url, None), in_download)
+                                                "libasound2:i386"],
+                         page_scanner=PageScanner(start=re.escape(">Linux <"),
+                                                  end=re.escape('<div class="spacer"><br/><br/>'),
+                                                  url=r'href="(.*)"><.*{}-'.format(
+                                                      "32" if get_current_arch() == "i386" else "64")))
 
     def post_install(self):
         """Create the Stencyl launcher"""
@@ -258,12 +243,12 @@ class Twine(umake.frameworks.baseinstaller.BaseInstaller):
                         categories="Development;IDE;"))
 
 
-class Superpowers(umake.frameworks.baseinstaller.BaseInstaller):
+class Superpowers(umake.frameworks.githubrelease.BaseGitHubReleaseInstaller):
 
     def __init__(self, category):
         super().__init__(name="Superpowers", description=_("The HTML5 2D+3D game maker"),
                          category=category, only_on_archs=['i386', 'amd64'],
-                         download_page="https://api.github.com/repos/superpowers/superpowers-app/releases/latest",
+                         github_repository="superpowers/superpowers-app",
                          dir_to_decompress_in_tarball='superpowers*',
                          desktop_filename="superpowers.desktop",
                          required_files_path=["Superpowers"])
@@ -273,30 +258,8 @@ class Superpowers(umake.frameworks.baseinstaller.BaseInstaller):
         "i386": "ia32"
     }
 
-    @MainLoop.in_mainloop_thread
-    def get_metadata_and_check_license(self, result):
-        logger.debug("Fetched download page, parsing.")
-        page = result[self.download_page]
-        error_msg = page.error
-        if error_msg:
-            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
-            UI.return_main_screen(status_code=1)
-
-        try:
-            assets = json.loads(page.buffer.read().decode())["assets"]
-            download_url = None
-            for asset in assets:
-                if "linux-{}".format(self.arch_trans[get_current_arch()]) in asset["browser_download_url"]:
-                    download_url = asset["browser_download_url"]
-            if not download_url:
-                raise IndexError
-        except (json.JSONDecodeError, IndexError):
-            logger.error("Can't parse the download URL from the download page.")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download URL: " + download_url)
-
-        self.download_requests.append(DownloadItem(download_url, None))
-        self.start_download_and_install()
+    def get_asset_url(self, release):
+        return release.find("linux-{}".format(self.arch_trans[get_current_arch()]))
 
     def post_install(self):
         """Create the Superpowers launcher"""
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""Install assets of GitHub releases"""
+
+from abc import ABCMeta, abstractmethod
+from contextlib import closing
+import json
+import logging
+import os
+from threading import Lock
+from urllib.parse import urlparse
+import umake.frameworks.baseinstaller
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.tools import MainLoop, Singleton
+from umake.ui import UI
+
+logger = logging.getLogger(__name__)
+
+
+class GitHubRelease(object):
+    """Assets of a GitHub release, indexed by extension of their download url"""
+
+    # extensions made of multiple suffixes
+    COMPOUND_EXTENSIONS = (".tar.gz", ".tar.bz2", ".tar.xz")
+
+    def __init__(self, release):
+        self.tag = release.get("tag_name")
+        self.asset_urls = [asset["browser_download_url"] for asset in release["assets"]]
+        self._urls_by_extension = {}
+        for url in self.asset_urls:
+            self._urls_by_extension.setdefault(self.get_extension(url), []).append(url)
+
+    @classmethod
+    def get_extension(cls, url):
+        filename = os.path.basename(urlparse(url).path)
+        for extension in cls.COMPOUND_EXTENSIONS:
+            if filename.endswith(extension):
+                return extension
+        return os.path.splitext(filename)[1]
+
+    def find(self, keyword="", extension=None):
+        """Return the download url of the last asset containing keyword and having this extension, if any"""
+        urls = self.asset_urls if extension is None else self._urls_by_extension.get(extension, [])
+        for url in reversed(urls):
+            if keyword in url:
+                return url
+        return None
+
+
+class GitHubReleases(object, metaclass=Singleton):
+    """Latest releases of GitHub repositories, fetched once per repository for the whole session"""
+
+    API_URL = "https://api.github.com/repos/{}/releases/latest"
+
+    def __init__(self):
+        self._lock = Lock()
+        # repository: GitHubRelease
+        self._releases = {}
+        # repository: callbacks waiting for the release being fetched
+        self._waiting = {}
+
+    def get_latest(self, repository, on_done):
+        """Call on_done(release, error) with the latest GitHubRelease of repository, or an error string.
+
+        Only one request is made for concurrent and later calls for the same repository, unless it failed."""
+        with self._lock:
+            release = self._releases.get(repository)
+            if release is None:
+                fetching = repository in self._waiting
+                self._waiting.setdefault(repository, []).append(on_done)
+        if release is not None:
+            logger.debug("Reusing latest release of {}".format(repository))
+            on_done(release, None)
+            return
+        if not fetching:
+            url = self.API_URL.format(repository)
+            DownloadCenter([DownloadItem(url)], lambda result: self._fetched(repository, result[url]), download=False)
+
+    def _fetched(self, repository, result):
+        release, error = None, result.error
+        if not error:
+            try:
+                with closing(result.buffer):
+                    release = GitHubRelease(json.load(result.buffer))
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                error = "Can't parse the latest release of {}: {}".format(repository, e)
+        with self._lock:
+            if release is not None:
+                self._releases[repository] = release
+            callbacks = self._waiting.pop(repository)
+        for on_done in callbacks:
+            on_done(release, error)
+
+
+class BaseGitHubReleaseInstaller(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCMeta):
+    """Frameworks installing an asset of the latest release of a GitHub repository"""
+
+    def __init__(self, *args, **kwargs):
+        self.github_repository = kwargs.pop("github_repository")
+        kwargs["download_page"] = GitHubReleases.API_URL.format(self.github_repository)
+        super().__init__(*args, **kwargs)
+
+    @abstractmethod
+    def get_asset_url(self, release):
+        """Return the download url of the asset to install from the GitHubRelease, None if there is none"""
+        pass
+
+    def download_provider_page(self):
+        logger.debug("Get latest release of {}".format(self.github_repository))
+        GitHubReleases().get_latest(self.github_repository, self.get_release_asset)
+
+    @MainLoop.in_mainloop_thread
+    def get_release_asset(self, release, error):
+        """Download the asset to install from the latest release"""
+        if error:
+            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error))
+            UI.return_main_screen(status_code=1)
+
+        download_url = self.get_asset_url(release)
+        if not download_url:
+            logger.error("Can't parse the download URL from the download page.")
+            UI.return_main_screen(status_code=1)
+        logger.debug("Found download URL: " + download_url)
+
+        self.download_requests.append(DownloadItem(download_url, None))
+        self.start_download_and_install()
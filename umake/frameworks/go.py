@@ -20,14 +20,13 @@
 
 """Go module"""
 
-from contextlib import suppress
 from gettext import gettext as _
 import logging
 import os
 import re
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
-from umake.tools import get_current_arch, add_env_to_user, ChecksumType
+from umake.tools import get_current_arch, add_env_to_user, ChecksumType, PageScanner
 from umake.ui import UI
 
 logger = logging.getLogger(__name__)
@@ -43,31 +42,15 @@ class GoCategory(umake.frameworks.BaseCategory):
 class GoLang(umake.frameworks.baseinstaller.BaseInstaller):
 
     def __init__(self, category):
+        arch = get_current_arch().replace("i386", "386")
         super().__init__(name="Go Lang", description=_("Google compiler (default)"), is_category_default=True,
                          category=category, only_on_archs=['i386', 'amd64'],
                          download_page="https://golang.org/dl/",
                          checksum_type=ChecksumType.sha256,
                          dir_to_decompress_in_tarball="go",
-                         required_files_path=[os.path.join("bin", "go")])
-
-    def parse_download_link(self, line, in_download):
-        """Parse Go download link, expect to find a sha and a url"""
-        url, sha = (None, None)
-        if "linux-{}".format(get_current_arch().replace("i386", "386")) in line:
-            in_download = True
-        if in_download:
-            p = re.search(r'href="(.*)">', line)
-            with suppress(AttributeError):
-                url = p.group(1)
-            p = re.search(r'<td><tt>(\w+)</tt></td>', line)
-            with suppress(AttributeError):
-                sha = p.group(1)
-            if "</tr>" in line:
-                in_download = False
-
-        if url is None and sha is None:
-            return (None, in_download)
-        return ((url, sha), in_download)
+                         required_files_path=[os.path.join("bin", "go")],
+                         page_scanner=PageScanner(start=re.escape("linux-{}".format(arch)), end=re.escape("</tr>"),
+                                                  url=r'href="(.*)">', checksum=r'<td><tt>(\w+)</tt></td>'))
 
     def post_install(self):
         """Add go necessary env variables"""
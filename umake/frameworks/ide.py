@@ -21,7 +21,6 @@
 
 """Generic IDE module."""
 from abc import ABCMeta, abstractmethod
-from bs4 import BeautifulSoup
 from concurrent import futures
 from contextlib import suppress
 from gettext import gettext as _
@@ -39,10 +38,11 @@ from urllib import parse
 import shutil
 
 import umake.frameworks.baseinstaller
+import umake.frameworks.githubrelease
 from umake.interactions import DisplayMessage, LicenseAgreement
-from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.download_center import ChecksumUrl, DownloadCenter, DownloadItem
 from umake.tools import as_root, create_launcher, get_application_desktop_file, ChecksumType, Checksum, MainLoop,\
-    strip_tags, add_env_to_user, add_exec_link, get_current_arch
+    strip_tags, add_env_to_user, add_exec_link, get_current_arch, PageScanner, parse_html
 from umake.ui import UI
 
 logger = logging.getLogger(__name__)
@@ -98,7 +98,7 @@ class BaseEclipse(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCMet
         DownloadCenter([DownloadItem(self.download_page, headers=self.headers)], self.get_metadata, download=False)
 
     def parse_download_link(self, line, in_download):
-        """Parse Eclipse download links"""
+        """Parse Eclipse download links, collecting them as candidates"""
         url_found = False
         if self.download_keyword in line and self.bits in line:
             in_download = True
@@ -107,12 +107,18 @@ class BaseEclipse(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCMet
         if in_download:
             p = re.search(r'href="(.*)" title', line)
             with suppress(AttributeError):
-                self.sha512_url = "https://www.eclipse.org/" + p.group(1) + '.sha512&r=1'
+                self.download_candidates.append("https://www.eclipse.org/" + p.group(1))
                 url_found = True
-                DownloadCenter(urls=[DownloadItem(self.sha512_url, None)],
-                               on_done=self.get_sha_and_start_download, download=False)
         return (url_found, in_download)
 
+    def resolve_download_link(self):
+        """Pick the candidate link to download, whatever the number of matching lines in the page.
+
+        Linux links come first, then the ones for our architecture, in page order."""
+        # sorting is stable, so that page order is kept between equivalent links
+        return sorted(self.download_candidates, key=lambda link: ('linux' not in link,
+                                                                  self.bits == '' and 'x86_64' in link))[0]
+
     @MainLoop.in_mainloop_thread
     def get_metadata(self, result):
         """Download files to download + license and check it"""
@@ -123,34 +129,29 @@ class BaseEclipse(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCMet
             logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
             UI.return_main_screen(status_code=1)
 
+        self.download_candidates = []
         in_download = False
-        url_found = False
         for line in result[self.download_page].buffer:
             line_content = line.decode()
-            (_url_found, in_download) = self.parse_download_link(line_content, in_download)
-            if not url_found:
-                url_found = _url_found
+            (_, in_download) = self.parse_download_link(line_content, in_download)
 
-        if not url_found:
+        if not self.download_candidates:
             logger.error("Download page changed its syntax or is not parsable")
             UI.return_main_screen(status_code=1)
+        self.sha512_url = self.resolve_download_link() + '.sha512&r=1'
+        self.get_sha_and_start_download()
 
-    @MainLoop.in_mainloop_thread
-    def get_sha_and_start_download(self, download_result):
-        res = download_result[self.sha512_url]
-        sha512 = res.buffer.getvalue().decode('utf-8').split()[0]
-        # you get and store self.download_url
+    def get_sha_and_start_download(self):
+        """Start downloading, fetching the sha512 along"""
         url = re.sub('.sha512', '', self.sha512_url)
-        if url is None:
-            logger.error("Download page changed its syntax or is not parsable (missing url)")
-            UI.return_main_screen(status_code=1)
-        if sha512 is None:
-            logger.error("Download page changed its syntax or is not parsable (missing sha512)")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download link for {}, checksum: {}".format(url, sha512))
-        self.download_requests.append(DownloadItem(url, Checksum(ChecksumType.sha512, sha512)))
+        logger.debug("Found download link for {}, checksum: {}".format(url, self.sha512_url))
+        self.download_requests.append(DownloadItem(url, Checksum(ChecksumType.sha512, ChecksumUrl(self.sha512_url))))
         self.start_download_and_install()
 
+    @property
+    def bundle_extra_requests(self):
+        return [DownloadItem(self.icon_url, None)]
+
     def post_install(self):
         """Create the Eclipse launcher"""
         DownloadCenter(urls=[DownloadItem(self.icon_url, None)],
@@ -267,7 +268,7 @@ class BaseJetBrains(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCM
             UI.return_main_screen(status_code=1)
 
         try:
-            key, content = json.loads(page.buffer.read().decode()).popitem()
+            key, content = json.load(page.buffer).popitem()
         except (json.JSONDecodeError):
             logger.error("Can't parse the download URL from the download page.")
             UI.return_main_screen(status_code=1)
@@ -286,23 +287,12 @@ class BaseJetBrains(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCM
             logger.error("Can't parse the download URL from the download page.")
             UI.return_main_screen(status_code=1)
         logger.debug("Found download URL: " + download_url)
-        logger.debug("Downloading checksum first, from " + checksum_url)
-
-        def checksum_downloaded(results):
-            checksum_result = next(iter(results.values()))  # Just get the first.
-            if checksum_result.error:
-                logger.error(checksum_result.error)
-                UI.return_main_screen(status_code=1)
-
-            checksum = checksum_result.buffer.getvalue().decode('utf-8').split()[0]
-            logger.info('Obtained SHA256 checksum: ' + checksum)
-
-            self.download_requests.append(DownloadItem(download_url,
-                                                       checksum=Checksum(ChecksumType.sha256, checksum),
-                                                       ignore_encoding=True))
-            self.start_download_and_install()
+        logger.debug("Downloading checksum along, from " + checksum_url)
 
-        DownloadCenter([DownloadItem(checksum_url)], on_done=checksum_downloaded, download=False)
+        self.download_requests.append(DownloadItem(download_url,
+                                                   checksum=Checksum(ChecksumType.sha256, ChecksumUrl(checksum_url)),
+                                                   ignore_encoding=True))
+        self.start_download_and_install()
 
     def post_install(self):
         """Create the appropriate JetBrains launcher."""
@@ -541,7 +531,8 @@ class Arduino(umake.frameworks.baseinstaller.BaseInstaller):
             logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
             UI.return_main_screen(status_code=1)
 
-        soup = BeautifulSoup(result[self.download_page].buffer, 'html.parser')
+        # we only need links from the page
+        soup = parse_html(result[self.download_page].buffer.getvalue(), 'a')
 
         # We need to avoid matching arduino-nightly-...
         download_link_pat = r'arduino-[\d\.\-r]+-linux' + self.bits + '.tar.xz$'
@@ -562,30 +553,26 @@ class Arduino(umake.frameworks.baseinstaller.BaseInstaller):
             logger.error("Can't parse the checksum link from %s.", self.download_page)
             UI.return_main_screen(status_code=1)
 
-        DownloadCenter([DownloadItem(self.scraped_download_url), DownloadItem(self.scraped_checksum_url)],
-                       on_done=self.prepare_to_download_archive, download=False)
+        DownloadCenter([DownloadItem(self.scraped_download_url)], on_done=self.prepare_to_download_archive,
+                       download=False)
+
+    def parse_checksum(self, checksums):
+        """Return the md5 of the archive from the checksums list"""
+        match = re.search(r'^(\S+)\s+arduino-[\d\.\-r]+-linux' + self.bits + '.tar.xz$', checksums, re.M)
+        if not match:
+            raise BaseException("Can't find a checksum.")
+        return match.group(1)
 
     @MainLoop.in_mainloop_thread
     def prepare_to_download_archive(self, results):
-        """Store the md5 for later and fire off the actual download."""
+        """Fire off the actual download, with the md5 fetched along."""
         download_page = results[self.scraped_download_url]
-        checksum_page = results[self.scraped_checksum_url]
         if download_page.error:
             logger.error("Error fetching download page: %s", download_page.error)
             UI.return_main_screen(status_code=1)
-        if checksum_page.error:
-            logger.error("Error fetching checksums: %s", checksum_page.error)
-            UI.return_main_screen(status_code=1)
 
-        match = re.search(r'^(\S+)\s+arduino-[\d\.\-r]+-linux' + self.bits + '.tar.xz$',
-                          checksum_page.buffer.getvalue().decode('ascii'),
-                          re.M)
-        if not match:
-            logger.error("Can't find a checksum.")
-            UI.return_main_screen(status_code=1)
-        checksum = match.group(1)
-
-        soup = BeautifulSoup(download_page.buffer.getvalue(), 'html.parser')
+        # the download button is in the link we are looking for
+        soup = parse_html(download_page.buffer.getvalue(), 'a')
         btn = soup.find('button', text=re.compile('JUST DOWNLOAD'))
 
         if not btn:
@@ -599,9 +586,8 @@ class Arduino(umake.frameworks.baseinstaller.BaseInstaller):
 
         logger.info('Final download url: %s, cookies: %s.', final_download_url, cookies)
 
-        self.download_requests = [DownloadItem(final_download_url,
-                                               checksum=Checksum(ChecksumType.md5, checksum),
-                                               cookies=cookies)]
+        checksum = Checksum(ChecksumType.md5, ChecksumUrl(self.scraped_checksum_url, parse=self.parse_checksum))
+        self.download_requests = [DownloadItem(final_download_url, checksum=checksum, cookies=cookies)]
 
         # add the user to arduino group
         if not self.was_in_arduino_group:
@@ -797,41 +783,19 @@ class VisualStudioCode(umake.frameworks.baseinstaller.BaseInstaller):
         super().run_for(args)
 
 
-class LightTable(umake.frameworks.baseinstaller.BaseInstaller):
+class LightTable(umake.frameworks.githubrelease.BaseGitHubReleaseInstaller):
 
     def __init__(self, category):
         super().__init__(name="LightTable", description=_("LightTable code editor"),
                          category=category, only_on_archs=['amd64'],
-                         download_page="https://api.github.com/repos/LightTable/LightTable/releases/latest",
+                         github_repository="LightTable/LightTable",
                          desktop_filename="lighttable.desktop",
                          required_files_path=["LightTable"],
                          dir_to_decompress_in_tarball="lighttable-*",
                          checksum_type=ChecksumType.md5)
 
-    @MainLoop.in_mainloop_thread
-    def get_metadata_and_check_license(self, result):
-        logger.debug("Fetched download page, parsing.")
-        page = result[self.download_page]
-        error_msg = page.error
-        if error_msg:
-            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
-            UI.return_main_screen(status_code=1)
-
-        try:
-            assets = json.loads(page.buffer.read().decode())["assets"]
-            download_url = None
-            for asset in assets:
-                if "linux" in asset["browser_download_url"]:
-                    download_url = asset["browser_download_url"]
-            if not download_url:
-                raise IndexError
-        except (json.JSONDecodeError, IndexError):
-            logger.error("Can't parse the download URL from the download page.")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download URL: " + download_url)
-
-        self.download_requests.append(DownloadItem(download_url, None))
-        self.start_download_and_install()
+    def get_asset_url(self, release):
+        return release.find("linux")
 
     def post_install(self):
         """Create the LightTable Code launcher"""
@@ -843,41 +807,19 @@ class LightTable(umake.frameworks.baseinstaller.BaseInstaller):
                         categories="Development;IDE;"))
 
 
-class Atom(umake.frameworks.baseinstaller.BaseInstaller):
+class Atom(umake.frameworks.githubrelease.BaseGitHubReleaseInstaller):
 
     def __init__(self, category):
         super().__init__(name="Atom", description=_("The hackable text editor"),
                          category=category, only_on_archs=['amd64'],
-                         download_page="https://api.github.com/repos/Atom/Atom/releases/latest",
+                         github_repository="Atom/Atom",
                          desktop_filename="atom.desktop",
                          required_files_path=["atom", "resources/app/apm/bin/apm"],
                          dir_to_decompress_in_tarball="atom-*",
                          checksum_type=ChecksumType.md5)
 
-    @MainLoop.in_mainloop_thread
-    def get_metadata_and_check_license(self, result):
-        logger.debug("Fetched download page, parsing.")
-        page = result[self.download_page]
-        error_msg = page.error
-        if error_msg:
-            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
-            UI.return_main_screen(status_code=1)
-
-        try:
-            assets = json.loads(page.buffer.read().decode())["assets"]
-            download_url = None
-            for asset in assets:
-                if "tar.gz" in asset["browser_download_url"]:
-                    download_url = asset["browser_download_url"]
-            if not download_url:
-                raise IndexError
-        except (json.JSONDecodeError, IndexError):
-            logger.error("Can't parse the download URL from the download page.")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download URL: " + download_url)
-
-        self.download_requests.append(DownloadItem(download_url, None))
-        self.start_download_and_install()
+    def get_asset_url(self, release):
+        return release.find(extension=".tar.gz")
 
     def post_install(self):
         """Create the Atom Code launcher"""
@@ -899,22 +841,15 @@ class SublimeText(umake.frameworks.baseinstaller.BaseInstaller):
                          download_page="https://sublimetext.com/3",
                          desktop_filename="sublime-text.desktop",
                          required_files_path=["sublime_text"],
-                         dir_to_decompress_in_tarball="sublime_text_*")
+                         dir_to_decompress_in_tarball="sublime_text_*",
+                         page_scanner=PageScanner(url=r'href="([^<\n]*{}.tar.bz2)"'.format(
+                                                  self.arch_trans[get_current_arch()])))
 
     arch_trans = {
         "amd64": "x64",
         "i386": "x32"
     }
 
-    def parse_download_link(self, line, in_download):
-        """Parse SublimeText download links"""
-        url = None
-        if '.tar.bz2' in line:
-            p = re.search(r'href="([^<]*{}.tar.bz2)"'.format(self.arch_trans[get_current_arch()]), line)
-            with suppress(AttributeError):
-                url = p.group(1)
-        return ((url, None), in_download)
-
     def post_install(self):
         """Create the Sublime Text Code launcher"""
         create_launcher(self.desktop_filename, get_application_desktop_file(name=_("Sublime Text"),
@@ -951,8 +886,6 @@ class SpringToolsSuite(umake.frameworks.baseinstaller.BaseInstaller):
             with suppress(AttributeError):
                 self.checksum_url = p.group(1) + '.sha1'
                 url_found = True
-                DownloadCenter(urls=[DownloadItem(self.checksum_url, None)],
-                               on_done=self.get_sha_and_start_download, download=False)
         return (url_found, in_download)
 
     @MainLoop.in_mainloop_thread
@@ -976,21 +909,13 @@ class SpringToolsSuite(umake.frameworks.baseinstaller.BaseInstaller):
         if not url_found:
             logger.error("Download page changed its syntax or is not parsable")
             UI.return_main_screen(status_code=1)
+        self.get_sha_and_start_download()
 
-    @MainLoop.in_mainloop_thread
-    def get_sha_and_start_download(self, download_result):
-        res = download_result[self.checksum_url]
-        checksum = res.buffer.getvalue().decode('utf-8').split()[0]
-        # you get and store self.download_url
+    def get_sha_and_start_download(self):
+        """Start downloading, fetching the sha1 along"""
         url = re.sub('.sha1', '', self.checksum_url)
-        if url is None:
-            logger.error("Download page changed its syntax or is not parsable (missing url)")
-            UI.return_main_screen(status_code=1)
-        if checksum is None:
-            logger.error("Download page changed its syntax or is not parsable (missing sha512)")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
-        self.download_requests.append(DownloadItem(url, Checksum(self.checksum_type, checksum)))
+        logger.debug("Found download link for {}, checksum: {}".format(url, self.checksum_url))
+        self.download_requests.append(DownloadItem(url, Checksum(self.checksum_type, ChecksumUrl(self.checksum_url))))
         self.start_download_and_install()
 
     def post_install(self):
@@ -1004,12 +929,12 @@ class SpringToolsSuite(umake.frameworks.baseinstaller.BaseInstaller):
                                                                             categories=categories))
 
 
-class Processing(umake.frameworks.baseinstaller.BaseInstaller):
+class Processing(umake.frameworks.githubrelease.BaseGitHubReleaseInstaller):
 
     def __init__(self, category):
         super().__init__(name="Processing", description=_("Processing code editor"),
                          category=category, only_on_archs=['i386', 'amd64'],
-                         download_page="https://api.github.com/repos/processing/processing/releases/latest",
+                         github_repository="processing/processing",
                          desktop_filename="processing.desktop",
                          required_files_path=["processing"],
                          dir_to_decompress_in_tarball="processing-*")
@@ -1019,30 +944,8 @@ class Processing(umake.frameworks.baseinstaller.BaseInstaller):
         "i386": "32"
     }
 
-    @MainLoop.in_mainloop_thread
-    def get_metadata_and_check_license(self, result):
-        logger.debug("Fetched download page, parsing.")
-        page = result[self.download_page]
-        error_msg = page.error
-        if error_msg:
-            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
-            UI.return_main_screen(status_code=1)
-
-        try:
-            assets = json.loads(page.buffer.read().decode())["assets"]
-            download_url = None
-            for asset in assets:
-                if "linux{}".format(self.arch_trans[get_current_arch()]) in asset["browser_download_url"]:
-                    download_url = asset["browser_download_url"]
-            if not download_url:
-                raise IndexError
-        except (json.JSONDecodeError, IndexError):
-            logger.error("Can't parse the download URL from the download page.")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download URL: " + download_url)
-
-        self.download_requests.append(DownloadItem(download_url, None))
-        self.start_download_and_install()
+    def get_asset_url(self, release):
+        return release.find("linux{}".format(self.arch_trans[get_current_arch()]))
 
     def post_install(self):
         """Create the Processing Code launcher"""
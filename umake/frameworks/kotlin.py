@@ -22,12 +22,10 @@
 from gettext import gettext as _
 import logging
 import os
-import json
-import umake.frameworks.baseinstaller
+import umake.frameworks.githubrelease
 from umake.interactions import DisplayMessage
-from umake.tools import add_env_to_user, MainLoop
+from umake.tools import add_env_to_user
 from umake.ui import UI
-from umake.network.download_center import DownloadItem
 
 logger = logging.getLogger(__name__)
 
@@ -38,37 +36,18 @@ class KotlinCategory(umake.frameworks.BaseCategory):
         super().__init__(name="Kotlin", description=_("The Kotlin Programming Language"), logo_path=None)
 
 
-class KotlinLang(umake.frameworks.baseinstaller.BaseInstaller):
+class KotlinLang(umake.frameworks.githubrelease.BaseGitHubReleaseInstaller):
 
     def __init__(self, category):
         super().__init__(name="Kotlin Lang", description=_("Kotlin language standalone compiler"),
                          is_category_default=True, category=category,
                          packages_requirements=["openjdk-7-jre | openjdk-8-jre"],
-                         download_page="https://api.github.com/repos/Jetbrains/kotlin/releases/latest",
+                         github_repository="Jetbrains/kotlin",
                          dir_to_decompress_in_tarball="kotlinc",
                          required_files_path=[os.path.join("bin", "kotlinc")])
 
-    @MainLoop.in_mainloop_thread
-    def get_metadata_and_check_license(self, result):
-        logger.debug("Fetched download page, parsing.")
-
-        page = result[self.download_page]
-
-        error_msg = page.error
-        if error_msg:
-            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
-            UI.return_main_screen(status_code=1)
-
-        try:
-            assets = json.loads(page.buffer.read().decode())["assets"]
-            download_url = assets[0]["browser_download_url"]
-        except (json.JSONDecodeError, IndexError):
-            logger.error("Can't parse the download URL from the download page.")
-            UI.return_main_screen(status_code=1)
-        logger.debug("Found download URL: " + download_url)
-
-        self.download_requests.append(DownloadItem(download_url, None))
-        self.start_download_and_install()
+    def get_asset_url(self, release):
+        return release.find("kotlin-compiler-", extension=".zip")
 
     def post_install(self):
         """Add the Kotlin binary dir to PATH"""
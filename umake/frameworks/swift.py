@@ -20,17 +20,16 @@
 
 """Swift module"""
 
+from concurrent import futures
 from contextlib import suppress
 from gettext import gettext as _
-import gnupg
 import logging
 import os
 import re
-import tempfile
 
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
-from umake.tools import add_env_to_user, as_root, MainLoop, get_current_ubuntu_version
+from umake.tools import add_env_to_user, as_root, MainLoop, get_current_ubuntu_version, GpgKeyring
 from umake.network.download_center import DownloadCenter, DownloadItem
 from umake.ui import UI
 
@@ -54,6 +53,7 @@ class SwiftLang(umake.frameworks.baseinstaller.BaseInstaller):
                          dir_to_decompress_in_tarball="swift*",
                          required_files_path=[os.path.join("usr", "bin", "swift")])
         self.asc_url = "https://swift.org/keys/all-keys.asc"
+        self.signature_check = None
 
     def parse_download_link(self, line, in_download):
         """Parse Swift download link, expect to find a .sig file"""
@@ -93,42 +93,39 @@ class SwiftLang(umake.frameworks.baseinstaller.BaseInstaller):
         DownloadCenter(urls=[DownloadItem(sig_url, None), DownloadItem(self.asc_url, None)],
                        on_done=self.check_gpg_and_start_download, download=False)
 
-    def _check_gpg_signature(self, gnupgdir, asc_content, sig):
-        """check gpg signature (temporary stock in dir)"""
-        gpg = gnupg.GPG(gnupghome=gnupgdir)
-        imported_keys = gpg.import_keys(asc_content)
-        if imported_keys.count == 0:
-            logger.error("Keys not valid")
-            UI.return_main_screen(status_code=1)
+    def _check_gpg_signature(self, asc_content, sig):
+        """check gpg signature with the persistent keyring, return an error message if invalid"""
+        gpg = GpgKeyring("swift").get_gpg(asc_content)
+        if gpg is None:
+            return "Keys not valid"
         verify = gpg.verify(sig)
         if verify is False:
-            logger.error("Signature not valid")
-            UI.return_main_screen(status_code=1)
-
-    @MainLoop.in_mainloop_thread
-    def check_gpg_and_start_download(self, download_result):
-        asc_content = download_result.pop(self.asc_url).buffer.getvalue().decode('utf-8')
-        sig_url = list(download_result.keys())[0]
-        res = download_result[sig_url]
-        sig = res.buffer.getvalue().decode('utf-8').split()[0]
+            return "Signature not valid"
+        return None
 
+    def _check_gpg_signature_as_installer(self, asc_content, sig):
         # When we install new packages, we are executing as root and then dropping
         # as the user for extracting and such. However, for signature verification,
         # we use gpg. This one doesn't like priviledge drop (if uid = 0 and
         # euid = 1000) and asserts if uid != euid.
-        # Importing the key as root as well creates new gnupg files owned as root if
-        # new keys weren't imported first.
         # Consequently, run gpg as root if we needed root access or as the user
-        # otherwise. We store the gpg public key in a temporary gnupg directory that
-        # will be removed under the same user rights (this directory needs to be owned
-        # by the same user id to not be rejected by gpg).Z
+        # otherwise. The keyring is given back to the user when built as root.
         if self.need_root_access:
             with as_root():
-                with tempfile.TemporaryDirectory() as tmpdirname:
-                    self._check_gpg_signature(tmpdirname, asc_content, sig)
-        else:
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                self._check_gpg_signature(tmpdirname, asc_content, sig)
+                return self._check_gpg_signature(asc_content, sig)
+        return self._check_gpg_signature(asc_content, sig)
+
+    @MainLoop.in_mainloop_thread
+    def check_gpg_and_start_download(self, download_result):
+        asc_content = download_result.pop(self.asc_url).buffer.getvalue().decode('utf-8')
+        sig_url = list(download_result.keys())[0]
+        res = download_result[sig_url]
+        sig = res.buffer.getvalue().decode('utf-8').split()[0]
+
+        # check the signature while downloading, we only wait for it before installing
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.signature_check = executor.submit(self._check_gpg_signature_as_installer, asc_content, sig)
+        executor.shutdown(wait=False)
 
         # you get and store self.download_url
         url = re.sub('.sig', '', sig_url)
@@ -139,6 +136,21 @@ class SwiftLang(umake.frameworks.baseinstaller.BaseInstaller):
         self.download_requests.append(DownloadItem(url, None))
         self.start_download_and_install()
 
+    def decompress_and_install(self, fds):
+        """Only install once the signature is checked"""
+        self.signature_check.add_done_callback(lambda future: self.signature_checked(future, fds))
+
+    @MainLoop.in_mainloop_thread
+    def signature_checked(self, future, fds):
+        try:
+            error = future.result()
+        except Exception as e:
+            error = "Couldn't check the signature: {}".format(e)
+        if error:
+            logger.error(error)
+            UI.return_main_screen(status_code=1)
+        super().decompress_and_install(fds)
+
     def post_install(self):
         """Add swift necessary env variables"""
         add_env_to_user(self.name, {"PATH": {"value": os.path.join(self.install_path, "usr", "bin")}})
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering an AsyncDownloadCenter, downloading many requests concurrently on a single thread"""
+
+import asyncio
+from contextlib import suppress
+import http.client
+from io import BytesIO
+import logging
+import os
+import random
+import ssl
+from threading import Lock, Thread
+from time import monotonic
+from urllib.parse import urljoin, urlparse
+import zlib
+
+import requests
+import requests.cookies
+import requests.exceptions
+import requests.structures
+import requests.utils
+from umake.network.download_center import DownloadCenter, TruncatedDownloadError
+from umake.network.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDownloadCenter(DownloadCenter):
+    """Read or download requested urls concurrently on a shared asyncio event loop thread.
+
+    This has the same contract than DownloadCenter, but http(s) transfers are coroutines multiplexed on one thread,
+    reusing keep-alive connections between requests to the same host. The event loop runs in its own thread: as for
+    DownloadCenter, callbacks are called from it and consumers dispatch them to the GLib main loop with
+    MainLoop.in_mainloop_thread.
+    Other protocols, mirrors, bundles, proxied and rate limited transfers are delegated to the threaded
+    implementation."""
+
+    MAX_REDIRECTS = 30
+    # headers only sent to the requested host, and not to other hosts we are redirected to
+    CREDENTIAL_HEADERS = ("authorization", "proxy-authorization", "cookie")
+    # maximum number of simultaneous connections to a host, which are kept alive for next requests
+    MAX_CONNECTIONS_PER_HOST = 6
+    _DECODERS = {"gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+                 "x-gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+                 "deflate": lambda: zlib.decompressobj()}
+
+    _loop = None
+    _loop_lock = Lock()
+    # idle connections and connection slots per (scheme, host, port), only accessed from the event loop thread
+    _idle_connections = {}
+    _host_slots = {}
+
+    def _start_downloads(self):
+        """Start fetching all urls as coroutines on the shared event loop"""
+        loop = self._get_loop()
+        for url_request in self._urls:
+            if self._join_in_flight(url_request):
+                continue
+            dest = self._create_dest(url_request)
+            future = asyncio.run_coroutine_threadsafe(self._fetch_async(url_request, dest), loop)
+            self._share_in_flight(future, url_request)
+            self._tag_future(future, url_request, dest)
+
+    @classmethod
+    def _get_loop(cls):
+        """Return the shared event loop, starting its thread on first use"""
+        with cls._loop_lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                Thread(target=cls._loop.run_forever, name="umake-async-download", daemon=True).start()
+            return cls._loop
+
+    async def _fetch_async(self, download_item, dest):
+        """Get an url content, retrying transient errors following the item retry policy.
+
+        This will write the content to dest and check for its checksum.
+        Return a tuple of (dest, final_url, cookies)
+        """
+        url = download_item.url
+        loop = asyncio.get_running_loop()
+        if urlparse(url).scheme not in ("http", "https") or self.bundle or self._get_mirror_urls(url) or \
+                RateLimiter().enabled or self._get_proxy(url):
+            return await loop.run_in_executor(None, self._fetch, download_item, dest)
+
+        policy = download_item.retry_policy or self.DEFAULT_RETRY_POLICY
+        host = urlparse(url).netloc
+        attempt = 1
+        while True:
+            self._check_host_budget(host)
+            if attempt > 1:
+                self._retries[url] = self._retries.get(url, 0) + 1
+                dest.seek(0)
+                dest.truncate()
+            try:
+                final_url, cookies = await self._fetch_once_async(download_item, dest)
+                self._record_host_result(host, success=True)
+                break
+            except _ProxyRequired:
+                logger.debug("{} is redirected to a proxied url, downloading it in a thread".format(url))
+                dest.seek(0)
+                dest.truncate()
+                return await loop.run_in_executor(None, self._fetch, download_item, dest)
+            except BaseException as e:
+                if not self._is_transient_error(e):
+                    raise
+                self._record_host_result(host, success=False)
+                if attempt >= policy.attempts:
+                    raise
+                delay = min(policy.backoff * 2 ** (attempt - 1), policy.max_backoff)
+                delay += random.uniform(0, delay * policy.jitter)
+                with suppress(AttributeError, KeyError, TypeError, ValueError):
+                    delay = max(delay, min(float(e.response.headers["retry-after"]), policy.max_backoff))
+                logger.warning("Downloading {} failed (attempt {}/{}), retrying in {:.1f}s: {}".format(
+                    url, attempt, policy.attempts, delay, e))
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        # hashing is cpu bound: don't hold other transfers meanwhile
+        await loop.run_in_executor(None, self._check_checksum, url, download_item.checksum, dest)
+        if self._download_progress.get(url, {}).get("size") == -1:
+            self._deliver_report(force=True)
+        return dest, final_url, cookies
+
+    async def _fetch_once_async(self, download_item, dest):
+        """Try to download an url content to dest once, following redirects.
+
+        Return a tuple of (final_url, cookies)
+        """
+        url = download_item.url
+        cookies = requests.cookies.RequestsCookieJar()
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            if redirect and self._get_proxy(url):
+                raise _ProxyRequired()
+            request = requests.Request("GET", url).prepare()
+            headers = requests.utils.default_headers()
+            request_cookies = requests.cookies.merge_cookies(requests.cookies.RequestsCookieJar(), cookies)
+            # like requests, don't leak credentials to other hosts: received cookies are only sent to their domain
+            if self._same_host(download_item.url, url):
+                headers.update(download_item.headers or {})
+                request_cookies = requests.cookies.merge_cookies(request_cookies, download_item.cookies or {})
+            else:
+                headers.update({key: value for (key, value) in (download_item.headers or {}).items()
+                                if key.lower() not in self.CREDENTIAL_HEADERS})
+            cookie_header = requests.cookies.get_cookie_header(request_cookies, request)
+            if cookie_header:
+                headers["Cookie"] = cookie_header
+
+            connection, response, message = await self._request(url, headers)
+            try:
+                cookies.extract_cookies(requests.cookies.MockResponse(message), requests.cookies.MockRequest(request))
+                if response.is_redirect:
+                    await connection.discard_body()
+                    url = urljoin(url, requests.utils.requote_uri(response.headers["location"]))
+                    logger.debug("Redirected to {}".format(url))
+                    continue
+                if response.status_code >= 400:
+                    await connection.discard_body()
+                response.raise_for_status()
+                await self._read_content(download_item, connection, response, dest)
+                return url, cookies
+            finally:
+                connection.release()
+        raise requests.exceptions.TooManyRedirects("Exceeded {} redirects.".format(self.MAX_REDIRECTS))
+
+    @staticmethod
+    def _get_proxy(url):
+        """Return the proxy url requests would use for url from the environment, None if there is none"""
+        return requests.utils.select_proxy(url, requests.utils.get_environ_proxies(url))
+
+    @staticmethod
+    def _same_host(url, other_url):
+        """Return True if credentials sent to url can be sent to other_url"""
+        parsed_url, parsed_other_url = urlparse(url), urlparse(other_url)
+        if parsed_url.hostname != parsed_other_url.hostname:
+            return False
+        # no downgrade from https to http
+        return parsed_url.scheme == parsed_other_url.scheme or parsed_other_url.scheme == "https"
+
+    async def _request(self, url, headers):
+        """Send a GET request for url and read the response headers.
+
+        A stale idle connection is replaced by a new one.
+        Return a tuple of (connection, response, headers message)
+        """
+        parsed_url = urlparse(url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        lines = ["GET {} HTTP/1.1".format(path), "Host: {}".format(parsed_url.netloc.rsplit("@", 1)[-1])]
+        lines.extend("{}: {}".format(key, value) for (key, value) in headers.items())
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        while True:
+            connection = await self._get_connection(parsed_url)
+            try:
+                connection.writer.write(request)
+                status_line, header_lines = await connection.read_headers(self.TIMEOUT)
+                break
+            except (ConnectionError, TruncatedDownloadError) as e:
+                connection.release(reusable=False)
+                if not connection.reused:
+                    raise
+                logger.debug("Idle connection to {} was closed: {}".format(parsed_url.netloc, e))
+            except BaseException:
+                connection.release(reusable=False)
+                raise
+
+        try:
+            version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            status = int(status)
+        except ValueError as e:
+            connection.release(reusable=False)
+            raise ConnectionError("Invalid HTTP status line: {}".format(status_line)) from e
+        message = http.client.parse_headers(BytesIO(b"".join(header_lines)))
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(message.items())
+        connection.prepare_body(version, status, response.headers)
+        return connection, response, message
+
+    async def _get_connection(self, parsed_url):
+        """Return an idle connection to parsed_url host or a new one, waiting for a free slot on this host"""
+        port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        key = (parsed_url.scheme, parsed_url.hostname, port)
+        slots = self._host_slots.setdefault(key, asyncio.Semaphore(self.MAX_CONNECTIONS_PER_HOST))
+        await slots.acquire()
+        idle_connections = self._idle_connections.setdefault(key, [])
+        while idle_connections:
+            connection = idle_connections.pop()
+            if not connection.reader.at_eof():
+                connection.reused = True
+                return connection
+            connection.close()
+
+        ssl_context = None
+        if parsed_url.scheme == "https":
+            # use the same certificates than requests
+            ssl_context = ssl.create_default_context(cafile=os.environ.get("REQUESTS_CA_BUNDLE") or
+                                                     os.environ.get("CURL_CA_BUNDLE") or
+                                                     requests.utils.DEFAULT_CA_BUNDLE_PATH)
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parsed_url.hostname, port, ssl=ssl_context,
+                                        limit=self.MAX_BLOCK_SIZE),
+                self.TIMEOUT)
+        except ssl.SSLError:
+            slots.release()
+            raise
+        except (OSError, asyncio.TimeoutError) as e:
+            slots.release()
+            raise ConnectionError("Couldn't connect to {}: {}".format(parsed_url.netloc, e)) from e
+        return _Connection(key, reader, writer, self)
+
+    @classmethod
+    def close_idle_connections(cls):
+        """Close all connections kept alive for next requests"""
+        def _close():
+            for idle_connections in cls._idle_connections.values():
+                while idle_connections:
+                    idle_connections.pop().close()
+        if cls._loop is not None:
+            cls._loop.call_soon_threadsafe(_close)
+
+    async def _read_content(self, download_item, connection, response, dest):
+        """Read response content from connection to dest, decoding it and reporting progress"""
+        url = download_item.url
+        content_size = int(response.headers.get('content-length', -1))
+        encoding = response.headers.get('content-encoding', '').lower()
+        decoder = None
+        if not download_item.ignore_encoding and encoding in self._DECODERS:
+            decoder = self._DECODERS[encoding]()
+
+        received = 0
+        self._report_progress(url, received, content_size)
+        block_size = self.BLOCK_SIZE
+        while True:
+            start = monotonic()
+            data = await connection.read_body(block_size, self.TIMEOUT)
+            if not data:
+                break
+            block_size = self._next_block_size(block_size, monotonic() - start)
+            if decoder:
+                try:
+                    data = decoder.decompress(data)
+                except zlib.error as e:
+                    raise requests.exceptions.ContentDecodingError("Can't decode {} content: {}".format(url, e))
+            dest.write(data)
+            received += len(data)
+            self._report_progress(url, received, content_size)
+        if decoder:
+            data = decoder.flush()
+            dest.write(data)
+            received += len(data)
+            self._report_progress(url, received, content_size)
+        connection.body_done()
+
+
+class _ProxyRequired(Exception):
+    """A redirect leads to an url which must go through a proxy"""
+    pass
+
+
+class _Connection:
+    """A keep-alive HTTP/1.1 connection, holding one of its host slots while in use"""
+
+    def __init__(self, key, reader, writer, download_center):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self._download_center = download_center
+        self._keep_alive = False
+        self._remaining = None
+        self._chunked = False
+        self._chunk_remaining = 0
+        self._body_done = False
+        self._released = False
+
+    async def _read(self, coroutine, timeout):
+        try:
+            return await asyncio.wait_for(coroutine, timeout)
+        except asyncio.IncompleteReadError as e:
+            raise TruncatedDownloadError("Connection closed by the server") from e
+        except asyncio.TimeoutError as e:
+            raise TimeoutError("No data received for {}s".format(timeout)) from e
+
+    async def read_headers(self, timeout):
+        """Return the status line and the header lines of the next response"""
+        status_line = await self._read(self.reader.readuntil(b"\n"), timeout)
+        header_lines = []
+        while True:
+            line = await self._read(self.reader.readuntil(b"\n"), timeout)
+            if line in (b"\r\n", b"\n"):
+                return status_line, header_lines
+            header_lines.append(line)
+
+    def prepare_body(self, version, status, headers):
+        """Setup body reading and connection reuse from response headers"""
+        connection_header = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            self._keep_alive = connection_header != "close"
+        else:
+            self._keep_alive = connection_header == "keep-alive"
+        if status < 200 or status in (204, 304):
+            self._remaining = 0
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            self._chunked = True
+        elif "content-length" in headers:
+            self._remaining = int(headers["content-length"])
+        else:
+            # content ends when the server closes the connection
+            self._keep_alive = False
+
+    async def read_body(self, size, timeout):
+        """Return the next size bytes of the response body, or less at the end of it"""
+        data = b""
+        while len(data) < size:
+            if self._chunked:
+                if not self._chunk_remaining:
+                    size_line = await self._read(self.reader.readuntil(b"\n"), timeout)
+                    try:
+                        self._chunk_remaining = int(size_line.split(b";", 1)[0].strip(), 16)
+                    except ValueError as e:
+                        raise requests.exceptions.ChunkedEncodingError("Invalid chunk size: {}".format(size_line)) \
+                            from e
+                    if not self._chunk_remaining:
+                        # skip the trailer
+                        while await self._read(self.reader.readuntil(b"\n"), timeout) not in (b"\r\n", b"\n"):
+                            pass
+                        self._chunked = False
+                        self._remaining = 0
+                        continue
+                chunk_size = min(size - len(data), self._chunk_remaining)
+                data += await self._read(self.reader.readexactly(chunk_size), timeout)
+                self._chunk_remaining -= chunk_size
+                if not self._chunk_remaining:
+                    await self._read(self.reader.readuntil(b"\n"), timeout)
+            elif self._remaining is not None:
+                if not self._remaining:
+                    break
+                chunk_size = min(size - len(data), self._remaining)
+                data += await self._read(self.reader.readexactly(chunk_size), timeout)
+                self._remaining -= chunk_size
+            else:
+                new_data = await self._read(self.reader.read(size - len(data)), timeout)
+                if not new_data:
+                    break
+                data += new_data
+        return data
+
+    async def discard_body(self):
+        """Read and drop the response body, so that the connection can be reused"""
+        while await self.read_body(self._download_center.MAX_BLOCK_SIZE, self._download_center.TIMEOUT):
+            pass
+        self.body_done()
+
+    def body_done(self):
+        self._body_done = True
+
+    def release(self, reusable=True):
+        """Give back the host slot, keeping the connection for a next request if possible"""
+        if self._released:
+            return
+        self._released = True
+        self._download_center._host_slots[self.key].release()
+        if reusable and self._keep_alive and self._body_done and not self.reader.at_eof():
+            idle_connections = self._download_center._idle_connections.setdefault(self.key, [])
+            if len(idle_connections) < self._download_center.MAX_CONNECTIONS_PER_HOST:
+                connection = _Connection(self.key, self.reader, self.writer, self._download_center)
+                idle_connections.append(connection)
+                return
+        self.close()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module handling offline bundles of downloaded content"""
+
+import hashlib
+from io import BytesIO
+import logging
+import os
+from threading import Lock
+from umake.network.download_center import DownloadCenter
+from umake.network.file_adapter import copy_file_content
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+class Bundle:
+    """A self-describing directory of downloaded content, indexed by the requested url.
+
+    A recording bundle stores any content going through the DownloadCenter (provider pages, metadata, checksum files
+    and artifacts). A replaying bundle serves them back without any network access."""
+
+    MANIFEST_FILENAME = "manifest.yaml"
+    FILES_DIRNAME = "files"
+
+    def __init__(self, path, recording=False):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.recording = recording
+        self._manifest_path = os.path.join(self.path, self.MANIFEST_FILENAME)
+        self._lock = Lock()
+        self._entries = {}
+        try:
+            with open(self._manifest_path) as f:
+                self._entries = yaml.safe_load(f)["entries"]
+        except FileNotFoundError:
+            if not recording:
+                raise BaseException("{} isn't a valid bundle: no {} found".format(self.path, self.MANIFEST_FILENAME))
+            os.makedirs(os.path.join(self.path, self.FILES_DIRNAME), exist_ok=True)
+            self._save_manifest()
+        except (yaml.YAMLError, KeyError, TypeError) as e:
+            raise BaseException("Invalid bundle manifest {}: {}".format(self._manifest_path, e))
+
+    def __contains__(self, url):
+        return url in self._entries
+
+    def fetch(self, url, dest, report):
+        """Copy bundle content for url to dest, calling report(current_size, total_size) on progress.
+
+        Return the final url as recorded."""
+        try:
+            entry = self._entries[url]
+        except KeyError:
+            raise BaseException("{} isn't part of the bundle {}".format(url, self.path))
+        logger.debug("Serving {} from bundle {}".format(url, self.path))
+        report(0, entry["size"])
+        with open(os.path.join(self.path, entry["file"]), 'rb') as f:
+            if not isinstance(dest, BytesIO):
+                copy_file_content(f, dest, report=lambda copied_size: report(copied_size, entry["size"]))
+            else:
+                dest.write(f.read())
+                report(entry["size"], entry["size"])
+        return entry["final_url"]
+
+    def record(self, url, final_url, fd):
+        """Store fd content for url in the bundle, with its final url"""
+        filename = "{}-{}".format(hashlib.sha1(url.encode()).hexdigest()[:16],
+                                  os.path.basename(final_url.split('?')[0]) or "index")
+        relpath = os.path.join(self.FILES_DIRNAME, filename)
+        dest_path = os.path.join(self.path, relpath)
+        fd.seek(0)
+        with open(dest_path + ".new", 'wb') as dest:
+            if not isinstance(fd, BytesIO):
+                size = copy_file_content(fd, dest)
+            else:
+                size = dest.write(fd.getvalue())
+        os.replace(dest_path + ".new", dest_path)
+        fd.seek(0)
+        sha256 = DownloadCenter.sha256_for_fd(fd)
+        fd.seek(0)
+        logger.debug("Recorded {} in bundle as {}".format(url, relpath))
+
+        with self._lock:
+            self._entries[url] = {"file": relpath, "final_url": final_url, "size": size,
+                                  "sha256": sha256}
+            self._save_manifest()
+
+    def _save_manifest(self):
+        """Save atomically the manifest, so that an interrupted export still leaves a valid bundle"""
+        with open(self._manifest_path + ".new", 'w') as f:
+            yaml.safe_dump({"entries": self._entries}, f, default_flow_style=False)
+        os.replace(self._manifest_path + ".new", self._manifest_path)
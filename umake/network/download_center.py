@@ -21,44 +21,110 @@
 
 from collections import namedtuple
 from concurrent import futures
-from contextlib import closing
+from contextlib import closing, suppress
 import hashlib
-from io import BytesIO
+from io import BytesIO, UnsupportedOperation
 import logging
+import mmap
 import os
+import random
 import tempfile
+from threading import Lock
+from time import monotonic, sleep, time
+from urllib.parse import unquote, urlparse
 
-import requests
-import requests.exceptions
-from umake.network.ftp_adapter import FTPAdapter
-from umake.tools import ChecksumType, root_lock
+from umake.network.rate_limiter import RateLimiter
+from umake.tools import ChecksumType, ConfigHandler, Tracer, root_lock
 
 logger = logging.getLogger(__name__)
 
 
-class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies'])):
+def _requests():
+    """Return the requests module.
+
+    requests and the adapters based on it are only imported once we download something, as they are slow to import
+    and not needed to only list frameworks (like on shell completion)"""
+    import requests
+    import requests.cookies
+    import requests.exceptions
+    return requests
+
+
+class TruncatedDownloadError(BaseException):
+    """The server closed the connection before sending the whole content"""
+    pass
+
+
+class RetryPolicy(namedtuple('RetryPolicy', ['attempts', 'backoff', 'max_backoff', 'jitter'])):
+    """How to retry a download failing with a transient error (connection issue, 5xx or truncated content).
+
+    attempts is the maximum number of attempts, 1 meaning no retry.
+    backoff is the delay in seconds before the first retry, doubled for each next one, up to max_backoff.
+    jitter is the maximum random ratio of the delay added to it, so that clients don't retry all at once."""
+    def __new__(cls, attempts=4, backoff=1, max_backoff=30, jitter=0.5):
+        return super().__new__(cls, attempts, backoff, max_backoff, jitter)
+
+
+class ChecksumUrl(namedtuple('ChecksumUrl', ['url', 'parse'])):
+    """Checksum value to fetch from url, in parallel with the content it checks.
+
+    To be used as the checksum_value of a tools.Checksum. parse returns the checksum value from the fetched text,
+    which defaults to its first word, like in sha*sum outputs."""
+    def __new__(cls, url, parse=lambda content: content.split()[0]):
+        return super().__new__(cls, url, parse)
+
+
+class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies',
+                                               'retry_policy'])):
     """An individual item to be downloaded and checked.
 
-    Checksum should be an instance of tools.Checksum, if provided.
+    Checksum should be an instance of tools.Checksum, if provided. Its value can be a ChecksumUrl.
     Headers should be a dictionary of HTTP headers, if provided.
-    Cookies should be a cookie dictionary, if provided."""
-    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None):
-        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies)
+    Cookies should be a cookie dictionary, if provided.
+    Retry_policy should be an instance of RetryPolicy, if provided. DownloadCenter.DEFAULT_RETRY_POLICY otherwise."""
+    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None, retry_policy=None):
+        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies, retry_policy)
 
 
 class DownloadCenter:
     """Read or download requested urls in separate threads."""
 
-    BLOCK_SIZE = 1024 * 8  # from urlretrieve code
-    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies"])
-
-    def __init__(self, urls, on_done, download=True, report=lambda x: None):
+    # read size adapts to the throughput, so that reading a block takes about BLOCK_DURATION seconds
+    BLOCK_SIZE = 64 * 1024
+    MAX_BLOCK_SIZE = 4 * 1024 * 1024
+    BLOCK_DURATION = 0.1
+    # minimum delay in seconds between two progress reports, so that we don't flood the main loop
+    REPORT_INTERVAL = 0.1
+    # Bundle to record downloads into or to serve them from, see umake.network.bundle
+    bundle = None
+    DEFAULT_RETRY_POLICY = RetryPolicy()
+    # timeout in seconds to connect and between two received chunks
+    TIMEOUT = 60
+    # after HOST_FAILURE_BUDGET consecutive transient failures on a host, stop trying it for HOST_COOLDOWN seconds
+    HOST_FAILURE_BUDGET = 5
+    HOST_COOLDOWN = 60
+    # bandwidth share of in memory downloads (pages, checksums…) compared to downloads to files
+    METADATA_WEIGHT = 8
+    _host_failures = {}
+    _host_failures_lock = Lock()
+    # in memory transfers in progress by url: (download item, mirrors used, futures of identical requests sharing it)
+    _in_flight = {}
+    _in_flight_lock = Lock()
+    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies", "retries"])
+
+    def __init__(self, urls, on_done, download=True, report=lambda x: None, use_mirrors=True):
         """Generate a threaded download machine.
 
         urls is a list of DownloadItems to download or read from.
         on_done is the callback that will be called once all those urls are downloaded.
         report, if not None, will be called once any download is in progress, reporting
         a dict of current download with current/size parameters
+        use_mirrors, if False, always downloads from the upstream urls, ignoring configured mirrors. Mirrors are only
+        used for downloads to files: pages and checksums read in memory are always downloaded from upstream, so that a
+        mirror can't serve both some content and the checksum validating it.
+
+        Urls requested several times are only downloaded once, as are in memory downloads of identical items already
+        in flight from another DownloadCenter. Shared transfers aren't reported.
 
         The callback will get a dictionary parameter like:
         {
@@ -68,7 +134,8 @@ class DownloadCenter:
                                error=string detailing the error which occurred (path and content would be empty),
                                fd=temporary file descriptor. close() will delete it from disk,
                                final_url=the final url, which may be different from the start if there were redirects,
-                               cookies=a dictionary of cookies after the request
+                               cookies=a dictionary of cookies after the request,
+                               retries=number of retried attempts, including on mirrors
                 )
         }
         """
@@ -77,33 +144,124 @@ class DownloadCenter:
         self._wired_report = report
         self._download_to_file = download
 
-        self._urls = urls
+        self._urls = []
+        for item in urls:
+            if item.url in (url_request.url for url_request in self._urls):
+                logger.debug("{} requested multiple times, only downloading it once".format(item.url))
+                continue
+            self._urls.append(item)
         self._downloaded_content = {}
+        # mirrors configuration is {"upstream url prefix": ["mirror url prefix", …]}, tried in order before upstream
+        self._mirrors = {}
+        if use_mirrors and download:
+            self._mirrors = (ConfigHandler().config or {}).get("mirrors") or {}
 
         self._download_progress = {}
-
-        executor = futures.ThreadPoolExecutor(max_workers=len(urls))
+        self._report_lock = Lock()
+        self._last_report_time = 0
+        self._retries = {}
+        # ChecksumUrl: future of its checksum value
+        self._checksums = {}
+
+        self._start_checksum_downloads()
+        self._start_downloads()
+
+    def _start_checksum_downloads(self):
+        """Start fetching checksums given as urls, so that they are ready once the content they check is"""
+        checksum_urls = set(item.checksum.checksum_value for item in self._urls
+                            if item.checksum and isinstance(item.checksum.checksum_value, ChecksumUrl))
+        if not checksum_urls:
+            return
+        for checksum_url in checksum_urls:
+            self._checksums[checksum_url] = futures.Future()
+
+        def checksums_downloaded(results):
+            for checksum_url in checksum_urls:
+                result = results[checksum_url.url]
+                try:
+                    if result.error:
+                        raise BaseException(result.error)
+                    with closing(result.buffer):
+                        self._checksums[checksum_url].set_result(checksum_url.parse(result.buffer.read().decode()))
+                except BaseException as e:
+                    self._checksums[checksum_url].set_exception(
+                        BaseException("Couldn't get checksum from {}: {}".format(checksum_url.url, e)))
+
+        # without reporting progress of the checksums
+        type(self)([DownloadItem(url) for url in set(checksum_url.url for checksum_url in checksum_urls)],
+                   on_done=checksums_downloaded, download=False, use_mirrors=False)
+
+    def _start_downloads(self):
+        """Start fetching all urls, each in its own thread"""
+        executor = futures.ThreadPoolExecutor(max_workers=len(self._urls))
         for url_request in self._urls:
-            # grab the md5sum if any
-            # switch between inline memory and temp file
-            if download:
-                # Named because shutils and tarfile library needs a .name property
-                # http://bugs.python.org/issue21044
-                # also, ensure we keep the same suffix
-                path, ext = os.path.splitext(url_request.url)
-                # We want to ensure that we don't create files as root
-                root_lock.acquire()
-                dest = tempfile.NamedTemporaryFile(suffix=ext)
-                root_lock.release()
-                logger.info("Start downloading {} to a temp file".format(url_request))
-            else:
-                dest = BytesIO()
-                logger.info("Start downloading {} in memory".format(url_request))
+            if self._join_in_flight(url_request):
+                continue
+            dest = self._create_dest(url_request)
             future = executor.submit(self._fetch, url_request, dest)
-            future.tag_url = url_request.url
-            future.tag_download = download
-            future.tag_dest = dest
-            future.add_done_callback(self._one_done)
+            self._share_in_flight(future, url_request)
+            self._tag_future(future, url_request, dest)
+
+    def _create_dest(self, url_request):
+        """Return the file object url_request content will be written to"""
+        # switch between inline memory and temp file
+        if self._download_to_file:
+            # Named because shutils and tarfile library needs a .name property
+            # http://bugs.python.org/issue21044
+            # also, ensure we keep the same suffix
+            path, ext = os.path.splitext(url_request.url)
+            # We want to ensure that we don't create files as root
+            root_lock.acquire()
+            dest = tempfile.NamedTemporaryFile(suffix=ext)
+            root_lock.release()
+            logger.info("Start downloading {} to a temp file".format(url_request))
+        else:
+            dest = BytesIO()
+            logger.info("Start downloading {} in memory".format(url_request))
+        return dest
+
+    def _tag_future(self, future, url_request, dest):
+        """Attach url_request details to future and deliver its result once done"""
+        future.tag_url = url_request.url
+        future.tag_download = self._download_to_file
+        future.tag_dest = dest
+        future.add_done_callback(self._one_done)
+
+    def _join_in_flight(self, url_request):
+        """Share the transfer of an identical in memory request in flight, if any. Return True if we joined it"""
+        if self._download_to_file:
+            return False
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(url_request.url)
+            # don't share transfers of checksums downloaded from upstream with transfers from mirrors
+            if in_flight is None or in_flight[0] != url_request or in_flight[1] != self._mirrors:
+                return False
+            future = futures.Future()
+            in_flight[2].append(future)
+        logger.debug("Sharing the transfer of {} in flight".format(url_request.url))
+        self._tag_future(future, url_request, BytesIO())
+        return True
+
+    def _share_in_flight(self, future, url_request):
+        """Let identical in memory requests join future until it's done, each getting its own copy of the content"""
+        if self._download_to_file:
+            return
+        in_flight = (url_request, self._mirrors, [])
+        with self._in_flight_lock:
+            self._in_flight[url_request.url] = in_flight
+
+        def share(future):
+            with self._in_flight_lock:
+                if self._in_flight.get(url_request.url) is in_flight:
+                    del self._in_flight[url_request.url]
+            # called before our own done callback, so the content is still available for copies
+            for shared_future in in_flight[2]:
+                if future.exception():
+                    shared_future.set_exception(future.exception())
+                else:
+                    fd, final_url, cookies = future.result()
+                    shared_future.set_result((BytesIO(fd.getvalue()), final_url, cookies))
+        future.add_done_callback(share)
 
     def _fetch(self, download_item, dest):
         """Get an url content and close the connexion.
@@ -113,64 +271,289 @@ class DownloadCenter:
         """
         url = download_item.url
         checksum = download_item.checksum
-        headers = download_item.headers or {}
-        cookies = download_item.cookies
-
-        def _report(block_no, block_size, total_size):
-            current_size = int(block_no * block_size)
-            if total_size != -1:
-                current_size = min(current_size, total_size)
-            self._download_progress[url] = {"current": current_size, "size": total_size}
-            logger.debug("Deliver download update: {} of {}".format(self._download_progress, total_size))
+
+        def _report(current_size, total_size):
+            self._report_progress(url, current_size, total_size)
+
+        with Tracer().span("fetch", "download", url=url) as span_args:
+            if self.bundle and not self.bundle.recording:
+                final_url = self.bundle.fetch(url, dest, _report)
+                cookies = _requests().cookies.RequestsCookieJar()
+                self._check_checksum(url, checksum, dest)
+            else:
+                mirror_urls = self._get_mirror_urls(url)
+                for candidate_url in mirror_urls + [url]:
+                    try:
+                        final_url, cookies = self._fetch_from_network(url, download_item._replace(url=candidate_url),
+                                                                      dest, _report)
+                        # checksums are the upstream ones, so that we catch outdated or corrupted mirrors
+                        self._check_checksum(url, checksum, dest)
+                        break
+                    except BaseException as e:
+                        if candidate_url == url:
+                            raise
+                        logger.warning("Couldn't download {} from mirror {}, trying next location: {}".format(
+                            url, candidate_url, e))
+                        dest.seek(0)
+                        dest.truncate()
+
+            if self.bundle and self.bundle.recording:
+                self.bundle.record(url, final_url, dest)
+            # the content size may be unknown, ensure the last progress is delivered
+            if self._download_progress.get(url, {}).get("size") == -1:
+                self._deliver_report(force=True)
+            span_args["bytes"] = dest.seek(0, os.SEEK_END)
+            span_args["retries"] = self._retries.get(url, 0)
+        return dest, final_url, cookies
+
+    def _report_progress(self, url, current_size, total_size):
+        """Update url download progress and deliver it if needed"""
+        if total_size != -1:
+            current_size = min(current_size, total_size)
+        is_new = url not in self._download_progress
+        self._download_progress[url] = {"current": current_size, "size": total_size}
+        # first and last reports are always delivered
+        self._deliver_report(force=is_new or current_size == total_size)
+
+    def _deliver_report(self, force=False):
+        """Deliver current progress of all downloads to the report callback, at most every REPORT_INTERVAL"""
+        with self._report_lock:
+            now = monotonic()
+            if not force and now - self._last_report_time < self.REPORT_INTERVAL:
+                return
+            self._last_report_time = now
+            logger.debug("Deliver download update: {}".format(self._download_progress))
             self._wired_report(self._download_progress)
 
+    def _get_mirror_urls(self, url):
+        """Return the list of mirror urls to try for url, using the longest matching upstream prefix"""
+        prefix = max((prefix for prefix in self._mirrors if url.startswith(prefix)), key=len, default=None)
+        if prefix is None:
+            return []
+        mirror_prefixes = self._mirrors[prefix]
+        if isinstance(mirror_prefixes, str):
+            mirror_prefixes = [mirror_prefixes]
+        return [mirror_prefix + url[len(prefix):] for mirror_prefix in mirror_prefixes]
+
+    def _check_checksum(self, url, checksum, dest):
+        """Check dest content against checksum, raising on mismatch"""
+        if not checksum or not checksum.checksum_value:
+            return
+        checksum_type = checksum.checksum_type
+        checksum_value = checksum.checksum_value
+        if isinstance(checksum_value, ChecksumUrl):
+            # wait for it to be fetched in parallel
+            checksum_value = self._checksums[checksum_value].result()
+        logger.debug("Checking checksum ({}).".format(checksum_type.name))
+        dest.seek(0)
+
+        with Tracer().span("checksum", "download", url=url, type=checksum_type.name) as span_args:
+            if checksum_type is ChecksumType.sha1:
+                actual_checksum = self.sha1_for_fd(dest)
+            elif checksum_type is ChecksumType.md5:
+                actual_checksum = self.md5_for_fd(dest)
+            elif checksum_type is ChecksumType.sha256:
+                actual_checksum = self.sha256_for_fd(dest)
+            elif checksum_type is ChecksumType.sha512:
+                actual_checksum = self.sha512_for_fd(dest)
+            else:
+                msg = "Unsupported checksum type: {}.".format(checksum_type)
+                raise BaseException(msg)
+            span_args["bytes"] = dest.tell()
+
+        logger.debug("Expected: {}, actual: {}.".format(checksum_value,
+                                                        actual_checksum))
+        if checksum_value != actual_checksum:
+            msg = ("The checksum of {} doesn't match. Corrupted download? "
+                   "Aborting.").format(url)
+            raise BaseException(msg)
+
+    def _fetch_from_network(self, url, download_item, dest, report):
+        """Download an url content to dest, retrying transient errors following the item retry policy.
+
+        url is the requested url, which may be different from download_item one when downloading from a mirror.
+        Return a tuple of (final_url, cookies)
+        """
+        if urlparse(download_item.url).scheme == "file" and self._download_to_file:
+            return self._fetch_local_file(download_item, dest, report)
+
+        policy = download_item.retry_policy or self.DEFAULT_RETRY_POLICY
+        host = urlparse(download_item.url).netloc
+        # validator of the partially downloaded content if the server supports resuming it
+        transfer = {"validator": None}
+        attempt = 1
+        while True:
+            self._check_host_budget(host)
+            if attempt > 1:
+                self._retries[url] = self._retries.get(url, 0) + 1
+            try:
+                result = self._fetch_once(download_item, dest, report, transfer)
+                self._record_host_result(host, success=True)
+                return result
+            except BaseException as e:
+                if not self._is_transient_error(e):
+                    raise
+                self._record_host_result(host, success=False)
+                if attempt >= policy.attempts:
+                    raise
+                delay = min(policy.backoff * 2 ** (attempt - 1), policy.max_backoff)
+                delay += random.uniform(0, delay * policy.jitter)
+                with suppress(AttributeError, KeyError, TypeError, ValueError):
+                    # honor server request (429, 503), but still within our own limit
+                    delay = max(delay, min(float(e.response.headers["retry-after"]), policy.max_backoff))
+                logger.warning("Downloading {} failed (attempt {}/{}), retrying in {:.1f}s: {}".format(
+                    download_item.url, attempt, policy.attempts, delay, e))
+                attempt += 1
+                sleep(delay)
+
+    def _fetch_local_file(self, download_item, dest, report):
+        """Copy a local file to dest without going through Python buffers.
+
+        Return a tuple of (final_url, cookies)
+        """
+        from umake.network.file_adapter import copy_file_content
+        path = unquote(urlparse(download_item.url).path)
+        try:
+            with open(path, 'rb') as src:
+                size = os.fstat(src.fileno()).st_size
+                report(0, size)
+                copy_file_content(src, dest, report=lambda copied_size: report(copied_size, size))
+        except FileNotFoundError as exc:
+            raise BaseException("{} doesn't exist".format(path)) from exc
+        return download_item.url, _requests().cookies.RequestsCookieJar()
+
+    def _fetch_once(self, download_item, dest, report, transfer):
+        """Try to download an url content to dest once, resuming it if possible.
+
+        transfer keeps the state between attempts to resume partial content.
+        Return a tuple of (final_url, cookies)
+        """
+        headers = dict(download_item.headers or {})
+        offset = dest.tell()
+        if offset and transfer["validator"]:
+            headers["Range"] = "bytes={}-".format(offset)
+            headers["If-Range"] = transfer["validator"]
+            logger.debug("Resuming {} from byte {}".format(download_item.url, offset))
+
+        requests = _requests()
+        from umake.network.file_adapter import FileAdapter
+        from umake.network.ftp_adapter import FTPAdapter
+
         # Requests support redirection out of the box.
         # Create a session so we can mount our own FTP adapter.
         session = requests.Session()
         session.mount('ftp://', FTPAdapter())
+        session.mount('file://', FileAdapter())
         try:
-            with closing(session.get(url, stream=True, headers=headers, cookies=cookies)) as r:
+            with closing(session.get(download_item.url, stream=True, headers=headers, cookies=download_item.cookies,
+                                     timeout=self.TIMEOUT)) as r:
                 r.raise_for_status()
                 content_size = int(r.headers.get('content-length', -1))
+                if r.status_code == 206:
+                    if content_size != -1:
+                        content_size += offset
+                else:
+                    # the server sent the whole content again
+                    offset = 0
+                    dest.seek(0)
+                    dest.truncate()
+                # we can only resume raw content, unchanged since the first attempt
+                validator = r.headers.get('etag')
+                if not validator or validator.startswith('W/'):
+                    validator = r.headers.get('last-modified')
+                encoded = r.headers.get('content-encoding') and not download_item.ignore_encoding
+                if r.headers.get('accept-ranges') == 'bytes' and not encoded:
+                    transfer["validator"] = validator
+                else:
+                    transfer["validator"] = None
+
+                # let the filesystem allocate the file contiguously
+                if not encoded and content_size > 0 and self._download_to_file:
+                    with suppress(OSError):
+                        os.posix_fallocate(dest.fileno(), 0, content_size)
 
                 # read in chunk and send report updates
-                block_num = 0
-                _report(block_num, self.BLOCK_SIZE, content_size)
-                for data in r.raw.stream(amt=self.BLOCK_SIZE, decode_content=not download_item.ignore_encoding):
-                    dest.write(data)
-                    block_num += 1
-                    _report(block_num, self.BLOCK_SIZE, content_size)
+                received = offset
+                report(received, content_size)
+                weight = 1 if self._download_to_file else self.METADATA_WEIGHT
+                with RateLimiter().stream(urlparse(download_item.url).hostname, weight) as throttle:
+                    for data in self._iter_content(r.raw, decode_content=not download_item.ignore_encoding):
+                        dest.write(data)
+                        received += len(data)
+                        report(received, content_size)
+                        throttle.consume(len(data))
+                # drop any preallocated space we didn't fill
+                dest.truncate()
+                if not encoded and content_size != -1 and received < content_size:
+                    raise TruncatedDownloadError("Received {} bytes out of {}".format(received, content_size))
                 final_url = r.url
                 cookies = session.cookies
         except requests.exceptions.InvalidSchema as exc:
             # Wrap this for a nicer error message.
             raise BaseException("Protocol not supported.") from exc
+        return final_url, cookies
+
+    def _iter_content(self, raw, decode_content):
+        """Yield content from raw, growing or shrinking blocks so that reading one takes about BLOCK_DURATION"""
+        # our FTP adapter raw stream can only be streamed: only use the initial block size there
+        if not hasattr(raw, "read"):
+            yield from raw.stream(amt=self.BLOCK_SIZE, decode_content=decode_content)
+            return
+        # read blocks from the same response, as dropping a stream() generator closes chunked responses
+        block_size = self.BLOCK_SIZE
+        while True:
+            start = monotonic()
+            data = raw.read(block_size, decode_content=decode_content)
+            duration = monotonic() - start
+            if not data:
+                # decoders can buffer some content without returning anything yet
+                if raw.closed:
+                    return
+                continue
+            yield data
+            block_size = self._next_block_size(block_size, duration)
+
+    def _next_block_size(self, block_size, duration):
+        """Return the size of the next block to read, given that reading one of block_size took duration"""
+        new_block_size = block_size
+        if duration < self.BLOCK_DURATION / 2:
+            new_block_size = min(block_size * 2, self.MAX_BLOCK_SIZE)
+        elif duration > self.BLOCK_DURATION * 2:
+            new_block_size = max(block_size // 2, self.BLOCK_SIZE)
+        if new_block_size != block_size:
+            logger.debug("Reading blocks of {} bytes".format(new_block_size))
+        return new_block_size
+
+    @staticmethod
+    def _is_transient_error(error):
+        """Return True if retrying later has a chance to succeed"""
+        import urllib3.exceptions
+        exceptions = _requests().exceptions
+        if isinstance(error, exceptions.SSLError):
+            return False
+        if isinstance(error, exceptions.HTTPError):
+            return error.response is not None and (error.response.status_code >= 500 or
+                                                   error.response.status_code == 429)
+        return isinstance(error, (exceptions.ConnectionError, exceptions.Timeout,
+                                  exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError,
+                                  TruncatedDownloadError, ConnectionError, TimeoutError))
 
-        if checksum and checksum.checksum_value:
-            checksum_type = checksum.checksum_type
-            checksum_value = checksum.checksum_value
-            logger.debug("Checking checksum ({}).".format(checksum_type.name))
-            dest.seek(0)
+    @classmethod
+    def _check_host_budget(cls, host):
+        """Raise if host failed too much lately, so that we don't hammer a dead host"""
+        with cls._host_failures_lock:
+            failures, last_failure = cls._host_failures.get(host, (0, 0))
+        if failures >= cls.HOST_FAILURE_BUDGET and time() - last_failure < cls.HOST_COOLDOWN:
+            raise BaseException("{} failed {} times in a row, not trying it again for now".format(host, failures))
 
-            if checksum_type is ChecksumType.sha1:
-                actual_checksum = self.sha1_for_fd(dest)
-            elif checksum_type is ChecksumType.md5:
-                actual_checksum = self.md5_for_fd(dest)
-            elif checksum_type is ChecksumType.sha256:
-                actual_checksum = self.sha256_for_fd(dest)
-            elif checksum_type is ChecksumType.sha512:
-                actual_checksum = self.sha512_for_fd(dest)
+    @classmethod
+    def _record_host_result(cls, host, success):
+        with cls._host_failures_lock:
+            if success:
+                cls._host_failures.pop(host, None)
             else:
-                msg = "Unsupported checksum type: {}.".format(checksum_type)
-                raise BaseException(msg)
-
-            logger.debug("Expected: {}, actual: {}.".format(checksum_value,
-                                                            actual_checksum))
-            if checksum_value != actual_checksum:
-                msg = ("The checksum of {} doesn't match. Corrupted download? "
-                       "Aborting.").format(url)
-                raise BaseException(msg)
-        return dest, final_url, cookies
+                failures, last_failure = cls._host_failures.get(host, (0, 0))
+                cls._host_failures[host] = (failures + 1, time())
 
     def _one_done(self, future):
         """Callback that will be called once the download finishes.
@@ -181,17 +564,20 @@ class DownloadCenter:
         if future.exception():
             logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
             result = self.DownloadResult(buffer=None, error=str(future.exception()), fd=None, final_url=None,
-                                         cookies=None)
+                                         cookies=None, retries=self._retries.get(future.tag_url, 0))
             # cleaned unusable temp file as something bad happened
             future.tag_dest.close()
         else:
             logger.info("{} download finished".format(future.tag_url))
             fd, final_url, cookies = future.result()
             fd.seek(0)
+            retries = self._retries.get(future.tag_url, 0)
             if future.tag_download:
-                result = self.DownloadResult(buffer=None, error=None, fd=fd, final_url=final_url, cookies=cookies)
+                result = self.DownloadResult(buffer=None, error=None, fd=fd, final_url=final_url, cookies=cookies,
+                                             retries=retries)
             else:
-                result = self.DownloadResult(buffer=fd, error=None, fd=None, final_url=final_url, cookies=cookies)
+                result = self.DownloadResult(buffer=fd, error=None, fd=None, final_url=final_url, cookies=cookies,
+                                             retries=retries)
         self._downloaded_content[future.tag_url] = result
         if len(self._urls) == len(self._downloaded_content):
             self._done()
@@ -207,6 +593,24 @@ class DownloadCenter:
     @classmethod
     def _checksum_for_fd(cls, algorithm, f, block_size=2 ** 20):
         checksum = algorithm()
+        # hash in place whatever is already in memory or can be mapped, from the current position
+        if isinstance(f, BytesIO):
+            with f.getbuffer() as content, content[f.tell():] as content_to_hash:
+                checksum.update(content_to_hash)
+            f.seek(0, os.SEEK_END)
+            return checksum.hexdigest()
+        try:
+            f.flush()
+            position = f.tell()
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, UnsupportedOperation):
+            # not a file or an empty one, which can't be mapped
+            pass
+        else:
+            with content, memoryview(content) as view, view[position:] as content_to_hash:
+                checksum.update(content_to_hash)
+            f.seek(0, os.SEEK_END)
+            return checksum.hexdigest()
         while True:
             data = f.read(block_size)
             if not data:
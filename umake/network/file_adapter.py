@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Tin Tvrtković
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Local file support for requests, and kernel side file copies"""
+
+import errno
+import os
+import urllib.parse
+from requests import Response
+from requests.adapters import BaseAdapter
+
+
+def copy_file_content(src, dest, report=lambda copied_size: None, block_size=64 * 1024 * 1024):
+    """Copy src file content from its current position to dest current position.
+
+    The copy is done in the kernel (copy_file_range, which can even share extents on some filesystems, or sendfile)
+    whenever possible, without going through Python buffers.
+    report is called with the copied size after each block. Return the copied size."""
+    src_fd, dest_fd = src.fileno(), dest.fileno()
+    src_offset, dest_offset = src.tell(), dest.tell()
+    dest.flush()
+    methods = ["copy_file_range", "sendfile", "pread"]
+    if not hasattr(os, "copy_file_range"):
+        methods.remove("copy_file_range")
+    copied = 0
+    while True:
+        try:
+            if methods[0] == "copy_file_range":
+                size = os.copy_file_range(src_fd, dest_fd, block_size, src_offset + copied, dest_offset + copied)
+            elif methods[0] == "sendfile":
+                os.lseek(dest_fd, dest_offset + copied, os.SEEK_SET)
+                size = os.sendfile(dest_fd, src_fd, src_offset + copied, block_size)
+            else:
+                size = os.pwrite(dest_fd, os.pread(src_fd, block_size, src_offset + copied), dest_offset + copied)
+        except OSError as e:
+            # not supported between those files or filesystems, try next method
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF) and \
+                    len(methods) > 1:
+                methods.pop(0)
+                continue
+            raise
+        if not size:
+            break
+        copied += size
+        report(copied)
+    src.seek(src_offset + copied)
+    dest.seek(dest_offset + copied)
+    return copied
+
+
+class FileAdapter(BaseAdapter):
+    """A file:// adapter for requests. Supports streaming GETs and not much else."""
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        path = urllib.parse.unquote(urllib.parse.urlparse(request.url).path)
+
+        resp = Response()
+        resp.url = request.url
+        resp.request = request
+
+        try:
+            f = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            resp.status_code = 404
+            return resp
+        except PermissionError:
+            resp.status_code = 403
+            return resp
+
+        resp.status_code = 200
+        resp.raw = LocalFileRaw(f)
+        resp.headers['content-length'] = str(os.fstat(f.fileno()).st_size)
+        resp.close = lambda: f.close()
+        return resp
+
+    def close(self):
+        pass
+
+
+class LocalFileRaw:
+    """Raw response content of a local file, compatible with what DownloadCenter uses of urllib3 responses"""
+
+    def __init__(self, f):
+        self.file = f
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def read(self, amt=None, decode_content=False):
+        data = self.file.read(amt)
+        if not data:
+            self.file.close()
+        return data
+
+    def stream(self, amt=64 * 1024, decode_content=False):
+        yield from iter(lambda: self.file.read(amt), b'')
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module sharing the available bandwidth between all downloads"""
+
+import logging
+import re
+from threading import Lock
+from time import monotonic, sleep
+from umake.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+_RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(rate):
+    """Return a rate in bytes per second from an int or a string like "500K", "1.5M" or "2MB"."""
+    if isinstance(rate, (int, float)):
+        return int(rate)
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*$', rate, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid rate: {}".format(rate))
+    return int(float(match.group(1)) * _RATE_UNITS[match.group(2).upper()])
+
+
+class RateLimiter(metaclass=Singleton):
+    """Share the bandwidth between all download streams.
+
+    Every stream currently downloading gets a share of the global and of its host rate limits, proportional to its
+    weight among all other streams. Each stream then paces itself to its share, so that lightweight, high weight
+    downloads (like metadata) aren't stuck behind bigger ones.
+    Downloads which can't pace themselves, like apt's, reserve instead a fixed part of the global limit, which
+    streams don't share."""
+
+    def __init__(self):
+        config = ConfigHandler().config or {}
+        self.max_rate = None
+        self.max_rate_per_host = {}
+        try:
+            if config.get("max_rate"):
+                self.max_rate = parse_rate(config["max_rate"])
+            self.max_rate_per_host = {host: parse_rate(rate)
+                                      for (host, rate) in (config.get("max_rate_per_host") or {}).items()}
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.error("Invalid rate limit configuration: {}".format(e))
+        self._streams = set()
+        self._reservations = set()
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.max_rate or self.max_rate_per_host)
+
+    def stream(self, host, weight=1):
+        """Return a context manager registering a download stream for host while it's active"""
+        return ThrottledStream(self, host, weight)
+
+    def reserve(self, weight=1):
+        """Return a context manager reserving a share of the global rate limit while it's active.
+
+        The reserved rate is set when entering it, as the share of weight among all active streams, and is None
+        if there is no global limit."""
+        return Reservation(self, weight)
+
+    def _reserve(self, reservation):
+        with self._lock:
+            if not self.max_rate:
+                return None
+            rate = self._available_rate() * reservation.weight / (reservation.weight +
+                                                                  sum(s.weight for s in self._streams))
+            self._reservations.add((reservation, rate))
+            return rate
+
+    def _release(self, reservation):
+        with self._lock:
+            self._reservations = {(r, rate) for (r, rate) in self._reservations if r is not reservation}
+
+    def _available_rate(self):
+        """Part of the global limit which isn't reserved"""
+        return self.max_rate - sum(rate for (r, rate) in self._reservations)
+
+    def _register(self, stream):
+        with self._lock:
+            self._streams.add(stream)
+
+    def _unregister(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def get_share(self, stream):
+        """Return the rate in bytes per second stream is allowed to use now, None if unlimited"""
+        share = None
+        with self._lock:
+            if self.max_rate:
+                share = self._available_rate() * stream.weight / sum(s.weight for s in self._streams)
+            host_rate = self.max_rate_per_host.get(stream.host)
+            if host_rate:
+                host_share = host_rate * stream.weight / sum(s.weight for s in self._streams if s.host == stream.host)
+                share = host_share if share is None else min(share, host_share)
+        return share
+
+
+class ThrottledStream:
+    """A download stream pacing itself to its share of the bandwidth"""
+
+    def __init__(self, limiter, host, weight):
+        self.host = host
+        self.weight = weight
+        self._limiter = limiter
+        self._next_time = None
+
+    def __enter__(self):
+        self._limiter._register(self)
+        self._next_time = monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self._limiter._unregister(self)
+
+    def consume(self, size):
+        """Account size received bytes, waiting until the stream is allowed to receive more"""
+        if not self._limiter.enabled:
+            return
+        share = self._limiter.get_share(self)
+        if not share:
+            return
+        now = monotonic()
+        # don't accumulate credit while the network was slower than our share
+        self._next_time = max(self._next_time + size / share, now)
+        if self._next_time > now:
+            sleep(self._next_time - now)
+
+
+class Reservation:
+    """A fixed share of the global bandwidth, for a download which is paced by someone else"""
+
+    def __init__(self, limiter, weight):
+        self.weight = weight
+        self.rate = None
+        self._limiter = limiter
+
+    def __enter__(self):
+        self.rate = self._limiter._reserve(self)
+        return self.rate
+
+    def __exit__(self, *args):
+        self._limiter._release(self)
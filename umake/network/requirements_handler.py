@@ -19,33 +19,71 @@
 
 """Module delivering a DownloadCenter to download in parallel multiple requests"""
 
-import apt
-import apt.progress
-import apt.progress.base
 from collections import namedtuple
 from concurrent import futures
 from contextlib import suppress
 import fcntl
 import logging
 import os
+import struct
 import tempfile
 import time
-from umake.tools import Singleton, add_foreign_arch, get_foreign_archs, get_current_arch, as_root
+from umake import settings
+from umake.network.rate_limiter import RateLimiter
+from umake.tools import ConfigHandler, Singleton, Tracer, add_foreign_arch, get_foreign_archs, get_current_arch, \
+    as_root
 
 logger = logging.getLogger(__name__)
 
+# struct flock: l_type, l_whence, l_start, l_len, l_pid
+_FLOCK_FORMAT = "hhqqi"
+
+
+def get_lock_holder(path):
+    """Return the pid of the process holding a fcntl lock on path, None if there is none
+
+    The pid is -1 for open file description locks. Raise PermissionError if we can't open the lock file to tell, as
+    apt and dpkg ones are only readable by root."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        lock = fcntl.fcntl(fd, fcntl.F_GETLK, struct.pack(_FLOCK_FORMAT, fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0))
+    finally:
+        os.close(fd)
+    lock_type, _, _, _, pid = struct.unpack(_FLOCK_FORMAT, lock)
+    return None if lock_type == fcntl.F_UNLCK else pid
+
 
 class RequirementsHandler(object, metaclass=Singleton):
     """Handle platform requirements"""
 
-    STATUS_DOWNLOADING, STATUS_INSTALLING = range(2)
+    STATUS_DOWNLOADING, STATUS_INSTALLING, STATUS_WAITING_LOCK = range(3)
+
+    # how often we check if apt and dpkg locks were released, in seconds
+    LOCK_POLL_INTERVAL = 0.5
+    # first and maximum delays before loading apt cache again when we can't tell what prevents it, in seconds
+    CACHE_RETRY_DELAY = 1
+    CACHE_MAX_RETRY_DELAY = 30
 
     RequirementsResult = namedtuple("RequirementsResult", ["bucket", "error"])
 
     def __init__(self):
+        # apt is slow to import and unneeded for shell completion: only load it once requirements are handled
+        import apt
         logger.info("Create a new apt cache")
         self.cache = apt.Cache()
         self.executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.apt_lock_timeout = settings.APT_LOCK_TIMEOUT
+        config = ConfigHandler().config or {}
+        with suppress(KeyError):
+            try:
+                self.apt_lock_timeout = float(config["apt_lock_timeout"])
+            except (ValueError, TypeError) as e:
+                logger.error("Invalid apt lock timeout configuration: {}".format(e))
+        # progress callback of the bucket being installed
+        self._progress_callback = None
 
     def is_bucket_installed(self, bucket):
         """Check if the bucket is installed
@@ -142,8 +180,13 @@ class RequirementsHandler(object, metaclass=Singleton):
 
     def _really_install_bucket(self, current_bucket):
         """Really install current bucket and bind signals"""
+        with Tracer().span("install_bucket", "requirements", bucket=current_bucket["bucket"]):
+            return self._install_bucket(current_bucket)
+
+    def _install_bucket(self, current_bucket):
         bucket = current_bucket["bucket"]
         logger.debug("Starting {} installation".format(bucket))
+        self._progress_callback = current_bucket["progress_callback"]
 
         # exchange file output for apt and dpkg after the fork() call (open it empty)
         self.apt_fd = tempfile.NamedTemporaryFile(delete=False)
@@ -184,16 +227,23 @@ class RequirementsHandler(object, metaclass=Singleton):
                 message = "Can't mark for install {}: {}".format(pkg_name, msg)
                 raise BaseException(message)
 
+        from umake.network.apt_progress import FetchProgress, InstallProgress
         # this can raise on installedArchives() exception if the commit() fails
-        with as_root():
-            self.cache.commit(fetch_progress=self._FetchProgress(current_bucket,
-                                                                 self.STATUS_DOWNLOADING,
-                                                                 current_bucket["progress_callback"]),
-                              install_progress=self._InstallProgress(current_bucket,
-                                                                     self.STATUS_INSTALLING,
-                                                                     current_bucket["progress_callback"],
-                                                                     self._force_reload_apt_cache,
-                                                                     self.apt_fd.name))
+        with as_root(), RateLimiter().reserve() as apt_rate, \
+                Tracer().span("apt_commit", "requirements", download_bytes=self.cache.required_download):
+            # apt paces itself to its share of the global bandwidth limit, our own downloads share the rest
+            if apt_rate:
+                import apt_pkg
+                for method in ("http", "https"):
+                    apt_pkg.config.set("Acquire::{}::Dl-Limit".format(method), str(max(1, int(apt_rate) // 1024)))
+            self.cache.commit(fetch_progress=FetchProgress(current_bucket,
+                                                           self.STATUS_DOWNLOADING,
+                                                           current_bucket["progress_callback"]),
+                              install_progress=InstallProgress(current_bucket,
+                                                               self.STATUS_INSTALLING,
+                                                               current_bucket["progress_callback"],
+                                                               self._force_reload_apt_cache,
+                                                               self.apt_fd.name))
 
         return True
 
@@ -215,101 +265,62 @@ class RequirementsHandler(object, metaclass=Singleton):
         future.tag_bucket["installed_callback"](result)
 
     def _force_reload_apt_cache(self):
-        """Loop on loading apt cache in case something else is updating"""
-        try:
-            self.cache.open()
-        except SystemError:
-            time.sleep(1)
-            self._force_reload_apt_cache()
-
-    class _FetchProgress(apt.progress.base.AcquireProgress):
-        """Progress handler for downloading a bucket"""
-        def __init__(self, bucket, status, progress_callback,):
-            apt.progress.base.AcquireProgress.__init__(self)
-            self._bucket = bucket
-            self._status = status
-            self._progress_callback = progress_callback
-
-        def pulse(self, owner):
-            percent = (((self.current_bytes + self.current_items) * 100.0) /
-                       float(self.total_bytes + self.total_items))
-            logger.debug("{} download update: {}% of {}".format(self._bucket['bucket'], percent, self.total_bytes))
-            report = {"step": self._status, "percentage": percent, "pkg_size_download": self.total_bytes}
-            self._progress_callback(report)
-
-    class _InstallProgress(apt.progress.base.InstallProgress):
-        """Progress handler for installing a bucket"""
-        def __init__(self, bucket, status, progress_callback, force_load_apt_cache, exchange_filename):
-            apt.progress.base.InstallProgress.__init__(self)
-            self._bucket = bucket
-            self._status = status
-            self._progress_callback = progress_callback
-            self._force_reload_apt_cache = force_load_apt_cache
-            self._exchange_filename = exchange_filename
-
-        def error(self, pkg, msg):
-            logger.error("{} installation finished with an error: {}".format(self._bucket['bucket'], msg))
-            self._force_reload_apt_cache()  # reload apt cache
-            raise BaseException(msg)
-
-        def finish_update(self):
-            # warning: this function can be called even if dpkg failed (it raised an exception around commit()
-            # DO NOT CALL directly the callbacks from there.
-            logger.debug("Install for {} ended.".format(self._bucket['bucket']))
-            self._force_reload_apt_cache()  # reload apt cache
-
-        def status_change(self, pkg, percent, status):
-            logger.debug("{} install update: {}".format(self._bucket['bucket'], percent))
-            self._progress_callback({"step": self._status, "percentage": percent})
-
-        @staticmethod
-        def _redirect_stdin():  # pragma: no cover (in a fork)
-            os.dup2(os.open(os.devnull, os.O_RDWR), 0)
-
-        def _redirect_output(self):  # pragma: no cover (in a fork)
-            fd = os.open(self._exchange_filename, os.O_RDWR)
-            os.dup2(fd, 1)
-            os.dup2(fd, 2)
-
-        def _fixup_fds(self):  # pragma: no cover (in a fork)
-            required_fds = [0, 1, 2,  # stdin, stdout, stderr
-                            self.writefd,
-                            self.write_stream.fileno(),
-                            self.statusfd,
-                            self.status_stream.fileno()
-                            ]
-            # ensure that our required fds close on exec
-            for fd in required_fds[3:]:
-                old_flags = fcntl.fcntl(fd, fcntl.F_GETFD)
-                fcntl.fcntl(fd, fcntl.F_SETFD, old_flags | fcntl.FD_CLOEXEC)
-            # close all fds
-            proc_fd = "/proc/self/fd"
-            if os.path.exists(proc_fd):
-                error_count = 0
-                for fdname in os.listdir(proc_fd):
-                    try:
-                        fd = int(fdname)
-                    except ValueError:
-                        print("ERROR: can not get fd for '%s'" % fdname)
-                    if fd in required_fds:
+        """Load apt cache, waiting for anything else updating it to be done"""
+        deadline = time.monotonic() + self.apt_lock_timeout
+        retry_delay = self.CACHE_RETRY_DELAY
+        while True:
+            try:
+                self.cache.open()
+                return
+            except SystemError as e:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise BaseException("Couldn't load apt cache within {}s: {}".format(self.apt_lock_timeout, e))
+                logger.debug("Can't load apt cache yet: {}".format(e))
+                try:
+                    if self._wait_for_apt_locks(deadline):
                         continue
-                    try:
-                        os.close(fd)
-                    except OSError as e:
-                        # there will be one fd that can not be closed
-                        # as its the fd from pythons internal diropen()
-                        # so its ok to ignore one close error
-                        error_count += 1
-                        if error_count > 1:
-                            print("ERROR: os.close(%s): %s" % (fd, e))
-
-        def fork(self):
-            pid = os.fork()
-            if pid == 0:  # pragma: no cover
-                # be root
-                os.seteuid(0)
-                os.setegid(0)
-                self._fixup_fds()
-                self._redirect_stdin()
-                self._redirect_output()
-            return pid
+                except PermissionError as e:
+                    logger.debug("Can't check apt locks: {}".format(e))
+                # nobody holds the locks or we can't tell: retry later and later
+                time.sleep(min(retry_delay, deadline - now))
+                retry_delay = min(retry_delay * 2, self.CACHE_MAX_RETRY_DELAY)
+
+    @staticmethod
+    def _get_apt_lock_paths():
+        import apt_pkg
+        dpkg_dir = os.path.dirname(apt_pkg.config.find_file("Dir::State::status"))
+        return [os.path.join(dpkg_dir, "lock-frontend"), os.path.join(dpkg_dir, "lock"),
+                os.path.join(apt_pkg.config.find_dir("Dir::State::Lists"), "lock")]
+
+    @staticmethod
+    def _get_apt_lock_holder(lock_paths):
+        """Return the pid of the process holding any of the lock_paths, None if there is none
+
+        Lock files are only readable by root. Raise PermissionError if we can't switch to root to check them."""
+        with as_root():
+            return next((pid for pid in map(get_lock_holder, lock_paths) if pid is not None), None)
+
+    def _wait_for_apt_locks(self, deadline):
+        """Wait until apt and dpkg locks are released, reporting how long we waited. Return if we had to wait.
+
+        Checking a lock is cheap compared to loading the apt cache, which we only try again once they are all free.
+        Raise PermissionError if we can't check them."""
+        lock_paths = self._get_apt_lock_paths()
+        start = time.monotonic()
+        holder = None
+        while True:
+            previous_holder = holder
+            holder = self._get_apt_lock_holder(lock_paths)
+            if holder is None:
+                return previous_holder is not None
+            now = time.monotonic()
+            if now >= deadline:
+                raise BaseException("apt is still locked by process {} after {}s".format(
+                    holder, self.apt_lock_timeout))
+            if holder != previous_holder:
+                logger.info("Waiting for process {} to release apt lock".format(holder))
+            if self._progress_callback:
+                self._progress_callback({"step": self.STATUS_WAITING_LOCK, "holder": holder, "waited": now - start,
+                                         "percentage": 100 * (now - start) / self.apt_lock_timeout})
+            time.sleep(self.LOCK_POLL_INTERVAL)
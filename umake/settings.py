@@ -17,23 +17,47 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+from contextlib import suppress
+from functools import lru_cache
+import json
+import logging
 import os
-import requests
 import re
-from xdg.BaseDirectory import xdg_data_home
+from threading import Thread
+from time import time
+from xdg.BaseDirectory import xdg_cache_home, xdg_data_home
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_INSTALL_TOOLS_PATH = os.path.expanduser(os.path.join(xdg_data_home, "umake"))
 DEFAULT_BINARY_LINK_PATH = os.path.expanduser(os.path.join(DEFAULT_INSTALL_TOOLS_PATH, "bin"))
+DEFAULT_TRASH_PATH = os.path.expanduser(os.path.join(DEFAULT_INSTALL_TOOLS_PATH, ".trash"))
+TRASH_DIRNAME = ".umake-trash"
+DEDUP_INDEX_PATH = os.path.expanduser(os.path.join(DEFAULT_INSTALL_TOOLS_PATH, ".dedup-index"))
+PROFILE_LOCK_PATH = os.path.expanduser(os.path.join(DEFAULT_INSTALL_TOOLS_PATH, ".profile-lock"))
+GPG_KEYRINGS_PATH = os.path.expanduser(os.path.join(DEFAULT_INSTALL_TOOLS_PATH, ".gnupg"))
 OLD_CONFIG_FILENAME = "udtc"
 CONFIG_FILENAME = "umake"
 LSB_RELEASE_FILE = "/etc/lsb-release"
 UMAKE_FRAMEWORKS_ENVIRON_VARIABLE = "UMAKE_FRAMEWORKS"
+LATEST_VERSION_URL = "https://github.com/ubuntu/ubuntu-make/releases/latest"
+LATEST_VERSION_CACHE_PATH = os.path.expanduser(os.path.join(xdg_cache_home, "umake", "latest-version"))
+LATEST_VERSION_TTL = 24 * 3600
+LATEST_VERSION_TIMEOUT = 5
+# maximum time to wait for other package managers to release apt and dpkg locks, in seconds
+APT_LOCK_TIMEOUT = 600
 
 from_dev = False
 
 
 def get_version():
     '''Get version depending if on dev or released version'''
+    return _get_version(from_dev)
+
+
+@lru_cache()
+def _get_version(from_dev):
+    # only resolve the version once: it can spawn git
     version = open(os.path.join(os.path.dirname(__file__), 'version'), 'r', encoding='utf-8').read().strip()
     if not from_dev:
         snap_appendix = ''
@@ -52,10 +76,52 @@ def get_version():
 
 def get_latest_version():
     '''Get latest available version from github'''
+    # only imported there, as it's slow to import and not needed for most runs
+    import requests
+    # the latest release page redirects to the release tag one: no need to fetch and parse any content
+    page = requests.head(LATEST_VERSION_URL, timeout=LATEST_VERSION_TIMEOUT)
+    page.raise_for_status()
+    match = re.search('releases/tag/([^/]+)$', page.headers.get("location", ""))
+    if not match:
+        raise BaseException("Unexpected latest release location: {}".format(page.headers.get("location")))
+    return match.group(1)
+
+
+def _load_latest_version_cache():
+    with suppress(OSError, ValueError, KeyError, TypeError):
+        with open(LATEST_VERSION_CACHE_PATH, encoding='utf-8') as f:
+            cache = json.load(f)
+        return str(cache["version"]), float(cache["checked"])
+    return None, 0
+
+
+def get_cached_latest_version():
+    '''Get latest available version as last checked, without any network access. Return None if unknown'''
+    return _load_latest_version_cache()[0]
+
+
+def _refresh_latest_version_cache():
     try:
-        page = requests.get("https://github.com/ubuntu/ubuntu-make/releases")
-        page.raise_for_status()
-    except Exception as e:
-        raise e
-    latest = re.search('releases/tag/(.*)\">', page.text).group(1)
-    return latest
+        version = get_latest_version()
+        os.makedirs(os.path.dirname(LATEST_VERSION_CACHE_PATH), exist_ok=True)
+        with open(LATEST_VERSION_CACHE_PATH + ".new", "w", encoding='utf-8') as f:
+            json.dump({"version": version, "checked": time()}, f)
+        os.replace(LATEST_VERSION_CACHE_PATH + ".new", LATEST_VERSION_CACHE_PATH)
+    except BaseException as e:
+        # this is only informative, we'll try again next time
+        logger.debug("Couldn't check latest available version: {}".format(e))
+
+
+def refresh_latest_version_cache():
+    '''Check in the background latest available version if the cached one is older than LATEST_VERSION_TTL.
+
+    Nothing is done when offline. Return the checking thread, or None if the cached version is still valid'''
+    checked = _load_latest_version_cache()[1]
+    if 0 <= time() - checked < LATEST_VERSION_TTL:
+        return None
+    from gi.repository import Gio
+    if not Gio.NetworkMonitor.get_default().get_network_available():
+        return None
+    thread = Thread(target=_refresh_latest_version_cache, name="umake-version-check", daemon=True)
+    thread.start()
+    return thread
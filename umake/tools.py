@@ -17,27 +17,33 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-from collections import namedtuple
+import atexit
+from collections import deque, namedtuple
+from concurrent import futures
 from contextlib import contextmanager, suppress
 from enum import unique, Enum
+import fcntl
+import hashlib
 from gettext import gettext as _
 from gi.repository import GLib, Gio
 from glob import glob
+import json
 import logging
 import os
+from queue import Queue
 import re
 import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 from textwrap import dedent
-from time import sleep
-from threading import Lock
+from time import monotonic
+import threading
+from threading import Lock, Thread
+import uuid
 from umake import settings
 from xdg.BaseDirectory import load_first_config, xdg_config_home, xdg_data_home
-import yaml
-import yaml.scanner
-import yaml.parser
 
 logger = logging.getLogger(__name__)
 
@@ -45,10 +51,18 @@ logger = logging.getLogger(__name__)
 _current_arch = None
 _foreign_arch = None
 _version = None
+# framework tag: envs to write in its shell profile block (None to only remove it), during a profile transaction
+_profile_changes = None
+_profile_lock = threading.RLock()
+# fastest BeautifulSoup parser available
+_html_parser = None
 
 profile_tag = _("# Ubuntu make installation of {}\n")
 
-root_lock = Lock()
+root_lock = threading.RLock()
+_root_depth = threading.local()
+
+_trash_locations_filename = "locations"
 
 
 @unique
@@ -75,38 +89,120 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+def _yaml_loader_dumper():
+    """Return the fastest safe yaml loader and dumper available"""
+    import yaml
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader), getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
 class ConfigHandler(metaclass=Singleton):
+    """Shared umake configuration.
+
+    The config is reloaded if another process changed it on disk. Change it in a transaction() to have it saved
+    atomically once, with other umake processes locked out in between."""
 
     def __init__(self):
         """Load the config"""
         self._config = {}
+        # identity of the config file content we have in memory, None if there is no file, False if not loaded yet
+        self._config_stat = False
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
         old_config_file = load_first_config(settings.OLD_CONFIG_FILENAME)
-        config_file = load_first_config(settings.CONFIG_FILENAME)
         if old_config_file:
+            config_file = load_first_config(settings.CONFIG_FILENAME)
             if not config_file:
                 config_file = old_config_file.replace(settings.OLD_CONFIG_FILENAME, settings.CONFIG_FILENAME)
             os.rename(old_config_file, config_file)
+        self._reload_if_changed()
+
+    @staticmethod
+    def _get_config_file():
+        return load_first_config(settings.CONFIG_FILENAME) or os.path.join(xdg_config_home, settings.CONFIG_FILENAME)
+
+    @staticmethod
+    def _get_stat(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _reload_if_changed(self):
+        """Load the config file if it changed since we last loaded or saved it"""
+        config_file = self._get_config_file()
+        config_stat = self._get_stat(config_file)
+        if config_stat == self._config_stat:
+            return
+        self._config_stat = config_stat
+        self._config = {}
+        if config_stat is None:
+            logger.info("No configuration file found")
+            return
+        import yaml
         logger.debug("Opening {}".format(config_file))
         try:
             with open(config_file) as f:
-                self._config = yaml.load(f)
-        except (TypeError, FileNotFoundError):
+                self._config = yaml.load(f, Loader=_yaml_loader_dumper()[0]) or {}
+        except FileNotFoundError:
             logger.info("No configuration file found")
-        except (yaml.scanner.ScannerError, yaml.parser.ParserError) as e:
+        except yaml.YAMLError as e:
             logger.error("Invalid configuration file found: {}".format(e))
 
+    def _save(self):
+        """Atomically replace the config file with current config"""
+        # keep symlinked config files in place, writing next to their target for the replace to be atomic
+        config_file = os.path.realpath(os.path.join(xdg_config_home, settings.CONFIG_FILENAME))
+        logger.debug("Saving new configuration: {} in {}".format(self._config, config_file))
+        import yaml
+        with open(config_file + ".new", 'w') as f:
+            yaml.dump(self._config, f, Dumper=_yaml_loader_dumper()[1], default_flow_style=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(config_file + ".new", config_file)
+        self._config_stat = self._get_stat(config_file)
+
+    @contextmanager
+    def transaction(self):
+        """Yield the config to change it, saving it once at the end of the outermost transaction.
+
+        The config is locked against other umake processes for the whole transaction and is reloaded first if they
+        changed it. Nothing is saved if the transaction raises."""
+        with self._lock:
+            outermost = self._transaction_depth == 0
+            if outermost:
+                os.makedirs(xdg_config_home, exist_ok=True)
+                lock_file = open(os.path.join(xdg_config_home, settings.CONFIG_FILENAME + ".lock"), 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._transaction_depth += 1
+            try:
+                if outermost:
+                    self._reload_if_changed()
+                yield self._config
+                if outermost:
+                    self._save()
+            except BaseException:
+                if outermost:
+                    # drop changes made in memory
+                    self._config_stat = False
+                raise
+            finally:
+                self._transaction_depth -= 1
+                if outermost:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+
     @property
     def config(self):
-        return self._config
+        with self._lock:
+            if not self._transaction_depth:
+                self._reload_if_changed()
+            return self._config
 
     @config.setter
     def config(self, config):
-        config_file = os.path.join(xdg_config_home, settings.CONFIG_FILENAME)
-        logging.debug("Saving new configuration: {} in {}".format(config, config_file))
-        os.makedirs(os.path.dirname(config_file), exist_ok=True)
-        with open(config_file, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
-        self._config = config
+        with self.transaction():
+            self._config = config
 
 
 class NoneDict(dict):
@@ -126,9 +222,151 @@ class classproperty(object):
         return self.f(owner)
 
 
+class Tracer(object, metaclass=Singleton):
+    """Record time spent in install phases as spans, saved in the Chrome trace event format.
+
+    The saved file can be loaded in any trace viewer, like chrome://tracing or https://ui.perfetto.dev."""
+
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._thread_names = {}
+        self._lock = Lock()
+        self._origin = monotonic()
+
+    def start(self, path):
+        """Start recording spans, saving them to path when the process exits"""
+        self.enabled = True
+        self._origin = monotonic()
+        atexit.register(self.save, path)
+
+    @contextmanager
+    def span(self, name, category="umake", **args):
+        """Record the time spent in the with block as a span.
+
+        This yields the span arguments dict, which can be completed in the block, like with the number of bytes
+        processed."""
+        if not self.enabled:
+            yield args
+            return
+        start = monotonic()
+        try:
+            yield args
+        except MainLoop.ReturnMainLoop:
+            raise
+        except BaseException as e:
+            args["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            thread = threading.current_thread()
+            event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                     "ts": int((start - self._origin) * 1000000), "dur": int((monotonic() - start) * 1000000),
+                     "args": args}
+            with self._lock:
+                self._events.append(event)
+                self._thread_names[thread.ident] = thread.name
+
+    def save(self, path):
+        """Save all recorded spans to path"""
+        with self._lock:
+            events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                      for (tid, name) in self._thread_names.items()]
+            events.extend(self._events)
+        try:
+            with open(path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        except OSError as e:
+            logger.error("Couldn't save trace to {}: {}".format(path, e))
+            return
+        logger.info("Trace saved to {}".format(path))
+
+
+class DispatchQueue(object):
+    """Queue of calls to run in the main loop thread, drained in batches.
+
+    Calls are run in the order they were posted. A coalesced call replaces the arguments of any pending call with the
+    same key, keeping its place in the queue.
+    Threads posting calls wait while the queue is full, until the main loop catches up."""
+
+    # maximum time in seconds spent draining the queue per main loop iteration, so that other sources still run
+    BATCH_DURATION = 0.02
+    MAX_PENDING = 1000
+    DispatchStats = namedtuple("DispatchStats", ["depth", "max_depth", "dispatched", "coalesced", "mean_latency",
+                                                 "max_latency"])
+
+    def __init__(self):
+        # pending calls are [function, args, kwargs, key, post time]
+        self._pending = deque()
+        self._pending_by_key = {}
+        self._lock = Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._scheduled = False
+        self._max_depth = 0
+        self._dispatched = 0
+        self._coalesced = 0
+        self._total_latency = 0
+        self._max_latency = 0
+
+    def post(self, function, args=(), kwargs=None, key=None):
+        """Run function(*args, **kwargs) in the main loop thread.
+
+        If key isn't None, only the last call posted with that key is run."""
+        with self._lock:
+            if key is not None and key in self._pending_by_key:
+                call = self._pending_by_key[key]
+                call[1] = args
+                call[2] = kwargs or {}
+                self._coalesced += 1
+                return
+            # never wait in the main loop thread, which is the one draining the queue
+            if len(self._pending) >= self.MAX_PENDING and threading.current_thread() is not threading.main_thread() \
+                    and not GLib.MainContext.default().is_owner():
+                self._not_full.wait_for(lambda: len(self._pending) < self.MAX_PENDING)
+            call = [function, args, kwargs or {}, key, monotonic()]
+            self._pending.append(call)
+            if key is not None:
+                self._pending_by_key[key] = call
+            self._max_depth = max(self._max_depth, len(self._pending))
+            if not self._scheduled:
+                self._scheduled = True
+                GLib.idle_add(self._drain)
+
+    def _drain(self):
+        """Run pending calls until the queue is empty or we spent BATCH_DURATION in this iteration"""
+        start = monotonic()
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._scheduled = False
+                    return False
+                function, args, kwargs, key, post_time = self._pending.popleft()
+                if key is not None:
+                    del self._pending_by_key[key]
+                now = monotonic()
+                self._dispatched += 1
+                self._total_latency += now - post_time
+                self._max_latency = max(self._max_latency, now - post_time)
+                if len(self._pending) == self.MAX_PENDING - 1:
+                    self._not_full.notify_all()
+            function(*args, **kwargs)
+            if monotonic() - start > self.BATCH_DURATION:
+                # let other main loop sources run, we'll be called back on next iteration
+                return True
+
+    def get_stats(self):
+        """Return current queue depth and overall dispatch metrics (latencies are in seconds)"""
+        with self._lock:
+            return self.DispatchStats(depth=len(self._pending), max_depth=self._max_depth,
+                                      dispatched=self._dispatched, coalesced=self._coalesced,
+                                      mean_latency=self._total_latency / self._dispatched if self._dispatched else 0,
+                                      max_latency=self._max_latency)
+
+
 class MainLoop(object, metaclass=Singleton):
     """Mainloop simple wrapper"""
 
+    dispatch_queue = DispatchQueue()
+
     def __init__(self):
         self.mainloop = GLib.MainLoop()
         # Glib steals the SIGINT handler and so, causes issue in the callback
@@ -145,17 +383,17 @@ class MainLoop(object, metaclass=Singleton):
             raise self.ReturnMainLoop()
 
     def _clean_up(self, exit_code):
+        logger.debug("Main loop dispatch stats: {}".format(self.dispatch_queue.get_stats()))
         self.mainloop.quit()
         sys.exit(exit_code)
 
     @staticmethod
-    def in_mainloop_thread(function):
-        """Decorator to run a function in a mainloop thread"""
-
-        # GLib.idle_add doesn't propagate try: except in the mainloop, so we handle it there for all functions
+    def _wrap_for_mainloop(function, key=None):
+        # we are not called from GLib directly, so we handle exceptions there for all functions
         def wrapper(*args, **kwargs):
             try:
-                function(*args, **kwargs)
+                with Tracer().span(function.__qualname__, "mainloop"):
+                    function(*args, **kwargs)
             except MainLoop.ReturnMainLoop:
                 pass
             except BaseException:
@@ -163,9 +401,30 @@ class MainLoop(object, metaclass=Singleton):
                 GLib.idle_add(MainLoop().quit, 1, False)
 
         def inner(*args, **kwargs):
-            return GLib.idle_add(wrapper, *args, **kwargs)
+            call_key = None
+            if key is not None:
+                call_key = key(*args, **kwargs)
+                if call_key is not None:
+                    call_key = (function, call_key)
+            MainLoop.dispatch_queue.post(wrapper, args, kwargs, key=call_key)
         return inner
 
+    @staticmethod
+    def in_mainloop_thread(function):
+        """Decorator to run a function in a mainloop thread"""
+        return MainLoop._wrap_for_mainloop(function)
+
+    @staticmethod
+    def coalesced_in_mainloop_thread(key):
+        """Decorator to run a function in a mainloop thread, dropping pending calls superseded by a newer one.
+
+        key is called with the function arguments: a pending call is replaced by a newer one with the same key.
+        Calls for which key returns None are never replaced. This is meant for idempotent updates, like progress
+        reports."""
+        def decorator(function):
+            return MainLoop._wrap_for_mainloop(function, key)
+        return decorator
+
     class ReturnMainLoop(BaseException):
         """Exception raised only to return to MainLoop without finishing the function"""
 
@@ -278,6 +537,68 @@ def launcher_exists(desktop_filename):
     return True
 
 
+class LauncherFavorites(metaclass=Singleton):
+    """Unity launcher favorites, updated once for all launchers pinned during a batch"""
+
+    SCHEMA_ID = "com.canonical.Unity.Launcher"
+
+    def __init__(self):
+        # installed schemas don't change while we run
+        self.available = self.SCHEMA_ID in Gio.Settings.list_schemas()
+        self._gsettings = None
+        self._to_pin = []
+        self._batch_depth = 0
+        self._lock = threading.RLock()
+
+    def _get_gsettings(self):
+        if self._gsettings is None:
+            self._gsettings = Gio.Settings(schema_id=self.SCHEMA_ID, path="/com/canonical/unity/launcher/")
+        return self._gsettings
+
+    def get_favorites(self):
+        """Return launcher favorites, including the ones pinned in current batch"""
+        with self._lock:
+            favorites = self._get_gsettings().get_strv("favorites")
+            return favorites + [tag for tag in self._to_pin if tag not in favorites]
+
+    def pin(self, desktop_filename):
+        """Pin desktop filename in the launcher, once current batch ends"""
+        with self.batch():
+            launcher_tag = "application://{}".format(desktop_filename)
+            if launcher_tag not in self._to_pin:
+                self._to_pin.append(launcher_tag)
+
+    @contextmanager
+    def batch(self):
+        """Only update favorites once at the end of the outermost batch"""
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._update_favorites()
+
+    def _update_favorites(self):
+        to_pin, self._to_pin = self._to_pin, []
+        if not to_pin:
+            return
+        gsettings = self._get_gsettings()
+        favorites = gsettings.get_strv("favorites")
+        to_pin = [launcher_tag for launcher_tag in to_pin if launcher_tag not in favorites]
+        if not to_pin:
+            return
+        index = len(favorites)
+        with suppress(ValueError):
+            index = favorites.index("unity://running-apps")
+        favorites[index:index] = to_pin
+        logger.debug("Pin {} in the launcher".format(to_pin))
+        gsettings.set_strv("favorites", favorites)
+        # ensure the change is written before we exit (see https://bugzilla.gnome.org/show_bug.cgi?id=744030)
+        Gio.Settings.sync()
+
+
 def launcher_exists_and_is_pinned(desktop_filename):
     """Return true if the desktop filename is pinned in the launcher"""
     if not launcher_exists(desktop_filename):
@@ -285,11 +606,10 @@ def launcher_exists_and_is_pinned(desktop_filename):
     if os.environ.get("XDG_CURRENT_DESKTOP") != "Unity":
         logger.debug("Don't check launcher as current environment isn't Unity")
         return True
-    if "com.canonical.Unity.Launcher" not in Gio.Settings.list_schemas():
+    if not LauncherFavorites().available:
         logger.debug("In an Unity environment without the Launcher schema file")
         return False
-    gsettings = Gio.Settings(schema_id="com.canonical.Unity.Launcher", path="/com/canonical/unity/launcher/")
-    launcher_list = gsettings.get_strv("favorites")
+    launcher_list = LauncherFavorites().get_favorites()
     res = "application://" + desktop_filename in launcher_list
     if not res:
         logger.debug("Launcher exists but is not pinned (pinned: {}).".format(launcher_list))
@@ -320,21 +640,165 @@ def create_launcher(desktop_filename, content):
     with open(launcher_path, "w") as f:
         f.write(content)
 
-    if "com.canonical.Unity.Launcher" not in Gio.Settings.list_schemas():
+    if not LauncherFavorites().available:
         logger.info("Don't create a launcher icon, as we are not under Unity")
         return
-    gsettings = Gio.Settings(schema_id="com.canonical.Unity.Launcher", path="/com/canonical/unity/launcher/")
-    launcher_list = gsettings.get_strv("favorites")
-    launcher_tag = "application://{}".format(desktop_filename)
-    if launcher_tag not in launcher_list:
-        index = len(launcher_list)
-        with suppress(ValueError):
-            index = launcher_list.index("unity://running-apps")
-        launcher_list.insert(index, launcher_tag)
-        # FIXME: working around a bug in glib: https://bugzilla.gnome.org/show_bug.cgi?id=744030
-        sleep(1.5)
-        ##########
-        gsettings.set_strv("favorites", launcher_list)
+    LauncherFavorites().pin(desktop_filename)
+
+
+def _lower_thread_priority():
+    """Lower current thread priority so that it doesn't compete with the main work"""
+    # on linux, each thread has its own nice value
+    with suppress(AttributeError, OSError):
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+
+
+class TrashCollector(metaclass=Singleton):
+    """Remove trashed paths in low priority background threads
+
+    Those are daemon threads, so they never delay exiting: whatever wasn't removed yet stays in the trash
+    and will be cleaned by the next empty_trash() call."""
+
+    UNLINK_WORKERS = 4
+    REPORT_EVERY = 10000
+
+    def __init__(self):
+        self._queue = Queue()
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.UNLINK_WORKERS,
+                                                    initializer=_lower_thread_priority)
+        Thread(target=self._run, daemon=True).start()
+
+    def collect(self, path):
+        """Queue path for removal"""
+        logger.debug("Queue {} for removal".format(path))
+        self._queue.put(path)
+
+    def join(self):
+        """Wait for all queued paths to be removed"""
+        self._queue.join()
+
+    def _run(self):
+        _lower_thread_priority()
+        while True:
+            path = self._queue.get()
+            try:
+                self._remove(path)
+            except Exception as e:
+                logger.warning("Couldn't remove {}: {}".format(path, e))
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _unlink_files(paths):
+        removed = 0
+        for path in paths:
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # left to the rmtree() fallback
+                logger.debug("Couldn't unlink {}: {}".format(path, e))
+        return removed
+
+    def _remove(self, path):
+        """Remove path, unlinking each directory files in parallel, and then directories bottom up"""
+        if not os.path.isdir(path) or os.path.islink(path):
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            return
+        dirs = []
+        to_scan = [path]
+        pending = []
+        removed = 0
+        while to_scan:
+            current_dir = to_scan.pop()
+            dirs.append(current_dir)
+            files = []
+            with suppress(OSError):
+                with os.scandir(current_dir) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            to_scan.append(entry.path)
+                        else:
+                            files.append(entry.path)
+            if files:
+                pending.append(self._executor.submit(self._unlink_files, files))
+            # collect what's already done to report progress
+            while pending and pending[0].done():
+                removed = self._report(path, removed, pending.pop(0).result())
+        for future in pending:
+            removed = self._report(path, removed, future.result())
+        for current_dir in reversed(dirs):
+            # directories are left non empty by files we couldn't unlink
+            with suppress(OSError):
+                os.rmdir(current_dir)
+        # fallback for anything we couldn't unlink, like in read-only directories
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info("{} removed ({} files)".format(path, removed))
+
+    def _report(self, path, removed, newly_removed):
+        """Log progress every REPORT_EVERY files and return the new number of removed files"""
+        if (removed + newly_removed) // self.REPORT_EVERY > removed // self.REPORT_EVERY:
+            logger.debug("Removing {}: {} files removed".format(path, removed + newly_removed))
+        return removed + newly_removed
+
+
+def _get_trash_dirs():
+    """Return all trash directories that may have some content"""
+    trash_dirs = [settings.DEFAULT_TRASH_PATH]
+    with suppress(FileNotFoundError):
+        with open(os.path.join(settings.DEFAULT_TRASH_PATH, _trash_locations_filename), encoding='utf-8') as f:
+            trash_dirs.extend([line.strip() for line in f if line.strip()])
+    return trash_dirs
+
+
+def _register_trash_dir(trash_dir):
+    """Keep track of trash directories which are not the default one"""
+    if trash_dir in _get_trash_dirs():
+        return
+    os.makedirs(settings.DEFAULT_TRASH_PATH, exist_ok=True)
+    with open(os.path.join(settings.DEFAULT_TRASH_PATH, _trash_locations_filename), "a", encoding='utf-8') as f:
+        f.write("{}\n".format(trash_dir))
+
+
+def move_to_trash(path):
+    """Atomically move path to a trash directory on the same filesystem and remove it in the background
+
+    path can be reused right away instead of waiting for a potentially huge tree to be removed.
+    Raise FileNotFoundError if path doesn't exist."""
+    path = os.path.normpath(path)
+    trashed_name = "{}-{}".format(os.path.basename(path), uuid.uuid4().hex)
+    # use the default trash, or a trash next to path if it's on another filesystem
+    for trash_dir in (settings.DEFAULT_TRASH_PATH, os.path.join(os.path.dirname(path), settings.TRASH_DIRNAME)):
+        trashed_path = os.path.join(trash_dir, trashed_name)
+        try:
+            os.makedirs(trash_dir, exist_ok=True)
+            os.rename(path, trashed_path)
+            break
+        except FileNotFoundError:
+            raise
+        except OSError as e:
+            logger.debug("Can't move {} to {}: {}".format(path, trash_dir, e))
+    else:
+        logger.debug("Removing {} directly".format(path))
+        shutil.rmtree(path)
+        return
+    if trash_dir != settings.DEFAULT_TRASH_PATH:
+        _register_trash_dir(trash_dir)
+    logger.debug("Moved {} to {}".format(path, trashed_path))
+    TrashCollector().collect(trashed_path)
+
+
+def empty_trash():
+    """Remove in the background any content left in trash directories"""
+    for trash_dir in _get_trash_dirs():
+        with suppress(FileNotFoundError, NotADirectoryError):
+            with os.scandir(trash_dir) as it:
+                for entry in it:
+                    if entry.name != _trash_locations_filename:
+                        TrashCollector().collect(entry.path)
 
 
 def add_exec_link(exec_path, destination_name):
@@ -369,6 +833,172 @@ def strip_tags(content):
     return re.sub('<[^<]+?>', '', content)
 
 
+class PageScanner(object):
+    """Extract a download link, its checksum and a license from a whole decoded page.
+
+    All patterns are regular expressions compiled once, in multiline mode, when the scanner is created. url and
+    checksum are searched for, capturing their value in their first group, in download sections of whole lines:
+    from the line matching start to the line matching end, included, or the end of the page. Without start, the whole
+    page is a download section. The license is made of the lines from the first one matching license_start, to the
+    next one matching license_end, excluded.
+    Each kind of section is found in a single forward pass, stopping once we have what we need from it. Like with per
+    line parsing, the last section providing an url wins until a checksum is found, when one is needed."""
+
+    Result = namedtuple("Result", ["url", "checksum", "license"])
+
+    def __init__(self, url, checksum=None, start=None, end=None, license_start=None, license_end=None):
+        def compile_pattern(pattern):
+            return re.compile(pattern, re.MULTILINE) if pattern else None
+        self._url = compile_pattern(url)
+        self._checksum = compile_pattern(checksum)
+        self._start = compile_pattern(start)
+        self._end = compile_pattern(end)
+        self._license_start = compile_pattern(license_start)
+        self._license_end = compile_pattern(license_end)
+
+    @staticmethod
+    def _line_start(page, pos):
+        return page.rfind("\n", 0, pos) + 1
+
+    @staticmethod
+    def _line_end(page, pos):
+        end = page.find("\n", pos)
+        return len(page) if end == -1 else end + 1
+
+    def _sections(self, page, start, end, end_included):
+        """Generate (begin, end) positions of sections of whole lines"""
+        pos = 0
+        while True:
+            match = start.search(page, pos)
+            if not match:
+                return
+            begin = self._line_start(page, match.start())
+            # the end line can be the start one, but the license ends at the earliest on next line
+            end_match = end.search(page, begin if end_included else self._line_end(page, match.start())) \
+                if end else None
+            if not end_match:
+                pos = len(page)
+            elif end_included:
+                pos = self._line_end(page, end_match.start())
+            else:
+                pos = self._line_start(page, end_match.start())
+            yield (begin, pos)
+
+    def scan(self, page, need_checksum=False, need_license=False):
+        """Return a Result of what was found in page, stopping as soon as everything needed is"""
+        url, checksum = None, None
+        sections = self._sections(page, self._start, self._end, True) if self._start else [(0, len(page))]
+        for begin, end in sections:
+            match = self._url.search(page, begin, end)
+            if match:
+                url = match.group(1)
+            if self._checksum:
+                match = self._checksum.search(page, begin, end)
+                if match:
+                    checksum = match.group(1)
+            if url and (checksum or not need_checksum):
+                break
+
+        license_txt = ""
+        if need_license and self._license_start:
+            for begin, end in self._sections(page, self._license_start, self._license_end, False):
+                license_txt = page[begin:end]
+                break
+        return self.Result(url, checksum, license_txt)
+
+
+def get_html_parser():
+    """Return the fastest BeautifulSoup tree builder available: lxml if installed, python html parser otherwise"""
+    global _html_parser
+    if _html_parser is None:
+        try:
+            import lxml  # noqa
+            _html_parser = "lxml"
+        except ImportError:
+            _html_parser = "html.parser"
+    return _html_parser
+
+
+def parse_html(content, name=None, **kwargs):
+    """Return a BeautifulSoup tree of only the content elements, with their children, matching name and kwargs.
+
+    Those are the arguments of a SoupStrainer, to not build the tree of the whole page when we only look for some
+    elements. content can be a string or bytes."""
+    from bs4 import BeautifulSoup, SoupStrainer
+    return BeautifulSoup(content, get_html_parser(), parse_only=SoupStrainer(name, **kwargs))
+
+
+class GpgKeyring(object):
+    """Persistent gnupg home of published keys, kept across installs
+
+    The keyring is only rebuilt when the published keys change: we record the digest of the keys file it was built
+    from, and the fingerprints it should have. It's rebuilt from scratch, so that keys removed upstream are dropped.
+    When built as root, it's given back to the user, so that it can be used without privileges too."""
+
+    STATE_FILENAME = "umake-keys.json"
+
+    def __init__(self, name):
+        self.path = os.path.join(settings.GPG_KEYRINGS_PATH, name)
+
+    def _load_state(self):
+        with suppress(FileNotFoundError, ValueError):
+            with open(os.path.join(self.path, self.STATE_FILENAME)) as f:
+                return json.load(f)
+        return {}
+
+    def get_gpg(self, keys):
+        """Return a gnupg.GPG of the keyring having exactly the keys of that keys file content, None if it has none"""
+        import gnupg
+        digest = hashlib.sha256(keys.encode()).hexdigest()
+        state = self._load_state()
+        if state.get("digest") == digest:
+            gpg = gnupg.GPG(gnupghome=self.path)
+            if set(state["fingerprints"]) <= set(gpg.list_keys().fingerprints):
+                logger.debug("Reusing keyring {}".format(self.path))
+                return gpg
+
+        logger.debug("Building keyring {}".format(self.path))
+        parent_dir = os.path.dirname(self.path)
+        created_dir = None
+        existing_dir = parent_dir
+        while not os.path.isdir(existing_dir):
+            created_dir, existing_dir = existing_dir, os.path.dirname(existing_dir)
+        os.makedirs(parent_dir, exist_ok=True)
+        if created_dir:
+            self._give_to_user(created_dir)
+        # build it aside, to never leave a partial keyring in place
+        new_path = tempfile.mkdtemp(dir=parent_dir, prefix=".{}-".format(os.path.basename(self.path)))
+        try:
+            imported_keys = gnupg.GPG(gnupghome=new_path).import_keys(keys)
+            if imported_keys.count == 0:
+                return None
+            with open(os.path.join(new_path, self.STATE_FILENAME), 'w') as f:
+                json.dump({"digest": digest, "fingerprints": imported_keys.fingerprints}, f)
+            self._give_to_user(new_path)
+            shutil.rmtree(self.path, ignore_errors=True)
+            try:
+                os.rename(new_path, self.path)
+            except OSError:
+                # another umake run can have rebuilt it in between
+                if self._load_state().get("digest") != digest:
+                    raise
+        finally:
+            shutil.rmtree(new_path, ignore_errors=True)
+        return gnupg.GPG(gnupghome=self.path)
+
+    @staticmethod
+    def _give_to_user(path):
+        """Give the path tree to the user if we are running as root"""
+        if os.geteuid() != 0:
+            return
+        # fallback to root user if no SUDO_UID (should be su - root)
+        uid, gid = (int(os.getenv("SUDO_UID", default=0)), int(os.getenv("SUDO_GID", default=0)))
+        for dirpath, dirnames, filenames in os.walk(path):
+            os.lchown(dirpath, uid, gid)
+            for filename in filenames:
+                os.lchown(os.path.join(dirpath, filename), uid, gid)
+
+
 def switch_to_current_user():
     """Switch euid and guid to current user if current user is root"""
     if os.geteuid() != 0:
@@ -382,12 +1012,18 @@ def switch_to_current_user():
 def as_root():
     # block all other threads making sensitive operations
     root_lock.acquire()
+    # only the outermost as_root() in a thread switches user, nested ones are running as root already
+    depth = getattr(_root_depth, "value", 0)
+    _root_depth.value = depth + 1
     try:
-        os.seteuid(0)
-        os.setegid(0)
+        if not depth:
+            os.seteuid(0)
+            os.setegid(0)
         yield
     finally:
-        switch_to_current_user()
+        _root_depth.value = depth
+        if not depth:
+            switch_to_current_user()
         root_lock.release()
 
 
@@ -399,28 +1035,80 @@ def _get_shell_profile_file_path():
     return os.path.join(os.path.expanduser('~'), profile_filename)
 
 
-def remove_framework_envs_from_user(framework_tag):
-    """Remove all envs from user if found"""
-    profile_filepath = _get_shell_profile_file_path()
-    content = ""
-    framework_header = profile_tag.format(framework_tag)
-    try:
-        with open(profile_filepath, "r", encoding='utf-8') as f:
-            content = f.read()
-    except FileNotFoundError:
-        return
-    if framework_header not in content:
+@contextmanager
+def profile_transaction():
+    """Batch user env changes, applied with a single shell profile rewrite at the end of the outermost transaction.
+
+    Envs added in the same transaction for the same framework end up in the same block. Nothing is written if the
+    transaction raises."""
+    global _profile_changes
+    with _profile_lock:
+        if _profile_changes is not None:
+            yield
+            return
+        _profile_changes = {}
+        try:
+            yield
+            changes = _profile_changes
+        finally:
+            _profile_changes = None
+        _apply_profile_changes(changes)
+
+
+def _apply_profile_changes(changes):
+    """Replace framework blocks in shell profile file in a single pass, locked against other umake processes"""
+    if not changes:
         return
+    # keep symlinked profile files in place
+    profile_filepath = os.path.realpath(_get_shell_profile_file_path())
+    os.makedirs(os.path.dirname(settings.PROFILE_LOCK_PATH), exist_ok=True)
+    with open(settings.PROFILE_LOCK_PATH, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(profile_filepath, "r", encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        # drop current blocks of changed frameworks. A block ends with an empty line
+        headers = set(profile_tag.format(framework_tag) for framework_tag in changes)
+        content = []
+        in_block = False
+        for line in lines:
+            if in_block:
+                in_block = line != "\n"
+            elif line in headers:
+                in_block = True
+            else:
+                content.append(line)
+        if len(content) == len(lines) and all(envs is None for envs in changes.values()):
+            return
+
+        for framework_tag, envs in changes.items():
+            if envs is None:
+                continue
+            if content and not content[-1].endswith("\n"):
+                content.append("\n")
+            content.append(profile_tag.format(framework_tag))
+            for env, value in envs.items():
+                logger.debug("Adding {} to user's {} for {}".format(value, env, framework_tag))
+                export = ""
+                if env != "PATH":
+                    export = "export "
+                content.append("{}{}={}\n".format(export, env, value))
+            content.append("\n")
+
+        with open(profile_filepath + ".new", "w", encoding='utf-8') as f:
+            f.write("".join(content))
+        with suppress(FileNotFoundError):
+            shutil.copymode(profile_filepath, profile_filepath + ".new")
+        os.replace(profile_filepath + ".new", profile_filepath)
 
-    while framework_header in content:
-        framework_start_index = content.find(framework_header)
-        framework_end_index = content[framework_start_index:].find("\n\n")
-        content = content[:framework_start_index] + content[framework_start_index + framework_end_index + len("\n\n"):]
 
-    # rewrite .profile and omit framework_tag
-    with open(profile_filepath + ".new", "w", encoding='utf-8') as f:
-        f.write(content)
-    os.rename(profile_filepath + ".new", profile_filepath)
+def remove_framework_envs_from_user(framework_tag):
+    """Remove all envs from user if found"""
+    with profile_transaction():
+        _profile_changes[framework_tag] = None
 
 
 def add_env_to_user(framework_tag, env_dict):
@@ -431,29 +1119,20 @@ def add_env_to_user(framework_tag, env_dict):
                       keep: True/False }
     }
     value is either a list (in that case, it's concatenated) or a string
-    If keep is set to True, we keep previous values with :$OLDERENV."""
-
-    profile_filepath = _get_shell_profile_file_path()
-    remove_framework_envs_from_user(framework_tag)
-    envs_to_insert = {}
-    for env in env_dict:
-        value = env_dict[env]["value"]
-        if isinstance(value, list):
-            value = os.pathsep.join(value)
-        if env_dict[env].get("keep", True) and os.environ.get(env):
-            os.environ[env] = value + os.pathsep + os.environ[env]
-            value = "{}{}${}".format(value, os.pathsep, env)
-        else:
-            os.environ[env] = value
-        envs_to_insert[env] = value
-
-    with open(profile_filepath, "a", encoding='utf-8') as f:
-        f.write(profile_tag.format(framework_tag))
-        for env in envs_to_insert:
-            value = envs_to_insert[env]
-            logger.debug("Adding {} to user's {} for {}".format(value, env, framework_tag))
-            export = ""
-            if env != "PATH":
-                export = "export "
-            f.write("{}{}={}\n".format(export, env, value))
-        f.write("\n")
+    If keep is set to True, we keep previous values with :$OLDERENV.
+    Previous envs of the framework are replaced, unless added in the same profile transaction."""
+
+    with profile_transaction():
+        envs_to_insert = _profile_changes.get(framework_tag)
+        if envs_to_insert is None:
+            envs_to_insert = _profile_changes[framework_tag] = {}
+        for env in env_dict:
+            value = env_dict[env]["value"]
+            if isinstance(value, list):
+                value = os.pathsep.join(value)
+            if env_dict[env].get("keep", True) and os.environ.get(env):
+                os.environ[env] = value + os.pathsep + os.environ[env]
+                value = "{}{}${}".format(value, os.pathsep, env)
+            else:
+                os.environ[env] = value
+            envs_to_insert[env] = value
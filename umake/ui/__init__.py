@@ -23,7 +23,7 @@ import logging
 from contextlib import suppress
 from gi.repository import GLib
 from umake.tools import Singleton, MainLoop
-from umake.settings import get_version, get_latest_version
+from umake.settings import get_version, get_cached_latest_version
 
 logger = logging.getLogger(__name__)
 
@@ -37,14 +37,16 @@ class UI(object, metaclass=Singleton):
 
     @classmethod
     def return_main_screen(cls, status_code=0):
+        # never block on the network here: only use the version checked in the background by a previous run
         try:
-            truncated_version = get_version().split("+")[0]
-            if status_code == 1 and not (get_latest_version() == truncated_version):
-                print('''
+            if status_code == 1:
+                latest_version = get_cached_latest_version()
+                if latest_version and latest_version != get_version().split("+")[0]:
+                    print('''
 Your currently installed version ({}) differs from the latest release ({})
 Many issues are usually fixed in more up to date versions.
 To get the latest version you can read the instructions at https://github.com/ubuntu/ubuntu-make
-'''.format(get_version(), get_latest_version()))
+'''.format(get_version(), latest_version))
         except Exception as e:
             logger.error(e)
         cls.currentUI._return_main_screen(status_code=status_code)
@@ -61,6 +63,18 @@ To get the latest version you can read the instructions at https://github.com/ub
     def delayed_display(cls, contentType):
         GLib.timeout_add(50, cls._one_time_wrapper, cls.currentUI._display, contentType)
 
+    # only keep the last pending progress event of each kind
+    @classmethod
+    @MainLoop.coalesced_in_mainloop_thread(lambda cls, name, **data: name if name.endswith("_progress") else None)
+    def event(cls, name, **data):
+        """Notify a machine readable event, like a phase change or a progress update, to UIs reporting them"""
+        if cls.currentUI:
+            cls.currentUI._event(name, data)
+
+    def _event(self, name, data):
+        """Events are ignored by default"""
+        pass
+
     @staticmethod
     def _one_time_wrapper(fun, contentType):
         """To be called with GLib.timeout_add(), return False to only have one call"""
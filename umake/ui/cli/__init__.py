@@ -21,15 +21,18 @@
 
 import argcomplete
 from contextlib import suppress
+from gettext import gettext as _
 import logging
 import os
-from progressbar import ProgressBar, BouncingBar
 import readline
 import sys
+from umake.deduplicator import Deduplicator
 from umake.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
+from umake.network.download_center import DownloadCenter
+from umake.network.rate_limiter import RateLimiter
 from umake.ui import UI
 from umake.frameworks import BaseCategory
-from umake.tools import InputError, MainLoop
+from umake.tools import InputError, MainLoop, Tracer
 from umake.settings import get_version
 
 logger = logging.getLogger(__name__)
@@ -68,6 +71,7 @@ class CliUI(UI):
                     print(contentType.text)
                 elif isinstance(contentType, UnknownProgress):
                     if not contentType.bar:
+                        from progressbar import ProgressBar, BouncingBar
                         contentType.bar = ProgressBar(widgets=[BouncingBar()])
                     with suppress(StopIteration, AttributeError):
                         # pulse and add a timeout callback
@@ -157,6 +161,24 @@ def mangle_args_for_default_framework(args):
     return result_args
 
 
+def print_dedup_report():
+    """Print how much disk space deduplication saved per installed framework"""
+    report = Deduplicator.get_report()
+    for path in sorted(report):
+        print("{}: {}".format(path, format_size(report[path])))
+    print(_("Total saved: {}").format(format_size(sum(report.values()))))
+
+
+def format_size(size):
+    """Return a human readable size"""
+    unit = "B"
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return "{:.1f} {}".format(size, unit)
+
+
 def main(parser):
     """Main entry point of the cli command"""
     categories_parser = parser.add_subparsers(help='Developer environment', dest="category")
@@ -176,9 +198,39 @@ def main(parser):
         print(get_version())
         sys.exit(0)
 
+    if args.dedup_report:
+        print_dedup_report()
+        sys.exit(0)
+
     if not args.category:
         parser.print_help()
         sys.exit(0)
 
-    CliUI()
+    if args.max_rate:
+        RateLimiter().max_rate = args.max_rate
+
+    if args.trace:
+        Tracer().start(args.trace)
+
+    try:
+        if args.export_bundle or args.from_bundle:
+            from umake.network.bundle import Bundle
+        if args.export_bundle:
+            DownloadCenter.bundle = Bundle(args.export_bundle, recording=True)
+        elif args.from_bundle:
+            DownloadCenter.bundle = Bundle(args.from_bundle)
+    except BaseException as e:
+        logger.error(str(e))
+        sys.exit(2)
+
+    if args.json_events:
+        from umake.ui.json_events import JsonEventsUI, load_answers
+        try:
+            answers = load_answers(args.answers) if args.answers else None
+        except BaseException as e:
+            logger.error(str(e))
+            sys.exit(2)
+        JsonEventsUI(answers)
+    else:
+        CliUI()
     run_command_for_args(args)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module for a non interactive interface, reporting events as newline-delimited JSON objects"""
+
+import json
+import logging
+import re
+import sys
+from threading import Lock
+from time import monotonic, time
+from umake.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
+from umake.ui import UI
+from umake.tools import InputError, MainLoop
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+def load_answers(path):
+    """Load prompt answers from a yaml file like:
+
+    license: accept                    # answer to any license agreement
+    prompts:                           # answers to other prompts, by regular expression matching the prompt text
+      "already installed": "y"
+      "Choose installation path": "/opt/foo"
+    """
+    try:
+        with open(path) as f:
+            answers = yaml.safe_load(f) or {}
+        if not isinstance(answers, dict) or not isinstance(answers.get("prompts", {}), dict):
+            raise ValueError("expected a mapping with optional 'license' and 'prompts' keys")
+        for pattern in answers.get("prompts", {}):
+            re.compile(pattern)
+    except (OSError, ValueError, re.error, yaml.YAMLError) as e:
+        raise BaseException("Invalid answers file {}: {}".format(path, e)) from e
+    return answers
+
+
+class JsonEventsUI(UI):
+    """Report every event as a JSON object on its own line of stdout, answering prompts from an answers dict.
+
+    Other output is redirected to stderr, so that stdout only contains events."""
+
+    # minimum delay in seconds between two progress events of the same kind, except for the last one
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self, answers=None, stream=None):
+        # This this UI as current
+        super().__init__(self)
+        self._answers = answers or {}
+        self._stream = stream or sys.stdout
+        if self._stream is sys.stdout:
+            sys.stdout = sys.stderr
+        self._start_time = monotonic()
+        self._phase = None
+        self._phase_start_time = None
+        self._phases = {}
+        # progress name: (first report time, first report current size, last event time)
+        self._progress = {}
+        self._stream_lock = Lock()
+        self._log_handler = _EventLogHandler(self)
+        logging.getLogger().addHandler(self._log_handler)
+
+    def emit(self, event, **data):
+        """Write event with its data, current time and time elapsed since we started. This can be called from any
+        thread"""
+        data.update({"event": event, "time": time(), "elapsed": round(monotonic() - self._start_time, 3)})
+        with self._stream_lock:
+            self._stream.write(json.dumps(data, sort_keys=True) + "\n")
+            self._stream.flush()
+
+    def _end_phase(self):
+        if self._phase:
+            duration = round(monotonic() - self._phase_start_time, 3)
+            self._phases[self._phase] = self._phases.get(self._phase, 0) + duration
+            self.emit("phase_end", phase=self._phase, duration=duration)
+        self._phase = None
+
+    def _return_main_screen(self, status_code=0):
+        self._end_phase()
+        self.emit("result", status_code=status_code, success=status_code == 0, phases=self._phases,
+                  duration=round(monotonic() - self._start_time, 3))
+        MainLoop().quit(status_code=status_code)
+
+    def _event(self, name, data):
+        if name == "phase":
+            self._end_phase()
+            self._phase = data["phase"]
+            self._phase_start_time = monotonic()
+            self.emit("phase_start", **data)
+        elif name.endswith("_progress"):
+            self._emit_progress(name, data)
+        else:
+            self.emit(name, **data)
+
+    def _emit_progress(self, name, data):
+        """Emit throttled progress events, with rate and estimated remaining time when the size is known"""
+        now = monotonic()
+        current = data.get("current")
+        size = data.get("size")
+        finished = (current is not None and current == size) or data.get("percentage") == 100
+        if name not in self._progress:
+            self._progress[name] = (now, current, None)
+        first_time, first_current, last_event_time = self._progress[name]
+        if not finished and last_event_time is not None and now - last_event_time < self.PROGRESS_INTERVAL:
+            return
+        self._progress[name] = (first_time, first_current, now)
+        if current is not None and now > first_time:
+            rate = (current - first_current) / (now - first_time)
+            data["rate"] = round(rate)
+            data["eta"] = round((size - current) / rate, 1) if rate > 0 and size and size > 0 else None
+        self.emit("progress", kind=name[:-len("_progress")], **data)
+
+    def _display(self, contentType):
+        if isinstance(contentType, DisplayMessage):
+            self.emit("message", text=contentType.text)
+        elif isinstance(contentType, UnknownProgress):
+            # progress is reported by events, nothing to pulse
+            pass
+        elif isinstance(contentType, (InputText, TextWithChoices)):
+            self._answer(contentType)
+        else:
+            logger.error("Unexcepted content type to display to JSON events UI: {}".format(contentType))
+            MainLoop().quit(status_code=1)
+
+    def _find_answer(self, kind, text):
+        """Return the answer to the prompt from the answers file, or None to take the default one"""
+        if kind == "license" and "license" in self._answers:
+            return str(self._answers["license"])
+        for pattern, answer in self._answers.get("prompts", {}).items():
+            if re.search(pattern, text):
+                return str(answer)
+        return None
+
+    def _answer(self, contentType):
+        text = contentType.content
+        if isinstance(contentType, InputText):
+            kind = "input"
+            choices = None
+        else:
+            kind = "license" if isinstance(contentType, LicenseAgreement) else "choice"
+            choices = [choice.label for choice in contentType.choices]
+        answer = self._find_answer(kind, text)
+        self.emit("prompt", kind=kind, text=text, choices=choices, answer=answer)
+        try:
+            if isinstance(contentType, InputText):
+                contentType.run_callback(result=answer if answer is not None else contentType.default_input)
+            else:
+                contentType.choose(answer=answer)
+        except InputError as e:
+            logger.error("No valid answer to \"{}\": {}".format(text, e))
+            self._return_main_screen(status_code=1)
+
+
+class _EventLogHandler(logging.Handler):
+    """Report warnings and errors as events"""
+
+    def __init__(self, ui):
+        super().__init__(logging.WARNING)
+        self._ui = ui
+
+    def emit(self, record):
+        self._ui.emit("log", level=record.levelname.lower(), message=record.getMessage())